@@ -0,0 +1,106 @@
+"""
+Batched image augmentation with an independent draw per sample.
+
+torchvision transforms applied to a batch tensor draw one crop/flip/jitter for the
+whole batch. BatchAugment draws the parameters per sample and applies them with two
+fused ops: one index gather for crop + flip, and one per-sample 3x3 affine color
+transform for brightness, contrast, saturation, hue and grayscale.
+"""
+import math
+import torch
+
+# ITU-R 601 luma weights, same as torchvision's rgb_to_grayscale
+LUMA = torch.tensor([0.299, 0.587, 0.114])
+
+# RGB <-> YIQ, hue is rotated in the IQ plane
+RGB_TO_YIQ = torch.tensor([
+    [0.299, 0.587, 0.114],
+    [0.596, -0.274, -0.322],
+    [0.211, -0.523, 0.312],
+])
+YIQ_TO_RGB = torch.linalg.inv(RGB_TO_YIQ)
+
+
+class BatchAugment:
+    """
+    Per-sample RandomCrop + RandomHorizontalFlip + ColorJitter + RandomGrayscale for
+    (batch, 3, height, width) images in [0, 1], on whatever device the images are on.
+
+    Differences from the torchvision ops: the color ops are applied in a fixed order and
+    clamped once at the end instead of after every op, and hue is shifted by a rotation
+    in YIQ space instead of in HSV, which keeps the whole color transform linear.
+    """
+    def __init__(self, crop_size=(140, 140), flip_p=0.5, brightness=0.4, contrast=0.4,
+                 saturation=0.2, hue=0.1, grayscale_p=0.2, seed=None):
+        self.crop_size = crop_size
+        self.flip_p = flip_p
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.grayscale_p = grayscale_p
+        # parameters are drawn on the CPU so the same seed gives the same draws on any device
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+
+    def _uniform(self, n, low, high):
+        return low + (high - low) * torch.rand(n, generator=self.generator)
+
+    def _bernoulli(self, n, p):
+        return torch.rand(n, generator=self.generator) < p
+
+    def crop_and_flip(self, x):
+        b, _, height, width = x.shape
+        h, w = self.crop_size
+        assert h <= height and w <= width, f"crop {self.crop_size} is larger than the images {(height, width)}"
+        top = torch.randint(0, height - h + 1, (b,), generator=self.generator)
+        left = torch.randint(0, width - w + 1, (b,), generator=self.generator)
+        flip = self._bernoulli(b, self.flip_p)
+
+        rows = top[:, None] + torch.arange(h)
+        cols = torch.where(flip[:, None], torch.arange(w - 1, -1, -1), torch.arange(w))
+        cols = left[:, None] + cols
+        rows, cols = rows.to(x.device), cols.to(x.device)
+        batch_idx = torch.arange(b, device=x.device)[:, None, None]
+        # advanced indices around the channel slice give [batch, h, w, channels]
+        x = x[batch_idx, :, rows[:, :, None], cols[:, None, :]]
+        return x.permute(0, 3, 1, 2)
+
+    def color_transform(self, b):
+        """Per-sample color matrices [b, 3, 3] and the contrast factors"""
+        brightness = self._uniform(b, max(0, 1 - self.brightness), 1 + self.brightness)
+        contrast = self._uniform(b, max(0, 1 - self.contrast), 1 + self.contrast)
+        saturation = self._uniform(b, max(0, 1 - self.saturation), 1 + self.saturation)
+        theta = self._uniform(b, -self.hue, self.hue) * 2 * math.pi
+        grayscale = self._bernoulli(b, self.grayscale_p)
+
+        eye = torch.eye(3).expand(b, 3, 3)
+        gray = torch.ones(3, 1) * LUMA[None, :] # projects onto the luma of each pixel
+        sat = saturation[:, None, None] * eye + (1 - saturation[:, None, None]) * gray
+
+        cos, sin = torch.cos(theta), torch.sin(theta)
+        rot = torch.zeros(b, 3, 3)
+        rot[:, 0, 0] = 1
+        rot[:, 1, 1], rot[:, 1, 2] = cos, -sin
+        rot[:, 2, 1], rot[:, 2, 2] = sin, cos
+        hue = YIQ_TO_RGB @ rot @ RGB_TO_YIQ
+
+        mat = hue @ sat
+        mat = torch.where(grayscale[:, None, None], gray @ mat, mat)
+        return brightness, contrast, mat
+
+    def __call__(self, x):
+        x = self.crop_and_flip(x)
+        b = x.shape[0]
+        brightness, contrast, mat = self.color_transform(b)
+        # every color op maps gray to itself, so contrast blending towards the mean
+        # luma commutes with the matrix and the whole jitter is x -> A x + t
+        mean_luma = torch.einsum('c,bchw->b', LUMA.to(x.device, x.dtype), x) / (x.shape[2] * x.shape[3])
+        scale = (contrast * brightness).to(x.device, x.dtype)
+        shift = (1 - contrast).to(x.device, x.dtype) * brightness.to(x.device, x.dtype) * mean_luma
+        mat = (scale[:, None, None] * mat.to(x.device, x.dtype))
+        x = torch.einsum('bij,bjhw->bihw', mat, x) + shift[:, None, None, None]
+        return x.clamp(0, 1)
@@ -0,0 +1,152 @@
+"""
+Throughput benchmark of utils.get_dataloaders on its own, sweeping loader settings:
+
+$ python make_synthetic_shards.py --out_root=/tmp/nsd-synthetic
+$ python bench_loader.py --shard_root=/tmp/nsd-synthetic --batch_sizes=32,128 --num_workers_list=0,4 \
+    --image_decodes=pil,batched --train_caches=False,True --out_path=bench.json
+
+(a sweep over a single number is written --batch_sizes=32, with the trailing comma)
+
+Every combination of the sweep values reads num_epochs epochs of the
+train split and reports, as one JSON record each:
+
+    time_to_first_batch_s    from building the loaders to the first batch
+    samples_per_s            over all epochs, first batch included
+    bytes_per_s              bytes of the delivered (decoded) batches per second
+    shard_bytes_per_s        bytes of the tar shards read per second
+    wait_fraction            share of the time the consumer was blocked on the loader
+    worker_utilization       cpu time of the loading processes / (wall time * processes)
+    epoch_s                  wall time of each epoch
+
+step_ms simulates the compute of a training step, so wait_fraction shows how much of it
+the loader would hide. With device set the batches go through loaders.DevicePrefetcher.
+"""
+import os
+import gc
+import json
+import time
+import resource
+import itertools
+import torch
+
+import utils
+import shards
+import loaders
+
+
+def cpu_seconds(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def batch_nbytes(batch):
+    return sum(x.numel() * x.element_size() for x in batch if isinstance(x, torch.Tensor))
+
+
+def run(train_url, val_url, batch_size, num_workers, image_decode, train_cache, voxels_key,
+        num_epochs, max_batches, step_ms, device):
+    self_cpu0, children_cpu0 = cpu_seconds(resource.RUSAGE_SELF), cpu_seconds(resource.RUSAGE_CHILDREN)
+    t_start = time.time()
+    train_dl, _ = utils.get_dataloaders(
+        batch_size, "images",
+        num_workers=num_workers,
+        train_url=train_url,
+        val_url=val_url,
+        voxels_key=voxels_key,
+        image_decode=image_decode,
+        train_cache_bytes=int(100e9) if train_cache else 0,
+        val_cache_bytes=0,
+    )
+    if device:
+        train_dl = loaders.DevicePrefetcher(train_dl, device)
+
+    num_samples, num_bytes, wait, time_to_first_batch = 0, 0, 0., None
+    epoch_times, epoch_samples = [], []
+    for epoch in range(num_epochs):
+        t_epoch = time.time()
+        it = iter(train_dl)
+        for i in itertools.count():
+            if max_batches and i == max_batches:
+                break
+            t0 = time.time()
+            batch = next(it, None)
+            wait += time.time() - t0
+            if batch is None:
+                break
+            if time_to_first_batch is None:
+                time_to_first_batch = time.time() - t_start
+            num_samples += len(batch[0])
+            num_bytes += batch_nbytes(batch)
+            if step_ms:
+                time.sleep(step_ms / 1000)
+        del it
+        epoch_times.append(time.time() - t_epoch)
+        epoch_samples.append(num_samples - sum(epoch_samples))
+    total = time.time() - t_start
+
+    # shut the workers down so their cpu time shows up in RUSAGE_CHILDREN
+    del train_dl
+    gc.collect()
+    if num_workers > 0:
+        utilization = (cpu_seconds(resource.RUSAGE_CHILDREN) - children_cpu0) / (total * num_workers)
+    else:
+        utilization = (cpu_seconds(resource.RUSAGE_SELF) - self_cpu0) / total
+
+    # with a train cache only the first epoch reads the shards
+    samples_from_shards = epoch_samples[0] if train_cache else num_samples
+    counts = shards.get_shard_counts(train_url, 'train')
+    bytes_per_sample = sum(os.path.getsize(u) for u in counts) / sum(counts.values())
+    return dict(
+        time_to_first_batch_s=time_to_first_batch,
+        samples_per_s=num_samples / total,
+        bytes_per_s=num_bytes / total,
+        shard_bytes_per_s=bytes_per_sample * samples_from_shards / total,
+        wait_fraction=wait / total,
+        worker_utilization=utilization,
+        epoch_s=epoch_times,
+        num_samples=num_samples,
+    )
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    shard_root = '/tmp/nsd-synthetic' # from make_synthetic_shards.py, or the real local shards
+    num_train_shards = 10 # train_subj01_{0..num_train_shards-1}.tar
+    voxels_key = 'nsdgeneral.npy' # ('nsdgeneral.npy', 'wholebrain_3d.npy')
+    batch_sizes = (32, 128) # sweeps
+    num_workers_list = (0, 4)
+    image_decodes = 'pil,batched' # comma separated ('pil', 'batched', 'predecoded'), predecoded needs predecode_images.py shards
+    train_caches = (False,) # (False, True) compares against loaders.CachedLoader replays
+    num_epochs = 2
+    max_batches = 0 # per epoch, 0 for all
+    step_ms = 0. # simulated training step
+    device = '' # e.g. 'cuda' to include the DevicePrefetcher
+    out_path = '' # also write the records here
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str, tuple))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+    val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    records = []
+    sweep = itertools.product(batch_sizes, num_workers_list, image_decodes.split(','), train_caches)
+    for batch_size, num_workers, image_decode, cache in sweep:
+        settings = dict(batch_size=batch_size, num_workers=num_workers, image_decode=image_decode,
+                        train_cache=cache, voxels_key=voxels_key, step_ms=step_ms, device=device)
+        result = run(train_url, val_url, batch_size, num_workers, image_decode, cache, voxels_key,
+                     num_epochs, max_batches, step_ms, device)
+        record = dict(settings, **result)
+        print(json.dumps(record))
+        records.append(record)
+
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(dict(config=config, results=records), f, indent=2)
+        print(f"wrote {len(records)} results to {out_path}")
@@ -0,0 +1,266 @@
+"""
+Training step time, peak gpu memory and parameter count of model variants, on random inputs:
+
+$ python benchmark_models.py --bench=lowrank --arch=BrainNetworkLarge --ranks=0,128,256,512
+
+bench=lowrank    BrainNetwork / BrainNetworkLarge against the rank of their input projection
+                 (0 is the full nn.Linear, see models.LowRankLinear)
+bench=roi        the same against the number of ROI blocks of a block-diagonal input layer
+                 (models.RoiBlockLinear), contiguous equal blocks or the ROI map at roi_path
+bench=sparse3d   NewVoxel3dConvEncoder with dense against sparse (mask only) conv blocks, on
+                 the brain mask at mask_path or an ellipsoid "brain" in volume_dims. Also
+                 checks the sparse conv features against the dense ones with their features
+                 zeroed outside the mask after every block (max_abs_diff, in eval mode)
+bench=checkpoint activation checkpointing policies (see checkpointing.py) against batch size,
+                 for BrainNetwork / BrainNetworkLarge or arch=prior_w_voxel2clip (the joint
+                 BrainNetwork + diffusion prior of train_prior_w_voxel2clip.py, the policy
+                 applied to both), out of memory settings are recorded as oom
+bench=precision  fp32 / bf16 / fp16 training steps (see utils.get_autocast) of arch, each in
+                 its own process so that peak_rss_mb, the cpu memory, is its own
+bench=inference  eval forward latency of arch (or arch=NewVoxel3dConvEncoder, sparse with
+                 sparse=True) eager against inference.optimize_for_inference
+
+precision sets the autocast mode of the other benches.
+
+Each setting prints one JSON record, out_path also writes them all.
+"""
+import os
+import gc
+import json
+import multiprocessing
+import numpy as np
+import torch
+from dalle2_pytorch import DiffusionPriorNetwork
+
+import utils
+import models
+import brain_mask
+import checkpointing
+import inference
+from model3d import NewVoxel3dConvEncoder
+
+
+def count(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def bench_lowrank(config):
+    for rank in config['ranks']:
+        model_cls = getattr(models, config['arch'])
+        model = model_cls(out_dim=768, in_dim=config['in_dim'], rank=rank).to(config['device'])
+        voxels = torch.randn(config['batch_size'], config['in_dim'], device=config['device'])
+        yield dict(rank=rank, params=count(model),
+                   **utils.measure_step(model, voxels, lambda out: out.float().pow(2).mean(),
+                                        steps=config['steps'], warmup=config['warmup'], precision=config['precision']))
+        del model, voxels
+
+
+def bench_roi(config):
+    if config['roi_path']:
+        settings = [None, config['roi_path']]
+    else:
+        settings = [None if n == 0 else n for n in config['roi_blocks']]
+    for roi_index in settings:
+        model_cls = getattr(models, config['arch'])
+        model = model_cls(out_dim=768, in_dim=config['in_dim'], roi_index=roi_index).to(config['device'])
+        voxels = torch.randn(config['batch_size'], config['in_dim'], device=config['device'])
+        yield dict(roi_index=roi_index or 0, params=count(model),
+                   **utils.measure_step(model, voxels, lambda out: out.float().pow(2).mean(),
+                                        steps=config['steps'], warmup=config['warmup'], precision=config['precision']))
+        del model, voxels
+
+
+def masked_dense_features(model, volumes, masks):
+    """The dense conv blocks of model, zeroing the features outside the sparse path's active sites"""
+    x = (volumes * masks[0]).unsqueeze(1)
+    x = model.input_dropout(x)
+    for block, mask in zip(model.conv_blocks, masks[1:]):
+        x = block(x) * mask
+    return x
+
+
+def load_bench_mask(config):
+    """The brain mask at mask_path, or an ellipsoid "brain" in volume_dims"""
+    if config['mask_path']:
+        return brain_mask.load_mask(os.path.expanduser(config['mask_path'])).level_mask(config['mask_level'])
+    grid = np.meshgrid(*[np.linspace(-1, 1, d) for d in config['volume_dims']], indexing='ij')
+    return sum(g**2 for g in grid) < 0.8
+
+
+def encoder3d_kwargs(config, mask):
+    n = len(config['channels3d'])
+    return dict(dims=list(mask.shape), attention_width=config['channels3d'][-1], out_dim=768,
+                channels=list(config['channels3d']), strides=list(config['strides3d']),
+                padding=list(config['padding3d']), dilation=[1] * n, kernel=[3] * n)
+
+
+def bench_sparse3d(config):
+    mask = load_bench_mask(config)
+    kwargs = encoder3d_kwargs(config, mask)
+    dense = NewVoxel3dConvEncoder(**kwargs).to(config['device'])
+    sparse = NewVoxel3dConvEncoder(mask=mask, **kwargs).to(config['device'])
+    sparse.load_state_dict(dense.state_dict())
+    volumes = torch.randn(config['batch_size'], *mask.shape, device=config['device'])
+    volumes = volumes * torch.from_numpy(mask).to(volumes.device)
+
+    dense.eval()
+    sparse.eval()
+    with torch.no_grad():
+        masks, _ = sparse._sparse_plans(volumes.device)
+        diff = (sparse.conv_features(volumes) - masked_dense_features(dense, volumes, masks)).abs().max().item()
+    print(f"sparse vs masked dense conv features, max abs diff {diff:.2e}")
+
+    for mode, model in (('dense', dense), ('sparse', sparse)):
+        yield dict(mode=mode, dims=list(mask.shape), active_fraction=float(mask.mean()), max_abs_diff=diff,
+                   **utils.measure_step(model, volumes, lambda out: out.float().pow(2).mean(),
+                                        steps=config['steps'], warmup=config['warmup'], precision=config['precision']))
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+class PriorLoss(torch.nn.Module):
+    """BrainDiffusionPrior's loss as a module of (voxel, image_embed), for utils.measure_step"""
+    def __init__(self, diffusion_prior):
+        super().__init__()
+        self.diffusion_prior = diffusion_prior
+
+    def forward(self, voxel, image_embed):
+        return self.diffusion_prior(image_embed=image_embed, voxel=voxel)[0]
+
+
+def make_model(config, policy='none'):
+    if config['arch'] == 'prior_w_voxel2clip':
+        net = DiffusionPriorNetwork(dim=768, depth=6, dim_head=64, heads=12)
+        model = models.BrainDiffusionPrior(net=net, image_embed_dim=768, condition_on_text_encodings=False,
+                                           timesteps=1000, voxel2clip=models.BrainNetwork(768, config['in_dim']))
+        checkpointing.apply_checkpointing(model.voxel2clip, policy)
+        checkpointing.apply_checkpointing(model, policy)
+        return PriorLoss(model), lambda loss: loss
+    model = getattr(models, config['arch'])(out_dim=768, in_dim=config['in_dim'])
+    checkpointing.apply_checkpointing(model, policy)
+    return model, lambda out: out.float().pow(2).mean()
+
+
+def bench_checkpoint(config):
+    for batch_size in config['batch_sizes']:
+        for policy in config['policies']:
+            model, loss_fn = make_model(config, policy)
+            model = model.to(config['device'])
+            inputs = make_inputs(config, batch_size)
+            try:
+                result = utils.measure_step(model, inputs, loss_fn, steps=config['steps'],
+                                            warmup=config['warmup'], precision=config['precision'])
+            except RuntimeError as e:
+                if 'out of memory' not in str(e):
+                    raise
+                result = dict(oom=True)
+            yield dict(policy=policy, batch_size=batch_size, **result)
+            del model, inputs
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+def bench_inference(config):
+    if config['arch'] == 'NewVoxel3dConvEncoder':
+        mask = load_bench_mask(config)
+        model = NewVoxel3dConvEncoder(mask=mask if config['sparse'] else None, **encoder3d_kwargs(config, mask))
+        inputs = torch.randn(config['batch_size'], *mask.shape) * torch.from_numpy(mask)
+    else:
+        model = getattr(models, config['arch'])(out_dim=768, in_dim=config['in_dim'])
+        inputs = torch.randn(config['batch_size'], config['in_dim'])
+    model, inputs = model.to(config['device']), inputs.to(config['device'])
+    # BatchNorm stats and affines away from their init, so that the folding has something to fold
+    with torch.no_grad():
+        model.train()
+        for _ in range(3):
+            model(inputs)
+        for m in model.modules():
+            if isinstance(m, torch.nn.modules.batchnorm._BatchNorm):
+                m.weight.uniform_(-1, 1)
+                m.bias.normal_()
+    model.eval()
+    optimized = inference.optimize_for_inference(model, inputs)
+    for mode, m in (('eager', model), ('optimized', optimized)):
+        yield dict(mode=mode, latency_ms=inference.measure_latency(m, inputs, config['steps'], config['warmup']))
+
+
+def make_inputs(config, batch_size):
+    inputs = [torch.randn(batch_size, config['in_dim'], device=config['device'])]
+    if config['arch'] == 'prior_w_voxel2clip':
+        inputs.append(torch.randn(batch_size, 768, device=config['device']))
+    return inputs
+
+
+def precision_step(config, precision):
+    torch.manual_seed(0)
+    model, loss_fn = make_model(config)
+    model = model.to(config['device'])
+    if precision != 'fp32':
+        utils.keep_norms_fp32(model)
+    return utils.measure_step(model, make_inputs(config, config['batch_size']), loss_fn,
+                              steps=config['steps'], warmup=config['warmup'], precision=precision)
+
+
+def bench_precision(config):
+    ctx = multiprocessing.get_context('spawn')
+    for precision in config['precisions']:
+        if precision == 'fp16' and torch.device(config['device']).type == 'cpu':
+            print("skipping fp16, cpu autocast only does bf16")
+            continue
+        with ctx.Pool(1) as pool:
+            yield dict(precision=precision, **pool.apply(precision_step, (config, precision)))
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    bench = 'lowrank' # ('lowrank', 'roi', 'sparse3d', 'checkpoint', 'precision', 'inference')
+    arch = 'BrainNetwork' # ('BrainNetwork', 'BrainNetworkLarge', 'prior_w_voxel2clip' for checkpoint and precision, 'NewVoxel3dConvEncoder' for inference)
+    in_dim = 15724
+    ranks = (0, 64, 128, 256, 512, 1024)
+    roi_blocks = (0, 2, 4, 8, 16) # contiguous blocks, 0 is the full nn.Linear
+    roi_path = '' # .npy ROI map, compared against the full nn.Linear instead of roi_blocks
+    mask_path = '' # sparse3d: from make_brain_mask.py, else an ellipsoid mask in volume_dims
+    mask_level = 0
+    volume_dims = (83, 104, 81)
+    channels3d = (64, 128, 256, 64) # the conv blocks of config/3D_combo.py, last one is the attention width
+    strides3d = (1, 2, 3, 3)
+    padding3d = (0, 0, 0, 0)
+    sparse = False # inference: the sparse conv path of NewVoxel3dConvEncoder
+    policies = ('none', 'every2', 'all') # checkpoint
+    batch_sizes = (300, 600, 1200) # checkpoint
+    precisions = ('fp32', 'bf16', 'fp16') # precision
+    batch_size = 300
+    steps = 20
+    warmup = 5
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    precision = 'fp16' if device == 'cuda' else 'fp32' # ('fp32', 'bf16', 'fp16')
+    out_path = '' # also write the records here
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str, tuple))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    benches = dict(lowrank=bench_lowrank, roi=bench_roi, sparse3d=bench_sparse3d, checkpoint=bench_checkpoint,
+                   precision=bench_precision, inference=bench_inference)
+    assert bench in benches, f"bench must be one of {list(benches)}"
+
+    records = []
+    for result in benches[bench](config):
+        record = dict(dict(bench=bench, arch=arch, batch_size=batch_size), **result)
+        print(json.dumps(record))
+        records.append(record)
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(dict(config=config, results=records), f, indent=2)
+        print(f"wrote {len(records)} results to {out_path}")
@@ -0,0 +1,111 @@
+"""
+Brain mask for the wholebrain_3d volumes, most of whose [83, 104, 81] voxels are outside
+the brain and always zero.
+
+make_brain_mask.py computes the union of the nonzero voxels over the dataset and its
+bounding box. With the mask the volumes can be stored as just their in-mask voxels
+(see pack_voxels.py --mask_path=...), and a loader stage rebuilds the dense volume
+cropped to the bounding box, optionally average pooled to a lower resolution level.
+NewVoxel3dConvEncoder then gets dims=mask.dims(level) instead of the full volume shape,
+and optionally mask=mask.level_mask(level) to convolve only the voxels inside the mask.
+"""
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class BrainMask:
+    def __init__(self, mask, bbox):
+        """mask is a boolean volume, bbox a [3, 2] array of (start, stop) per axis"""
+        self.mask = np.asarray(mask, dtype=bool)
+        self.bbox = np.asarray(bbox, dtype=np.int64)
+        self.slices = tuple(slice(int(lo), int(hi)) for lo, hi in self.bbox)
+        self.crop_mask = self.mask[self.slices]
+        self.crop_shape = list(self.crop_mask.shape)
+        # position of each in-mask voxel in the flattened crop
+        self.flat_index = torch.from_numpy(np.flatnonzero(self.crop_mask))
+        self.num_voxels = len(self.flat_index)
+
+    def __repr__(self):
+        return (f"BrainMask(volume={list(self.mask.shape)}, crop={self.crop_shape}, "
+                f"voxels={self.num_voxels} ({100 * self.num_voxels / self.mask.size:.1f}%))")
+
+    def __eq__(self, other):
+        return isinstance(other, BrainMask) and np.array_equal(self.mask, other.mask) \
+            and np.array_equal(self.bbox, other.bbox)
+
+    def dims(self, level=0):
+        """Shape of the volumes coming out of __call__ at a pyramid level"""
+        return [math.ceil(d / 2**level) for d in self.crop_shape]
+
+    def level_mask(self, level=0):
+        """The crop mask at a pyramid level, a voxel is in if any voxel it pools over is"""
+        mask = torch.from_numpy(self.crop_mask)[None, None].float()
+        if level > 0:
+            k = 2**level
+            mask = F.max_pool3d(mask, k, stride=k, ceil_mode=True)
+        return mask[0, 0].numpy() > 0
+
+    def pack(self, volumes):
+        """[n, *volume] dense volumes to [n, num_voxels] in-mask values (numpy)"""
+        volumes = np.asarray(volumes)
+        crop = volumes[(slice(None),) + self.slices]
+        return crop.reshape(len(crop), -1)[:, self.flat_index.numpy()]
+
+    def unpack(self, values):
+        """[n, num_voxels] in-mask values to [n, *crop_shape] cropped volumes, zero outside the mask"""
+        out = values.new_zeros(len(values), int(np.prod(self.crop_shape)))
+        out[:, self.flat_index] = values
+        return out.view(len(values), *self.crop_shape)
+
+    def crop(self, volumes):
+        """[n, *volume] dense volumes to [n, *crop_shape], zero outside the mask"""
+        crop = volumes[(slice(None),) + self.slices]
+        return crop * torch.from_numpy(self.crop_mask).to(crop.dtype)
+
+    def __call__(self, voxels, level=0):
+        """
+        Loader stage: batches of packed ([n, num_voxels]) or dense ([n, *volume]) voxels
+        to cropped volumes at the given pyramid level, in the dtype they came in. The tar
+        path batches numpy arrays, they come out as tensors too.
+        """
+        voxels = torch.as_tensor(voxels)
+        if voxels.ndim == 2:
+            volumes = self.unpack(voxels)
+        else:
+            volumes = self.crop(voxels)
+        if level > 0:
+            k = 2**level
+            # no half precision pooling on the cpu
+            volumes = F.avg_pool3d(volumes.unsqueeze(1).float(), k, stride=k, ceil_mode=True) \
+                .squeeze(1).to(voxels.dtype)
+        return volumes
+
+
+def union_mask(volume_batches, threshold=0.):
+    """Voxels where any volume exceeds threshold in absolute value"""
+    mask = None
+    for volumes in volume_batches:
+        nonzero = (np.abs(np.asarray(volumes)) > threshold).any(axis=0)
+        mask = nonzero if mask is None else mask | nonzero
+    return mask
+
+
+def get_bbox(mask, pad=0):
+    """Tight [3, 2] (start, stop) box around the mask, grown by pad voxels on each side"""
+    bbox = []
+    for axis in range(mask.ndim):
+        other = tuple(a for a in range(mask.ndim) if a != axis)
+        idx = np.flatnonzero(mask.any(axis=other))
+        bbox.append([max(idx[0] - pad, 0), min(idx[-1] + 1 + pad, mask.shape[axis])])
+    return np.array(bbox, dtype=np.int64)
+
+
+def save_mask(path, mask, bbox):
+    np.savez_compressed(path, mask=mask, bbox=bbox)
+
+
+def load_mask(path):
+    data = np.load(path)
+    return BrainMask(data['mask'], data['bbox'])
@@ -0,0 +1,141 @@
+"""
+Check shard_cache.ShardCache against a local HTTP stand-in for the Hugging Face shards:
+
+$ python make_synthetic_shards.py --out_root=/tmp/nsd-synthetic
+$ python check_shard_cache.py --shard_root=/tmp/nsd-synthetic
+
+shard_root is served on http://127.0.0.1, where the first request for every flaky_every-th
+train shard fails with a 503. Then
+
+    read       every train shard goes through a ShardCache that holds max_cached_shards
+               shards, prefetching num_prefetch ahead: the bytes must match the local
+               files, the failed downloads must be retried and the cache must stay within
+               its budget (plus the prefetched shards not read yet)
+    evicted    a prefetched shard is removed from the cache before it is read, and must
+               be downloaded again
+    loader     utils.get_dataloaders over the http urls must deliver the same samples as
+               over the local shards
+"""
+import os
+import json
+import shutil
+import tempfile
+import functools
+import threading
+import collections
+import urllib.error
+import http.server
+import numpy as np
+
+import utils
+import shard_cache
+
+
+class StandInHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves a directory, failing the next request for each path in flaky"""
+    flaky = set()
+    requests = collections.Counter()
+
+    def do_GET(self):
+        self.requests[self.path] += 1
+        if self.path in self.flaky:
+            self.flaky.discard(self.path)
+            self.send_error(503, "flaky on purpose")
+            return
+        super().do_GET()
+
+    def log_message(self, *args):
+        pass
+
+
+def cache_bytes(cache_dir):
+    return sum(os.path.getsize(os.path.join(cache_dir, n)) for n in os.listdir(cache_dir) if not n.endswith('.tmp'))
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def trials(loader):
+    return sorted(int(t) for _, batch_trials in loader for t in np.asarray(batch_trials).reshape(-1))
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    shard_root = '/tmp/nsd-synthetic' # from make_synthetic_shards.py
+    max_cached_shards = 2 # cache budget, in shards
+    num_prefetch = 2
+    flaky_every = 3 # every n-th train shard fails its first request, 0 for none
+    batch_size = 32
+    num_workers = 2
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    shard_root = os.path.expanduser(shard_root)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(StandInHandler, directory=shard_root))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    print("serving", shard_root, "at", base)
+
+    names = {split: sorted(n for n in os.listdir(os.path.join(shard_root, split)) if n.endswith('.tar'))
+             for split in ('train', 'val')}
+    urls = [f"{base}/train/{n}" for n in names['train']]
+    local = {url: os.path.join(shard_root, 'train', n) for url, n in zip(urls, names['train'])}
+    largest = max(os.path.getsize(p) for p in local.values())
+    if flaky_every:
+        StandInHandler.flaky.update(f"/train/{n}" for n in names['train'][::flaky_every])
+    flaky = set(StandInHandler.flaky)
+    tmp_dir = tempfile.mkdtemp(prefix='check-shard-cache-')
+
+    # read
+    cache = shard_cache.ShardCache(os.path.join(tmp_dir, 'read'), max_cached_shards * largest, num_prefetch=num_prefetch)
+    peak, failed = 0, 0
+    for i, url in enumerate(urls):
+        cache.prefetch(urls[i + 1:])
+        try:
+            path = cache.get(url)
+        except urllib.error.HTTPError:
+            # a shard nobody prefetched fails in get, the next get has to retry it
+            failed += 1
+            path = cache.get(url)
+        assert read_bytes(path) == read_bytes(local[url]), f"{url} differs from {local[url]}"
+        peak = max(peak, cache_bytes(cache.cache_dir))
+    retried = sum(StandInHandler.requests[p] >= 2 for p in flaky)
+    print(f"read: {len(urls)} shards, {cache.hits} hits, {cache.misses} misses, {len(flaky)} flaky "
+          f"({failed} failed in get, {retried} retried), peak cache {peak / largest:.1f} shards")
+    assert retried == len(flaky), "a failed download wasn't retried"
+    assert peak <= cache.max_bytes + num_prefetch * largest, "the cache grew past its budget"
+
+    # evicted
+    cache = shard_cache.ShardCache(os.path.join(tmp_dir, 'evicted'), max_cached_shards * largest, num_prefetch=1)
+    url = urls[-1]
+    cache.prefetch([url])
+    cache._pending[url].result()
+    os.remove(cache.cache_path(url)) # e.g. evicted by another worker
+    assert read_bytes(cache.get(url)) == read_bytes(local[url])
+    print("evicted: a prefetched shard removed before it was read is downloaded again")
+
+    # loader
+    train_url = f"{base}/train/train_subj01_{{0..{len(urls) - 1}}}.tar"
+    val_url = f"{base}/val/val_subj01_{{0..{len(names['val']) - 1}}}.tar"
+    kwargs = dict(num_workers=num_workers, val_cache_bytes=0, prefetch_shards=num_prefetch,
+                  cache_dir=os.path.join(tmp_dir, 'loader'), shard_cache_bytes=max_cached_shards * largest)
+    remote = utils.get_dataloaders(batch_size, "trial", train_url=train_url, val_url=val_url, **kwargs)
+    local_loaders = utils.get_dataloaders(batch_size, "trial", train_url=train_url.replace(base, shard_root),
+                                          val_url=val_url.replace(base, shard_root), **kwargs)
+    for split, r, l in zip(('train', 'val'), remote, local_loaders):
+        remote_trials, local_trials = trials(r), trials(l)
+        print(f"loader: {split} {len(remote_trials)} samples over http, {len(local_trials)} local")
+        assert remote_trials == local_trials, f"the {split} samples over http differ from the local ones"
+
+    server.shutdown()
+    shutil.rmtree(tmp_dir)
+    print("all checks passed")
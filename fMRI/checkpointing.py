@@ -0,0 +1,134 @@
+"""
+Selective activation checkpointing for voxel2clip and the diffusion prior.
+
+A checkpointed block keeps only its inputs for backward and recomputes everything inside
+it then, trading compute (about one extra forward of the block) for activation memory,
+which lets the batch size, and with it the number of InfoNCE negatives, grow.
+
+apply_checkpointing(model, policy) wraps the residual blocks of BrainNetwork (mlp),
+BrainNetworkLarge (lins), NewVoxel3dConvEncoder (transformer.resblocks) or the
+causal transformer layers of a (Brain)DiffusionPrior / DiffusionPriorNetwork, chosen by
+policy:
+
+    'none'    nothing
+    'all'     every block
+    'everyK'  blocks 0, K, 2K, ... e.g. 'every2' for every other one
+
+benchmark_models.py --bench=checkpoint measures peak memory and step time per policy.
+"""
+import contextlib
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+PREFIX = 'checkpointed.'
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    """BatchNorms still normalize with the batch statistics, but don't update their running ones"""
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, momentum in zip(norms, momenta):
+            m.momentum = momentum
+
+
+class CheckpointWrapper(nn.Module):
+    """
+    Runs module under torch.utils.checkpoint while training with grad enabled. The
+    recomputation in backward doesn't update BatchNorm running stats a second time (dropout
+    masks are replayed from the saved RNG state). The state dict keys are those of module,
+    so checkpoints load with or without the wrapper.
+    """
+    def __init__(self, module):
+        super().__init__()
+        self.checkpointed = module
+        self.recomputing = False
+        self._register_state_dict_hook(self._strip_prefix)
+        self._register_load_state_dict_pre_hook(self._add_prefix)
+
+    def __getattr__(self, name):
+        if name == 'checkpointed':
+            return super().__getattr__(name)
+        try:
+            return super().__getattr__(name)
+        except AttributeError:
+            return getattr(self.checkpointed, name)
+
+    def __getitem__(self, idx):
+        return self.checkpointed[idx]
+
+    def forward(self, *args, **kwargs):
+        if not (self.training and torch.is_grad_enabled()):
+            return self.checkpointed(*args, **kwargs)
+        self.recomputing = False
+        out = checkpoint(self._run, *args, use_reentrant=False, **kwargs)
+        # the next call of _run, in backward, is the recomputation
+        self.recomputing = True
+        return out
+
+    def _run(self, *args, **kwargs):
+        if not self.recomputing:
+            return self.checkpointed(*args, **kwargs)
+        with frozen_batchnorm_stats(self.checkpointed):
+            return self.checkpointed(*args, **kwargs)
+
+    @staticmethod
+    def _strip_prefix(module, state_dict, prefix, local_metadata):
+        for key in list(state_dict):
+            if key.startswith(prefix + PREFIX):
+                state_dict[prefix + key[len(prefix + PREFIX):]] = state_dict.pop(key)
+        return state_dict
+
+    @staticmethod
+    def _add_prefix(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        for key in list(state_dict):
+            if key.startswith(prefix) and not key.startswith(prefix + PREFIX):
+                state_dict[prefix + PREFIX + key[len(prefix):]] = state_dict.pop(key)
+
+
+def checkpointable_blocks(model):
+    """
+    The blocks of a model that policies choose from, each a list of (container, index)
+    of the modules to wrap
+    """
+    model = getattr(model, 'module', model) # DDP
+    if hasattr(model, 'net') and hasattr(model.net, 'causal_transformer'):
+        model = model.net # DiffusionPrior -> DiffusionPriorNetwork
+    if hasattr(model, 'causal_transformer'):
+        # layers of [attention, feedforward], each called with its own residual outside
+        return [[(layer, 0), (layer, 1)] for layer in model.causal_transformer.layers]
+    for name in ('mlp', 'lins'):
+        if isinstance(getattr(model, name, None), nn.ModuleList):
+            blocks = getattr(model, name)
+            return [[(blocks, i)] for i in range(len(blocks))]
+    if hasattr(model, 'transformer') and hasattr(model.transformer, 'resblocks'):
+        blocks = model.transformer.resblocks
+        return [[(blocks, i)] for i in range(len(blocks))]
+    raise ValueError(f"no checkpointable blocks known for {type(model).__name__}")
+
+
+def selected(policy, num_blocks):
+    if policy == 'none':
+        return []
+    if policy == 'all':
+        return list(range(num_blocks))
+    if policy.startswith('every') and policy[len('every'):].isdigit():
+        return list(range(0, num_blocks, int(policy[len('every'):])))
+    raise ValueError(f"unknown checkpointing policy {policy}, expected 'none', 'all' or 'everyK'")
+
+
+def apply_checkpointing(model, policy):
+    """Wrap the blocks of model chosen by policy in CheckpointWrappers, in place. Returns their indices."""
+    blocks = checkpointable_blocks(model)
+    chosen = selected(policy, len(blocks))
+    for i in chosen:
+        for container, idx in blocks[i]:
+            if not isinstance(container[idx], CheckpointWrapper):
+                container[idx] = CheckpointWrapper(container[idx])
+    return chosen
@@ -0,0 +1,229 @@
+"""
+Offline cache of Clipper image embeddings keyed by the webdataset sample __key__.
+
+Written by precompute_clip_embs.py and read by utils.get_dataloaders(clip_emb_dir=...).
+Each Clipper configuration gets its own directory (see get_cache_dir), laid out as:
+
+    config.json         Clipper.get_config() the embeddings were computed with
+    {split}_embs.npy    float16 array of shape (num_samples, emb_dim)
+    {split}_keys.json   sample keys, row i of {split}_embs.npy belongs to keys[i]
+
+EmbeddingLRU is the online counterpart, used by Clipper(cache_size=...): embeddings
+keyed by a hash of the image / text content and the Clipper config, kept in a bounded
+in-memory LRU and optionally one file per embedding on disk.
+"""
+import os
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+
+
+def config_hash(clip_config):
+    return hashlib.sha1(json.dumps(clip_config, sort_keys=True).encode()).hexdigest()[:12]
+
+def get_cache_dir(cache_root, clip_config):
+    # changing any of the Clipper settings gives a new directory, so stale embeddings are never used
+    variant = clip_config['clip_variant'].replace('/', '-')
+    return os.path.join(os.path.expanduser(cache_root), f"{variant}-{config_hash(clip_config)}")
+
+def read_config(cache_dir):
+    path = os.path.join(cache_dir, 'config.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def is_complete(cache_dir, split, clip_config):
+    if read_config(cache_dir) != clip_config:
+        return False
+    return os.path.exists(os.path.join(cache_dir, f'{split}_embs.npy')) and \
+        os.path.exists(os.path.join(cache_dir, f'{split}_keys.json'))
+
+def write_split(cache_dir, split, keys, embs, clip_config):
+    assert len(keys) == len(embs), f"got {len(keys)} keys for {len(embs)} embeddings"
+    assert len(set(keys)) == len(keys), "sample keys must be unique"
+    os.makedirs(cache_dir, exist_ok=True)
+    old_config = read_config(cache_dir)
+    if old_config is not None and old_config != clip_config:
+        # the other split was computed with different settings, so it has to go
+        for name in os.listdir(cache_dir):
+            if name.endswith('_embs.npy') or name.endswith('_keys.json'):
+                os.remove(os.path.join(cache_dir, name))
+    with open(os.path.join(cache_dir, 'config.json'), 'w') as f:
+        json.dump(clip_config, f, indent=2)
+
+    # write to temp files and rename so an interrupted run never leaves a half written split
+    embs_path = os.path.join(cache_dir, f'{split}_embs.npy')
+    np.save(embs_path + '.tmp.npy', np.asarray(embs, dtype=np.float16))
+    os.replace(embs_path + '.tmp.npy', embs_path)
+    keys_path = os.path.join(cache_dir, f'{split}_keys.json')
+    with open(keys_path + '.tmp', 'w') as f:
+        json.dump(list(keys), f)
+    os.replace(keys_path + '.tmp', keys_path)
+    print(f"wrote {len(keys)} {split} embeddings to {cache_dir}")
+
+
+class ClipEmbeddingCache:
+    """
+    Looks up precomputed embeddings by sample key. The embeddings are memory-mapped and
+    opened lazily, so DataLoader workers each map the same file instead of getting a
+    pickled copy of the whole array.
+    """
+    def __init__(self, cache_dir, split, clip_config=None):
+        if clip_config is not None and read_config(cache_dir) != clip_config:
+            raise ValueError(f"CLIP embedding cache {cache_dir} is missing or was computed with a "
+                             f"different Clipper config, rerun precompute_clip_embs.py")
+        if not is_complete(cache_dir, split, read_config(cache_dir)):
+            raise ValueError(f"no {split} embeddings in {cache_dir}, run precompute_clip_embs.py")
+        self.embs_path = os.path.join(cache_dir, f'{split}_embs.npy')
+        with open(os.path.join(cache_dir, f'{split}_keys.json')) as f:
+            self.index = {key: i for i, key in enumerate(json.load(f))}
+        self._embs = None
+
+    @property
+    def embs(self):
+        if self._embs is None:
+            self._embs = np.load(self.embs_path, mmap_mode='r')
+        return self._embs
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_embs'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, keys):
+        """Embeddings of a batch of sample keys, [len(keys), emb_dim]"""
+        missing = [key for key in keys if key not in self.index]
+        if missing:
+            raise KeyError(f"samples {missing[:5]} are not in the CLIP embedding cache {self.embs_path}")
+        rows = np.array([self.index[key] for key in keys])
+        order = np.argsort(rows)
+        # sorted reads are sequential in the memmap, then undo the sort
+        embs = np.empty((len(rows), self.embs.shape[1]), dtype=self.embs.dtype)
+        embs[order] = self.embs[rows[order]]
+        return torch.from_numpy(embs)
+
+
+def content_hash(sample):
+    """Hash of one image tensor (its dtype, shape and values) or text prompt"""
+    h = hashlib.blake2b(digest_size=16)
+    if isinstance(sample, str):
+        h.update(b'text:' + sample.encode())
+    else:
+        sample = sample.detach().contiguous().cpu()
+        h.update(f"{sample.dtype}{tuple(sample.shape)}:".encode())
+        h.update(sample.reshape(-1).view(torch.uint8).numpy().tobytes()) # bytes, numpy has no bf16
+    return h.hexdigest()
+
+def autocast_state(device_type):
+    """The autocast dtype active on device_type as a string, 'none' outside autocast"""
+    try:
+        enabled, dtype = torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)
+    except (TypeError, AttributeError): # torch < 2.4 has one function per device type
+        if device_type == 'cuda':
+            enabled, dtype = torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()
+        else:
+            enabled, dtype = torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype()
+    return str(dtype) if enabled else 'none'
+
+
+class EmbeddingLRU:
+    """
+    The max_entries most recently used embeddings, by key. With disk_dir, every embedding
+    put is also written to {disk_dir}/{key[:2]}/{key}.pt, and a miss in memory is looked up
+    there before it counts as a miss. The embeddings are kept on the device they were put
+    from, so hits cost no transfer.
+
+    The disk tier is bounded by max_disk_bytes: past it, the least recently used files
+    (by mtime, like shard_cache.ShardCache) are removed down to 90% of the budget, so the
+    directory is only walked once every so many puts.
+    """
+    def __init__(self, max_entries, disk_dir=None, max_disk_bytes=int(1e9)):
+        assert max_entries > 0, "max_entries must be positive"
+        self.max_entries = max_entries
+        self.disk_dir = os.path.expanduser(disk_dir) if disk_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.reset_stats()
+        self.disk_bytes = sum(size for _, size, _ in self._disk_files()) if self.disk_dir else 0
+
+    def _disk_files(self):
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith('.pt'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError: # evicted by another process
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def evict_disk(self, target_bytes):
+        """Remove the least recently used files of the disk tier until it fits in target_bytes"""
+        files = self._disk_files()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        self.disk_bytes = total
+
+    def reset_stats(self):
+        self.hits, self.disk_hits, self.misses = 0, 0, 0
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return dict(hits=self.hits, disk_hits=self.disk_hits, misses=self.misses, entries=len(self.entries),
+                    hit_rate=(self.hits + self.disk_hits) / lookups if lookups else 0.)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.pt")
+
+    def _insert(self, key, emb):
+        self.entries[key] = emb
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key, device=None):
+        """The embedding of key, or None"""
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.disk_dir is not None and os.path.exists(self._path(key)):
+            self.disk_hits += 1
+            emb = torch.load(self._path(key), map_location=device or 'cpu')
+            os.utime(self._path(key)) # mark as most recently used
+            self._insert(key, emb)
+            return emb
+        self.misses += 1
+        return None
+
+    def put(self, key, emb):
+        # clone so that a row doesn't keep the whole batch it is a view of alive
+        emb = emb.detach().clone()
+        self._insert(key, emb)
+        if self.disk_dir is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            torch.save(emb.cpu(), path + '.tmp')
+            os.replace(path + '.tmp', path)
+            self.disk_bytes += os.path.getsize(path)
+            if self.disk_bytes > self.max_disk_bytes:
+                self.evict_disk(int(0.9 * self.max_disk_bytes))
@@ -0,0 +1,65 @@
+"""
+Per-voxel and per-session mean / std of the voxel arrays over the train shards, in one
+streaming pass (see voxel_stats.py):
+
+$ python compute_voxel_stats.py --voxels_keys=nsdgeneral.npy,wholebrain_3d.npy
+
+Writes {stats_dir}/{voxels key}_stats.npz for each key, used by pack_voxels.py and
+quantize_voxels.py --quantize=... and by the loaders (--voxel_stats_dir=...).
+"""
+import os
+import json
+import webdataset as wds
+from tqdm import tqdm
+
+import utils
+import shards
+import voxel_stats
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    voxels_keys = 'nsdgeneral.npy,wholebrain_3d.npy' # comma separated
+    batch_size = 300
+    num_workers = 4
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    num_train_shards = 50 # train_subj01_{0..num_train_shards-1}.tar under shard_root
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    stats_dir = os.path.expanduser('~/data/neuro/voxel-stats')
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if remote_data:
+        train_url, _ = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+
+    keys = voxels_keys.split(',')
+    # only the train split, validation must not leak into the normalization
+    data = wds.WebDataset(train_url)\
+        .decode(only=keys + ["trial.npy"])\
+        .to_tuple(*keys, "trial.npy")\
+        .batched(batch_size, partial=True)
+    # webdataset fails when a worker has no shard to read
+    dl = wds.WebLoader(data, num_workers=min(num_workers, len(shards.expand_urls(train_url))), batch_size=None, shuffle=False)
+
+    accumulators = {key: voxel_stats.VoxelStatsAccumulator() for key in keys}
+    for batch in tqdm(dl, desc='train'):
+        trials = batch[-1]
+        for key, voxels in zip(keys, batch[:-1]):
+            accumulators[key].update(voxels, trials)
+
+    os.makedirs(stats_dir, exist_ok=True)
+    for key, acc in accumulators.items():
+        stats = acc.finalize()
+        path = voxel_stats.stats_path(stats_dir, key)
+        stats.save(path)
+        print(f"{key}: {stats.count} samples, {len(stats.session_ids)} sessions, "
+              f"mean std {stats.std.mean():.4f}, int8 step {stats.scale.mean():.4f} z -> {path}")
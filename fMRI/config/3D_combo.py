@@ -11,7 +11,11 @@ voxel2clip_kwargs = dict(
     dilation=[1, 1, 1, 1],
     kernel=[3, 3, 3, 3],
     average_output=False,
+    # grad_checkpointing=True, # recompute the transformer activations in backward, for longer sequences (smaller strides)
 )
+# crop to the brain, dims above are then replaced by the cropped ones (see make_brain_mask.py)
+# brain_mask_path = '~/data/neuro/brain_mask.npz'
+# mask_level = 0
 
 wandb_log = True
 # wandb_run_name = "3D-combo"
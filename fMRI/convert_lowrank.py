@@ -0,0 +1,71 @@
+"""
+Convert the voxel input projection of a trained checkpoint to a rank r models.LowRankLinear,
+initialized from the truncated SVD of the trained weight:
+
+$ python convert_lowrank.py --ckpt_path=~/data/neuro/models/voxel2clip/test/ckpt-best.pth --rank=256
+
+writes ckpt-best-rank256.pth next to it. Works on voxel2clip checkpoints (BrainNetwork's
+lin0.0, BrainNetworkLarge's conv.0) and on prior-w-voxel2clip ones (voxel2clip.lin0.0).
+Only the model weights are kept, the optimizer state doesn't fit the new shapes. Train on
+from it with voxel2clip_kwargs rank=256 and --init_ckpt=<the converted checkpoint>.
+
+The relative error of the approximation is printed per layer, as a guide to the rank.
+"""
+import os
+import json
+import torch
+
+from models import svd_factors
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    ckpt_path = ''
+    rank = 256
+    layers = 'lin0.0,conv.0' # comma separated names of the projections to factorize (matched as key suffixes)
+    out_path = '' # default: <ckpt_path>-rank<rank>.pth
+    device = 'cuda' if torch.cuda.is_available() else 'cpu' # for the svd
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    ckpt_path = os.path.expanduser(ckpt_path)
+    checkpoint = torch.load(ckpt_path, map_location='cpu')
+    state_dict = checkpoint.get('model_state_dict', checkpoint)
+
+    converted = {}
+    for key, value in state_dict.items():
+        name = key[:-len('.weight')]
+        if not (key.endswith('.weight') and value.ndim == 2 and any(name.endswith(l) for l in layers.split(','))):
+            converted[key] = value
+            continue
+        weight = value.to(device)
+        down, up = svd_factors(weight, rank)
+        error = (torch.linalg.norm(weight.float() - up.float() @ down.float()) / torch.linalg.norm(weight.float())).item()
+        print(f"{name}: {list(weight.shape)} -> rank {rank}, "
+              f"{weight.numel():,} -> {down.numel() + up.numel():,} weights, relative error {error:.4f}")
+        converted[f"{name}.down.weight"] = down.cpu()
+        converted[f"{name}.up.weight"] = up.cpu()
+        if f"{name}.bias" in state_dict:
+            converted[f"{name}.up.bias"] = state_dict[f"{name}.bias"]
+
+    # the biases of the factorized layers moved to up.bias
+    for key in list(converted):
+        if key.endswith('.bias') and f"{key[:-len('.bias')]}.up.weight" in converted:
+            del converted[key]
+
+    num_converted = sum(k.endswith('.down.weight') for k in converted) - sum(k.endswith('.down.weight') for k in state_dict)
+    assert num_converted > 0, f"no 2D weights matching {layers} in {ckpt_path}"
+
+    out_path = os.path.expanduser(out_path) if out_path else ckpt_path.replace('.pth', f'-rank{rank}.pth')
+    torch.save({
+        'epoch': checkpoint.get('epoch'),
+        'model_state_dict': converted,
+        'lowrank': dict(rank=rank, source=ckpt_path),
+        }, out_path)
+    print(f"converted {num_converted} layers, saved to {out_path}")
@@ -0,0 +1,194 @@
+"""
+Export voxel2clip and one denoiser step of the diffusion prior to TorchScript and ONNX,
+so that serving needs neither models.py nor the training stack (clip, dalle2_pytorch,
+diffusers) behind it:
+
+$ python export_models.py --ckpt_path=~/data/neuro/models/voxel2clip/test/ckpt-best.pth --models=voxel2clip
+$ python export_models.py config/3D_combo.py --ckpt_path=<ckpt of train_prior_w_voxel2clip.py> --models=voxel2clip,prior
+
+Pass the training config file first, it sets the voxel_dims and voxel2clip_kwargs (and
+brain_mask_path, sparse_conv, pretrained ...) the checkpoint was trained with. A
+train_voxel2clip.py checkpoint holds a BrainNetwork, a train_prior_w_voxel2clip.py one
+the prior with its voxel2clip and its DiffusionPriorNetwork (net).
+
+    {out_dir}/voxel2clip.pt|.onnx  voxels [batch, in_dim] or volumes [batch, x, y, z] -> [batch, 768],
+                                   the eval forward of inference.inference_module
+    {out_dir}/prior_net.pt|.onnx   (image_embed [batch, 768], timesteps [batch] int64,
+                                   text_embed [batch, 768]) -> [batch, 768], the network's
+                                   prediction at one diffusion step, with cond_scale baked in
+    {out_dir}/export.json          inputs, outputs and parity of every export
+
+The batch dimension is dynamic: the models are exported on a batch of the first of
+batch_sizes and checked against the eager model at all of them, TorchScript through
+torch.jit.load and ONNX through onnxruntime (skipped when it isn't installed). An export
+that differs by more than atol fails.
+"""
+import os
+import json
+import inspect
+import torch
+import torch.nn as nn
+from dalle2_pytorch import DiffusionPriorNetwork
+from dalle2_pytorch.train_configs import DiffusionPriorNetworkConfig
+
+import inference
+import brain_mask as brain_mask_lib
+from models import BrainNetwork
+from model3d import NewVoxel3dConvEncoder
+
+
+class PriorNetStep(nn.Module):
+    """One call of a DiffusionPriorNetwork on (image_embed, timesteps, text_embed), classifier free guidance included"""
+    def __init__(self, net, cond_scale=1.):
+        super().__init__()
+        assert not net.self_cond, "self conditioning priors aren't exported"
+        self.net = net
+        self.cond_scale = cond_scale
+
+    def forward(self, image_embed, diffusion_timesteps, text_embed):
+        # all zero text encodings are masked out for the null ones, like the empty default, but
+        # don't need the padding to max_text_len whose dynamic shape the ONNX export gets wrong
+        text_encodings = image_embed.new_zeros(image_embed.shape[0], self.net.max_text_len, image_embed.shape[1])
+        return self.net.forward_with_cond_scale(image_embed, diffusion_timesteps, text_embed=text_embed,
+                                                text_encodings=text_encodings, cond_scale=self.cond_scale)
+
+
+def sub_state_dict(state_dict, prefix):
+    return {k[len(prefix):]: v for k, v in state_dict.items() if k.startswith(prefix)}
+
+
+def export_onnx(model, inputs, path, input_names, opset):
+    kwargs = dict(input_names=input_names, output_names=['output'], opset_version=opset,
+                  dynamic_axes={name: {0: 'batch'} for name in input_names + ['output']})
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False # the TorchScript based exporter, the one with dynamic_axes
+    torch.onnx.export(model, tuple(inputs), path, **kwargs)
+
+
+def check_parity(name, model, exported, make_inputs, batch_sizes, atol):
+    """Max abs diff of each exported backend (a callable on the inputs) to model at each batch size"""
+    parity = {}
+    for backend, run in exported.items():
+        for bs in batch_sizes:
+            inputs = make_inputs(bs)
+            with torch.no_grad():
+                expected = model(*inputs).float()
+            diff = (torch.as_tensor(run(inputs)).float() - expected).abs().max().item()
+            print(f"{name} {backend} batch {bs}: max abs diff {diff:.2e}")
+            assert diff <= atol, f"{name} {backend} export differs from eager at batch {bs}: {diff:.2e} > {atol}"
+            parity[f"{backend}_bs{bs}"] = diff
+    return parity
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    ckpt_path = ''
+    models = 'voxel2clip' # comma separated ('voxel2clip', 'prior'), prior needs a train_prior_w_voxel2clip.py checkpoint
+    formats = 'torchscript,onnx' # comma separated
+    voxel_dims = 1 # (1, 3)
+    voxel2clip_kwargs = dict(out_dim=768) # set by the training config file
+    brain_mask_path = '' # as in train_prior_w_voxel2clip.py
+    mask_level = 0
+    sparse_conv = False
+    pretrained = True # the prior network has the config of the pretrained one (prior_config_path), else the dims below
+    prior_config_path = 'checkpoints/prior_config.json'
+    dim = 768
+    depth = 6
+    dim_head = 64
+    heads = 12
+    cond_scale = 1. # classifier free guidance scale of the exported denoiser step
+    opset = 14
+    batch_sizes = (2, 5) # the export runs on the first (a single one is written --batch_sizes=2, with the trailing comma)
+    atol = 1e-4
+    out_dir = '' # default: export/ next to ckpt_path
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str, tuple))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    try:
+        import onnxruntime
+    except ImportError:
+        onnxruntime = None
+        print("onnxruntime isn't installed, the ONNX exports won't be checked")
+
+    ckpt_path = os.path.expanduser(ckpt_path)
+    out_dir = os.path.expanduser(out_dir) if out_dir else os.path.join(os.path.dirname(ckpt_path), 'export')
+    os.makedirs(out_dir, exist_ok=True)
+    formats = formats.split(',')
+
+    state_dict = torch.load(ckpt_path, map_location='cpu')
+    state_dict = state_dict.get('model_state_dict', state_dict)
+    is_prior_ckpt = any(k.startswith('voxel2clip.') for k in state_dict)
+
+    exports = {}
+    if 'voxel2clip' in models.split(','):
+        if voxel_dims == 1:
+            voxel2clip = BrainNetwork(**voxel2clip_kwargs)
+            in_shape = [voxel2clip_kwargs.get('in_dim', 15724)]
+        else:
+            if brain_mask_path:
+                brain_mask = brain_mask_lib.load_mask(os.path.expanduser(brain_mask_path))
+                voxel2clip_kwargs['dims'] = brain_mask.dims(mask_level)
+                if sparse_conv:
+                    voxel2clip_kwargs['mask'] = brain_mask.level_mask(mask_level)
+            voxel2clip = NewVoxel3dConvEncoder(**voxel2clip_kwargs)
+            in_shape = list(voxel2clip_kwargs['dims'])
+        voxel2clip.load_state_dict(sub_state_dict(state_dict, 'voxel2clip.') if is_prior_ckpt else state_dict)
+        voxel2clip.eval()
+        exports['voxel2clip'] = (voxel2clip, inference.inference_module(voxel2clip), ['voxels'],
+                                 lambda bs, in_shape=in_shape: [torch.randn(bs, *in_shape)])
+
+    if 'prior' in models.split(','):
+        assert is_prior_ckpt, f"{ckpt_path} has no prior, export it from a train_prior_w_voxel2clip.py checkpoint"
+        if pretrained:
+            with open(prior_config_path) as f:
+                net_config = json.load(f)['prior']['net']
+            net_config['max_text_len'] = 256 # as in BrainDiffusionPrior.from_pretrained
+            net = DiffusionPriorNetworkConfig(**net_config).create()
+        else:
+            net = DiffusionPriorNetwork(dim=dim, depth=depth, dim_head=dim_head, heads=heads)
+        net.load_state_dict(sub_state_dict(state_dict, 'net.'))
+        step = PriorNetStep(net, cond_scale).eval()
+        embed_dim = net.dim
+        num_timesteps = net.to_time_embeds[0].num_embeddings if isinstance(net.to_time_embeds[0], nn.Embedding) else 1000
+        exports['prior_net'] = (step, step, ['image_embed', 'timesteps', 'text_embed'],
+                                lambda bs: [torch.randn(bs, embed_dim), torch.randint(0, num_timesteps, (bs,)),
+                                            torch.randn(bs, embed_dim)])
+
+    report = dict(config=config, exports={})
+    for name, (model, module, input_names, make_inputs) in exports.items():
+        inputs = make_inputs(batch_sizes[0])
+        exported = {}
+        record = dict(inputs={n: ['batch'] + list(x.shape[1:]) for n, x in zip(input_names, inputs)},
+                      input_dtypes={n: str(x.dtype) for n, x in zip(input_names, inputs)})
+        if 'torchscript' in formats:
+            path = os.path.join(out_dir, f"{name}.pt")
+            with torch.no_grad():
+                # the prior's cached rotary / position tensors trip trace's own check, parity is checked below
+                traced = torch.jit.trace(module, tuple(inputs), check_trace=False)
+                torch.jit.save(torch.jit.freeze(traced), path)
+            loaded = torch.jit.load(path)
+            exported['torchscript'] = lambda inputs, loaded=loaded: loaded(*inputs)
+            record['torchscript'] = path
+        if 'onnx' in formats:
+            path = os.path.join(out_dir, f"{name}.onnx")
+            with torch.no_grad():
+                export_onnx(module, inputs, path, input_names, opset)
+            record['onnx'] = path
+            if onnxruntime is not None:
+                session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+                exported['onnx'] = lambda inputs, session=session, input_names=input_names: session.run(
+                    None, {n: x.numpy() for n, x in zip(input_names, inputs)})[0]
+        print(f"exported {name} to {[record[f] for f in formats]}")
+        record['max_abs_diff'] = check_parity(name, model, exported, make_inputs, batch_sizes, atol)
+        report['exports'][name] = record
+
+    with open(os.path.join(out_dir, 'export.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {os.path.join(out_dir, 'export.json')}")
@@ -0,0 +1,324 @@
+"""
+Inference-time transformations of the voxel2clip networks (models.BrainNetwork,
+models.BrainNetworkLarge), for serving their forward only:
+
+    fold_batchnorms(model)    eval copy with the BatchNorms folded into adjacent linears / convs
+    optimize_for_inference(model, example_inputs)
+                              frozen TorchScript of the eval forward, BatchNorms folded,
+                              dropout dropped and residual adds fused, checked against
+                              the eager model (also for model3d.NewVoxel3dConvEncoder)
+    quantize_dynamic(model)   int8 linear weights, activations quantized on the fly per batch
+    quantize_static(model, calibration_batches)
+                              int8 linear weights and activations, the activation ranges
+                              calibrated on a few hundred voxels
+
+The quantized models run on the cpu, with the fbgemm (x86) or qnnpack (arm) kernels.
+quantize_voxel2clip.py converts a checkpoint and reports latency, size and agreement
+with the fp32 model.
+"""
+import io
+import copy
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.nn.intrinsic as nni
+import torch.ao.quantization as quant
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from models import BrainNetwork, BrainNetworkLarge, LowRankLinear, RoiBlockLinear
+
+# identities in eval mode, a BatchNorm folds across them
+PASSTHROUGH = (nn.modules.dropout._DropoutNd, nn.Identity)
+
+
+class Shift(nn.Module):
+    """x + shift, what is left of a BatchNorm whose scale went into the linear before it"""
+    def __init__(self, shift):
+        super().__init__()
+        self.register_buffer('shift', shift.detach().clone())
+
+    def forward(self, x):
+        return x + self.shift
+
+
+class Scale(nn.Module):
+    """x * scale, per channel"""
+    def __init__(self, scale):
+        super().__init__()
+        self.register_buffer('scale', scale.detach().clone())
+
+    def forward(self, x):
+        return x * self.scale
+
+
+class ResidualBlock(nn.Module):
+    """x + body(x) * scale as one op (torch.addcmul), x + body(x) without a scale"""
+    def __init__(self, body, scale=None):
+        super().__init__()
+        self.body = body
+        self.register_buffer('scale', None if scale is None else scale.detach().clone())
+
+    def forward(self, x):
+        if self.scale is None:
+            return x + self.body(x)
+        return torch.addcmul(x, self.body(x), self.scale)
+
+
+class ResidualMLP(nn.Module):
+    """The eval forward of BrainNetwork / BrainNetworkLarge as rebuilt by residual_mlp"""
+    def __init__(self, stem, blocks, head):
+        super().__init__()
+        self.stem = stem
+        self.blocks = nn.Sequential(*blocks)
+        self.head = head
+
+    def forward(self, x):
+        return self.head(self.blocks(self.stem(x)))
+
+
+def bn_affine(bn):
+    """An eval BatchNorm1d as the per-channel affine x * scale + shift"""
+    weight = bn.weight if bn.affine else torch.ones_like(bn.running_var)
+    bias = bn.bias if bn.affine else torch.zeros_like(bn.running_var)
+    scale = weight / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bias - bn.running_mean * scale
+
+
+def scale_outputs(layer, scale, shift):
+    """Fold layer(x) * scale + shift into layer, an nn.Linear, LowRankLinear or RoiBlockLinear"""
+    if isinstance(layer, LowRankLinear):
+        layer = layer.up
+    if isinstance(layer, nn.Linear):
+        layer.weight.mul_(scale[:, None])
+    elif isinstance(layer, RoiBlockLinear):
+        padded = F.pad(scale, (0, layer.num_rois * layer.block_features - layer.out_features))
+        layer.weight.mul_(padded.view(layer.num_rois, 1, layer.block_features))
+    else:
+        raise TypeError(f"can't fold into a {type(layer).__name__}")
+    if layer.bias is None:
+        layer.bias = nn.Parameter(torch.zeros_like(shift))
+    layer.bias.mul_(scale).add_(shift)
+
+
+def scale_inputs(linear, scale, shift):
+    """Fold linear(x * scale + shift) into linear"""
+    if linear.bias is None:
+        linear.bias = nn.Parameter(linear.weight.new_zeros(linear.out_features))
+    linear.bias.add_(linear.weight @ shift)
+    linear.weight.mul_(scale[None, :])
+
+
+def is_linear(module):
+    return isinstance(module, (nn.Linear, LowRankLinear, RoiBlockLinear))
+
+
+def neighbour(seq, i, step):
+    """Index of the first module of seq before (step=-1) or after (step=1) i that isn't a passthrough"""
+    i += step
+    while 0 <= i < len(seq) and isinstance(seq[i], PASSTHROUGH):
+        i += step
+    return i if 0 <= i < len(seq) else None
+
+
+def fold_batchnorms(model):
+    """
+    An eval copy of model with each BatchNorm of its nn.Sequentials folded into a linear
+    or conv where that is exact: into the preceding layer if only dropout lies between
+    them, else into the following linear, else into the linear before a ReLU when none of
+    the BatchNorm's scales is negative (relu(x) * s == relu(x * s) for s >= 0), leaving its
+    shift as a Shift. BatchNorms after a GELU that feed a residual add stay. Folded
+    BatchNorms become nn.Identity, so the Sequentials keep their length. Returns the copy
+    and the number of BatchNorms folded.
+    """
+    model = copy.deepcopy(model).eval()
+    folded = 0
+    with torch.no_grad():
+        for seq in [m for m in model.modules() if isinstance(m, nn.Sequential)]:
+            for i in range(len(seq)):
+                if not isinstance(seq[i], nn.modules.batchnorm._BatchNorm):
+                    continue
+                before, after = neighbour(seq, i, -1), neighbour(seq, i, 1)
+                if before is not None and isinstance(seq[before], nn.modules.conv._ConvNd):
+                    seq[before] = fuse_conv_bn_eval(seq[before], seq[i])
+                    seq[i] = nn.Identity()
+                    folded += 1
+                    continue
+                if not isinstance(seq[i], nn.BatchNorm1d):
+                    continue
+                scale, shift = bn_affine(seq[i])
+                if before is not None and is_linear(seq[before]):
+                    scale_outputs(seq[before], scale, shift)
+                    seq[i] = nn.Identity()
+                elif after is not None and isinstance(seq[after], nn.Linear):
+                    scale_inputs(seq[after], scale, shift)
+                    seq[i] = nn.Identity()
+                elif (before is not None and isinstance(seq[before], nn.ReLU) and (scale >= 0).all()
+                      and neighbour(seq, before, -1) is not None and is_linear(seq[neighbour(seq, before, -1)])):
+                    scale_outputs(seq[neighbour(seq, before, -1)], scale, torch.zeros_like(shift))
+                    seq[i] = Shift(shift)
+                else:
+                    continue
+                folded += 1
+    return model, folded
+
+
+def drop_dropout(model):
+    """Replace model's dropout modules with nn.Identity, in place"""
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.modules.dropout._DropoutNd):
+                setattr(module, name, nn.Identity())
+    return model
+
+
+def split_affine(seq):
+    """
+    The modules of an eval nn.Sequential without its passthroughs, and the scale and
+    shift of a trailing BatchNorm1d or Shift (None where there is none)
+    """
+    modules = [m for m in seq if not isinstance(m, PASSTHROUGH)]
+    scale, shift = None, None
+    if modules and isinstance(modules[-1], nn.BatchNorm1d):
+        scale, shift = bn_affine(modules.pop())
+    elif modules and isinstance(modules[-1], Shift):
+        shift = modules.pop().shift
+    return modules, scale, shift
+
+
+def residual_mlp(model):
+    """
+    BrainNetwork / BrainNetworkLarge as an eval ResidualMLP with no BatchNorm, dropout or
+    separate residual add left. On top of fold_batchnorms, the BatchNorms that end the
+    residual blocks go too: their shifts add up along the residual stream to a constant
+    offset, which goes into the biases of the linears that read the stream, and their
+    scales into the residual adds (torch.addcmul).
+    """
+    model, _ = fold_batchnorms(model)
+    if isinstance(model, BrainNetwork):
+        stem, blocks, head = model.lin0, model.mlp, model.lin1
+    elif isinstance(model, BrainNetworkLarge):
+        stem, blocks, head = model.conv, model.lins, model.lin1
+    else:
+        raise TypeError(f"expected a BrainNetwork or BrainNetworkLarge, got {type(model).__name__}")
+
+    with torch.no_grad():
+        modules, scale, offset = split_affine(stem)
+        if scale is not None:
+            modules.append(Scale(scale))
+        stem = nn.Sequential(*modules)
+        if offset is None:
+            offset = head.weight.new_zeros(head.in_features)
+        residual_blocks = []
+        for block in blocks:
+            modules, scale, shift = split_affine(block)
+            # the block reads the stream without its offset
+            scale_inputs(modules[0], torch.ones_like(offset), offset)
+            residual_blocks.append(ResidualBlock(nn.Sequential(*modules), scale))
+            if shift is not None:
+                offset = offset + shift
+        scale_inputs(head, torch.ones_like(offset), offset)
+    return ResidualMLP(stem, residual_blocks, head).eval()
+
+
+def inference_module(model):
+    """
+    An eager eval copy of a voxel2clip encoder with its BatchNorms folded and no dropout:
+    residual_mlp for BrainNetwork / BrainNetworkLarge, convs and BatchNorms folded for
+    model3d.NewVoxel3dConvEncoder
+    """
+    if isinstance(model, (BrainNetwork, BrainNetworkLarge)):
+        return residual_mlp(model)
+    return drop_dropout(fold_batchnorms(model)[0])
+
+
+def optimize_for_inference(model, example_inputs, rtol=1e-4, atol=1e-5):
+    """
+    Frozen TorchScript of the eval forward of a voxel2clip encoder (see inference_module).
+    It is traced on example_inputs and frozen with torch.jit.freeze, which makes the
+    weights constants and lets the fuser merge the activations with the residual adds.
+    Its outputs on example_inputs are checked against the eager model's.
+    """
+    was_training = model.training
+    model.eval()
+    optimized = inference_module(model)
+    with torch.no_grad():
+        frozen = torch.jit.freeze(torch.jit.trace(optimized, example_inputs))
+        expected = model(example_inputs)
+        # the profiling executor optimizes the graph over the first calls
+        for _ in range(3):
+            actual = frozen(example_inputs)
+    model.train(was_training)
+    diff = (actual.float() - expected.float()).abs().max().item()
+    assert torch.allclose(actual.float(), expected.float(), rtol=rtol, atol=atol), \
+        f"optimized {type(model).__name__} differs from the eager one, max abs diff {diff:.2e}"
+    print(f"optimized {type(model).__name__}, max abs diff to eager {diff:.2e}")
+    return frozen
+
+
+def quantize_dynamic(model, backend='fbgemm'):
+    """int8 copy of model's nn.Linears (LowRankLinear's included), activations quantized per batch"""
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    return quant.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+def wrap_linears(module, qconfig):
+    """
+    Each nn.Linear of module, fused with a ReLU right after it in an nn.Sequential, between
+    its own quant / dequant stubs, in place
+    """
+    children = list(module.named_children())
+    for i, (name, child) in enumerate(children):
+        if isinstance(child, nn.Linear):
+            follows = children[i + 1][1] if isinstance(module, nn.Sequential) and i + 1 < len(children) else None
+            if isinstance(follows, nn.ReLU):
+                child = nni.LinearReLU(child, follows)
+                setattr(module, children[i + 1][0], nn.Identity())
+            wrapped = quant.QuantWrapper(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            wrap_linears(child, qconfig)
+
+
+def quantize_static(model, calibration_batches, backend='fbgemm'):
+    """
+    int8 copy of model's nn.Linears with int8 activations, their ranges observed on
+    calibration_batches (voxel batches). Each linear runs quantized between its own quant /
+    dequant stubs, the residual adds, GELUs, RoiBlockLinears and unfolded BatchNorms stay
+    in fp32. Fold the BatchNorms first, so that the ReLUs fuse into the linears.
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    wrap_linears(model, quant.get_default_qconfig(backend))
+    quant.prepare(model, inplace=True)
+    with torch.no_grad():
+        for voxels in calibration_batches:
+            model(voxels.cpu().float())
+    return quant.convert(model, inplace=True)
+
+
+def model_size_mb(model):
+    """Size of the serialized state dict (packed int8 weights included), or of a whole TorchScript module"""
+    buf = io.BytesIO()
+    if isinstance(model, torch.jit.ScriptModule):
+        torch.jit.save(model, buf) # frozen modules keep their weights as constants, not in the state dict
+    else:
+        torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+
+@torch.no_grad()
+def measure_latency(model, inputs, steps=20, warmup=5):
+    """Mean forward time of model on inputs in ms"""
+    for _ in range(warmup):
+        model(inputs)
+    if inputs.device.type == 'cuda':
+        torch.cuda.synchronize(inputs.device)
+    t0 = time.time()
+    for _ in range(steps):
+        model(inputs)
+    if inputs.device.type == 'cuda':
+        torch.cuda.synchronize(inputs.device)
+    return (time.time() - t0) / steps * 1000
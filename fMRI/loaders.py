@@ -0,0 +1,317 @@
+"""
+Wrappers around the (Web)DataLoaders returned by utils.get_dataloaders.
+
+get_loader_state / set_loader_state save and restore the position of a (wrapped) training
+loader, see shards.EpochLoader.state_dict.
+"""
+import os
+import time
+import queue
+import random
+import shutil
+import threading
+import itertools
+import numpy as np
+import torch
+
+
+def get_loader_state(loader):
+    """Position of a loader from utils.get_dataloaders, possibly wrapped, or None if it can't resume"""
+    if hasattr(loader, 'state_dict'):
+        return loader.state_dict()
+    return None
+
+def set_loader_state(loader, state):
+    if hasattr(loader, 'load_state_dict'):
+        loader.load_state_dict(state)
+    else:
+        raise ValueError(f"{type(loader).__name__} can't be resumed")
+
+
+class CachedLoader:
+    """
+    Records the decoded batches of the first complete pass over a loader and serves
+    every later epoch from them, so that pass is the only one paying for I/O and decoding.
+
+    Batches are kept in RAM up to max_bytes. Past that they are spilled to .npy files in
+    spill_dir and memory-mapped back, or, without a spill_dir, caching is given up and
+    the wrapped loader is used every epoch. A pass that is cut short (e.g. peeking at the
+    first batch) is not recorded.
+
+    Meant for validation, whose batches are the same every epoch. For training, pass
+    shuffle=True to replay the first epoch's batches in a new order each epoch (batch
+    composition then repeats across epochs).
+    """
+    def __init__(self, loader, max_bytes, spill_dir=None, shuffle=False, seed=0, name='loader'):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.shuffle = shuffle
+        self.rng = random.Random(seed)
+        self.name = name
+        self.batches = None
+        self.disabled = max_bytes <= 0 and spill_dir is None
+        self.skip_recording = False
+
+    def __len__(self):
+        if self.batches is not None:
+            return len(self.batches)
+        return len(self.loader)
+
+    def state_dict(self):
+        # replayed epochs don't move the wrapped loader, so a resume picks up from its position
+        return get_loader_state(self.loader)
+
+    def load_state_dict(self, state):
+        set_loader_state(self.loader, state)
+        # the resumed epoch is only part of one, record the next complete one instead
+        self.skip_recording = state['batch'] > 0
+
+    def _spill(self, i, j, x):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        path = os.path.join(self.spill_dir, f'{self.name}-{i:05d}-{j}.npy')
+        np.save(path, x.numpy())
+        return path
+
+    def _load(self, item):
+        if isinstance(item, str) and item.endswith('.npy'):
+            return torch.from_numpy(np.load(item, mmap_mode='r'))
+        return item
+
+    def _record(self):
+        batches, nbytes = [], 0
+        recording = True
+        for i, batch in enumerate(self.loader):
+            if recording:
+                stored = []
+                for j, x in enumerate(batch):
+                    if isinstance(x, torch.Tensor):
+                        size = x.numel() * x.element_size()
+                        if nbytes + size > self.max_bytes and self.spill_dir is not None:
+                            x = self._spill(i, j, x.cpu())
+                        elif nbytes + size > self.max_bytes:
+                            print(f"{self.name} cache: batches don't fit in {self.max_bytes / 1e9:.2f} GB, not caching")
+                            recording = False
+                            batches = []
+                            break
+                        else:
+                            x = x.cpu()
+                            nbytes += size
+                    stored.append(x)
+                if recording:
+                    batches.append(type(batch)(stored) if isinstance(batch, tuple) else stored)
+            yield batch
+        # only reached if the consumer didn't stop early
+        if recording:
+            print(f"{self.name} cache: {len(batches)} batches, {nbytes / 1e9:.2f} GB in RAM")
+            self.batches = batches
+        else:
+            self.disabled = True
+            if self.spill_dir is not None:
+                shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+    def __iter__(self):
+        if self.disabled or self.skip_recording:
+            self.skip_recording = False
+            yield from self.loader
+        elif self.batches is None:
+            yield from self._record()
+        else:
+            order = list(range(len(self.batches)))
+            if self.shuffle:
+                self.rng.shuffle(order)
+            for i in order:
+                yield type(self.batches[i])(self._load(x) for x in self.batches[i])
+
+
+def to_device_dtype(x):
+    """Default DevicePrefetcher conversion: uint8 images to [0, 1] floats, other floats to fp32"""
+    if x.dtype == torch.uint8:
+        return x.float() / 255
+    if x.is_floating_point():
+        return x.float()
+    return x
+
+
+class DevicePrefetcher:
+    """
+    Moves the batches of a loader to device ahead of time, so the copy (and the dtype
+    conversion, done on the device) overlaps with the current training step.
+
+    A background thread pulls batches from the loader and copies their tensors into
+    num_buffers sets of reused pinned buffers. On CUDA the host-to-device copy and the
+    conversion run on a side stream, and the consuming stream waits on them only when the
+    batch is handed out. Without CUDA the thread does the conversion instead.
+
+    wait_time is the time the last epoch spent blocked on the next batch, and
+    wait_fraction() that time relative to the whole epoch.
+    """
+    def __init__(self, loader, device, convert=to_device_dtype, num_buffers=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.convert = convert
+        self.num_buffers = num_buffers
+        self.cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.buffers = [dict() for _ in range(num_buffers)]
+        self.events = [None] * num_buffers
+        self.wait_time, self.epoch_time, self.num_batches = 0., 0., 0
+        # batches taken from the loader, under the lock so they match the loader's own position
+        self.pulled = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.loader)
+
+    def wait_fraction(self):
+        return self.wait_time / max(self.epoch_time, 1e-9)
+
+    def state_dict(self):
+        with self.lock:
+            state = get_loader_state(self.loader)
+            in_flight = self.pulled - self.num_batches
+        if state is not None:
+            # the wrapped loader is ahead by the batches staged but not handed out yet
+            state['batch'] -= in_flight
+        return state
+
+    def load_state_dict(self, state):
+        set_loader_state(self.loader, state)
+
+    def _pin(self, slot, j, x):
+        buf = self.buffers[slot].get(j)
+        if buf is None or buf.shape != x.shape or buf.dtype != x.dtype:
+            buf = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+            self.buffers[slot][j] = buf
+        buf.copy_(x)
+        return buf
+
+    def _stage(self, slot, batch):
+        if not self.cuda:
+            return [self.convert(x.to(self.device)) if isinstance(x, torch.Tensor) else x for x in batch], None
+        if self.events[slot] is not None:
+            # the previous copy out of these pinned buffers has to finish before they are reused
+            self.events[slot].synchronize()
+        out = []
+        with torch.cuda.stream(self.stream):
+            for j, x in enumerate(batch):
+                if isinstance(x, torch.Tensor):
+                    x = self._pin(slot, j, x) if not x.is_pinned() else x
+                    x = self.convert(x.to(self.device, non_blocking=True))
+                out.append(x)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        self.events[slot] = event
+        return out, event
+
+    def _produce(self, q, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        try:
+            if self.cuda:
+                torch.cuda.set_device(self.device)
+            it = iter(self.loader)
+            for i in itertools.count():
+                with self.lock:
+                    batch = next(it, None)
+                    if batch is None:
+                        break
+                    self.pulled += 1
+                staged = self._stage(i % self.num_buffers, batch)
+                if not put((type(batch), staged)):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        # bounds how far ahead the thread runs, the pinned buffers themselves are guarded by the events
+        q = queue.Queue(maxsize=self.num_buffers)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(q, stop), daemon=True)
+        self.wait_time, self.num_batches, self.pulled = 0., 0, 0
+        t_start = time.time()
+        thread.start()
+        try:
+            while True:
+                t0 = time.time()
+                item = q.get()
+                self.wait_time += time.time() - t0
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                batch_type, (batch, event) = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    for x in batch:
+                        if isinstance(x, torch.Tensor):
+                            # memory allocated on the side stream is now used on this one
+                            x.record_stream(current)
+                self.num_batches += 1
+                yield batch_type(batch) if batch_type is tuple else batch
+        finally:
+            stop.set()
+            thread.join()
+            self.epoch_time = time.time() - t_start
+
+
+class SubjectMixLoader:
+    """
+    Interleaves the batches of one loader per subject. Each batch comes from a single
+    subject and gets a third item, a long tensor with the subject id of each sample.
+
+    For training, the subject of the next batch is drawn with probability proportional
+    to its weight (by default its number of batches), with the same seed on every rank
+    so DDP ranks always step on the same subject. A subject's loader that runs out
+    starts its next epoch, and the iterators are kept between epochs, so every loader
+    keeps its workers busy all the time. An epoch is the sum of the subjects' batches.
+
+    With sequential=True (validation) each loader is read once, one after the other.
+    """
+    def __init__(self, loaders, subjects, weights=None, sequential=False, seed=0):
+        assert len(loaders) == len(subjects), "need one loader per subject"
+        self.loaders = loaders
+        self.subjects = list(subjects)
+        self.sizes = [len(dl) for dl in loaders]
+        self.weights = list(weights) if weights is not None else self.sizes
+        assert len(self.weights) == len(self.subjects), "need one weight per subject"
+        self.sequential = sequential
+        self.seed = seed
+        self.epoch = 0
+        self.iters = [None] * len(loaders)
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def _with_subject(self, batch, subject):
+        return (*batch, torch.full((len(batch[0]),), subject, dtype=torch.long))
+
+    def _next(self, i):
+        for _ in range(2):
+            if self.iters[i] is None:
+                self.iters[i] = iter(self.loaders[i])
+            try:
+                return next(self.iters[i])
+            except StopIteration:
+                self.iters[i] = None
+        raise RuntimeError(f"loader of subject {self.subjects[i]} has no batches")
+
+    def __iter__(self):
+        if self.sequential:
+            for dl, subject in zip(self.loaders, self.subjects):
+                for batch in dl:
+                    yield self._with_subject(batch, subject)
+            return
+        rng = random.Random(self.seed + self.epoch)
+        self.epoch += 1
+        order = rng.choices(range(len(self.loaders)), weights=self.weights, k=len(self))
+        for i in order:
+            yield self._with_subject(self._next(i), self.subjects[i])
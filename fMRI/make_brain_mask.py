@@ -0,0 +1,92 @@
+"""
+Compute the union brain mask and its bounding box over the wholebrain_3d volumes of the
+train and val shards (see brain_mask.py):
+
+$ python make_brain_mask.py --mask_path=~/data/neuro/brain_mask.npz
+
+Then pack a compact store with pack_voxels.py --voxels_key=wholebrain_3d.npy --mask_path=...
+and/or train with --brain_mask_path=...
+
+At the end the first val batch is read back through utils.get_dataloaders with the mask
+(the tar path of training) and compared against the raw volumes.
+"""
+import os
+import json
+import numpy as np
+import torch
+import webdataset as wds
+from tqdm import tqdm
+
+import utils
+import shards
+import brain_mask
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    voxels_key = 'wholebrain_3d.npy'
+    threshold = 0. # voxels whose absolute value never exceeds this are outside the mask
+    pad = 0 # extra voxels around the bounding box
+    batch_size = 300
+    num_workers = 4
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    num_train_shards = 50 # train_subj01_{0..num_train_shards-1}.tar under shard_root
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    mask_path = os.path.expanduser('~/data/neuro/brain_mask.npz')
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if remote_data:
+        train_url, val_url = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    def volume_batches():
+        for split, url in (('train', train_url), ('val', val_url)):
+            data = wds.WebDataset(url)\
+                .decode(only=[voxels_key])\
+                .to_tuple(voxels_key)\
+                .batched(batch_size, partial=True)
+            # webdataset fails when a worker has no shard to read, e.g. on the one val shard
+            dl = wds.WebLoader(data, num_workers=min(num_workers, len(shards.expand_urls(url))), batch_size=None, shuffle=False)
+            for (voxels,) in tqdm(dl, desc=split):
+                yield voxels
+
+    mask = brain_mask.union_mask(volume_batches(), threshold)
+    bbox = brain_mask.get_bbox(mask, pad)
+    mask_path = os.path.expanduser(mask_path)
+    os.makedirs(os.path.dirname(mask_path) or '.', exist_ok=True)
+    brain_mask.save_mask(mask_path, mask, bbox)
+
+    bm = brain_mask.load_mask(mask_path)
+    print(bm)
+    print("bbox", bbox.tolist())
+    for level in range(3):
+        print(f"level {level} dims {bm.dims(level)}")
+    print(f"saved to {mask_path}")
+
+    # check the training loaders' tar path through the mask on the first val batch, it must
+    # crop the raw volumes without losing any of their in-mask voxels
+    _, val_dl = utils.get_dataloaders(batch_size, "trial", num_workers=0, train_url=train_url, val_url=val_url,
+                                      voxels_key=voxels_key, brain_mask=bm, val_cache_bytes=0)
+    volumes, trials = next(iter(val_dl))
+    raw, raw_trials = next(iter(wds.WebDataset(val_url, shardshuffle=False)
+                                .decode(only=[voxels_key, "trial.npy"])
+                                .to_tuple(voxels_key, "trial.npy")
+                                .batched(len(volumes))))
+    assert np.array_equal(np.asarray(trials).reshape(-1), np.asarray(raw_trials).reshape(-1)), \
+        "the val loader and the raw shards are out of order"
+    assert list(volumes.shape[1:]) == bm.dims(0), f"loader volumes {list(volumes.shape[1:])}, mask crop {bm.dims(0)}"
+    raw = torch.as_tensor(np.asarray(raw))
+    diff = (volumes - bm.crop(raw)).abs().max().item()
+    lost = (raw.abs() > threshold).sum().item() - (volumes.abs() > threshold).sum().item()
+    print(f"tar loader check: max abs diff to the cropped raw volumes {diff:.2e}, {lost} voxels lost")
+    assert diff == 0 and lost == 0, "the tar loader's masked volumes don't match the raw ones"
@@ -0,0 +1,91 @@
+"""
+Write synthetic webdataset shards with the layout of the NSD shards, to exercise and
+benchmark the loaders without the /scratch or Hugging Face data:
+
+$ python make_synthetic_shards.py --out_root=/tmp/nsd-synthetic --num_train=2000
+
+    {out_root}/train/train_subj01_{0..n}.tar
+    {out_root}/val/val_subj01_{0..n}.tar
+    {out_root}/metadata.json    split totals and per-shard counts, see shards.get_shard_counts
+
+Each sample has a jpg, nsdgeneral.npy (float32 voxels, as many as the subject's real
+nsdgeneral ROI), wholebrain_3d.npy (float32 volume, zero outside an ellipsoid "brain")
+and trial.npy. --subjects=1,2,5,7 writes shards for several subjects. Then point the
+training scripts or bench_loader.py at it with --shard_root=<out_root>.
+"""
+import os
+import io
+import json
+import numpy as np
+import webdataset as wds
+from PIL import Image
+from tqdm import tqdm
+
+import utils
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_root = '/tmp/nsd-synthetic'
+    num_train = 1000
+    num_val = 100
+    samples_per_shard = 100
+    image_size = 256
+    jpeg_quality = 90
+    subjects = (1,)
+    num_voxels = 0 # nsdgeneral voxels, 0 for each subject's real count
+    volume_dims = (83, 104, 81) # wholebrain_3d
+    with_volumes = True # the volumes are most of the bytes, leave them out to only test the 1D path
+    seed = 0
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str, tuple))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    rng = np.random.default_rng(seed)
+    dims = list(volume_dims)
+    # ellipsoid filling most of the volume, like the brain in wholebrain_3d
+    grid = np.meshgrid(*[np.linspace(-1, 1, d) for d in dims], indexing='ij')
+    brain = sum(g**2 for g in grid) < 0.8
+
+    def make_image():
+        # smooth random image, so the jpgs compress (and decode) like photos rather than noise
+        small = rng.integers(0, 256, size=(image_size // 16, image_size // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((image_size, image_size), Image.BICUBIC)
+        buf = io.BytesIO()
+        image.save(buf, format='JPEG', quality=jpeg_quality)
+        return buf.getvalue()
+
+    metadata = dict(totals={}, shard_counts={})
+    for subj in subjects:
+        n_voxels = num_voxels or utils.NSDGENERAL_VOXELS[subj]
+        subject_totals = metadata['totals'] if subj == 1 else metadata['totals'].setdefault(f'subj{subj:02d}', {})
+        trial = 0
+        for split, num_samples in (('train', num_train), ('val', num_val)):
+            os.makedirs(os.path.join(out_root, split), exist_ok=True)
+            num_shards = -(-num_samples // samples_per_shard)
+            for shard in tqdm(range(num_shards), desc=f"subj{subj:02d} {split}"):
+                name = f"{split}_subj{subj:02d}_{shard}.tar"
+                count = min(samples_per_shard, num_samples - shard * samples_per_shard)
+                with wds.TarWriter(os.path.join(out_root, split, name)) as sink:
+                    for _ in range(count):
+                        sample = {
+                            '__key__': f"subj{subj:02d}_sample{trial:09d}",
+                            'jpg': make_image(),
+                            'nsdgeneral.npy': rng.standard_normal(n_voxels, dtype=np.float32),
+                            'trial.npy': np.array(trial),
+                        }
+                        if with_volumes:
+                            sample['wholebrain_3d.npy'] = rng.standard_normal(dims, dtype=np.float32) * brain
+                        sink.write(sample)
+                        trial += 1
+                metadata['shard_counts'][name] = count
+            subject_totals[split] = num_samples
+
+    with open(os.path.join(out_root, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    print(f"wrote {num_train} train and {num_val} val samples of subjects {list(subjects)} to {out_root}")
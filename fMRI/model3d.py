@@ -1,7 +1,11 @@
 """
 Conv3D model extracted from @aidan's OpenCLIP fork by @Atom_101.
+
+With a mask of the brain voxels, NewVoxel3dConvEncoder can run its conv blocks sparsely,
+only at the sites inside the mask (see sparse_conv_plan), instead of over the whole volume.
 """
 from collections import OrderedDict
+import itertools
 from dataclasses import dataclass
 import logging
 import math
@@ -12,6 +16,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 
 
 class LayerNorm(nn.LayerNorm):
@@ -22,13 +27,29 @@ class LayerNorm(nn.LayerNorm):
         x = F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         return x.to(orig_type)
     
+def scaled_dot_product_attention(q, k, v, attn_mask=None):
+    """F.scaled_dot_product_attention (fused kernels on torch 2), or the same math on torch 1.x"""
+    if hasattr(F, 'scaled_dot_product_attention'):
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+    attn = q @ k.transpose(-2, -1) * q.shape[-1]**-0.5
+    if attn_mask is not None:
+        if attn_mask.dtype == torch.bool:
+            attn = attn.masked_fill(~attn_mask, float('-inf'))
+        else:
+            attn = attn + attn_mask
+    return attn.softmax(dim=-1) @ v
+
 class ResidualAttentionBlock(nn.Module):
+    """Pre-norm transformer block on batch-first [*, seq_len, d_model] inputs"""
     def __init__(self, d_model: int, n_head: int, 
         mlp_ratio: float = 4.0, act_layer: Callable = nn.GELU, dropout: float = 0.0
     ):
         super().__init__()
 
+        # only holds the projections (in_proj_weight/bias, out_proj), so the state dicts of the
+        # nn.MultiheadAttention version still load, attention itself goes through scaled_dot_product_attention
         self.attn = nn.MultiheadAttention(d_model, n_head)
+        self.n_head = n_head
         self.ln_1 = LayerNorm(d_model)
         mlp_width = int(d_model * mlp_ratio)
         layers = [("c_fc", nn.Linear(d_model, mlp_width))]
@@ -39,7 +60,15 @@ class ResidualAttentionBlock(nn.Module):
         self.ln_2 = LayerNorm(d_model)
 
     def attention(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
-        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
+        bs, seq_len, d_model = x.shape
+        qkv = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias)
+        q, k, v = qkv.view(bs, seq_len, 3, self.n_head, d_model // self.n_head).permute(2, 0, 3, 1, 4)
+        if attn_mask is not None and attn_mask.dtype == torch.bool:
+            # nn.MultiheadAttention masks where True, scaled_dot_product_attention attends where True
+            attn_mask = ~attn_mask
+        x = scaled_dot_product_attention(q, k, v, attn_mask=attn_mask) # [*, n_head, seq_len, head_dim]
+        x = x.transpose(1, 2).reshape(bs, seq_len, d_model)
+        return self.attn.out_proj(x)
 
     def forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
         x = x + self.attention(self.ln_1(x), attn_mask=attn_mask)
@@ -47,13 +76,18 @@ class ResidualAttentionBlock(nn.Module):
         return x
 
 class Transformer(nn.Module):
+    """
+    Batch-first: [*, seq_len, width] in and out. With grad_checkpointing the activations
+    inside each block are recomputed in backward instead of stored, for long sequences.
+    """
     def __init__(self, width: int, layers: int, heads: int,
-        mlp_ratio: float = 4.0, act_layer: Callable = nn.GELU, dropout: float = 0.0
+        mlp_ratio: float = 4.0, act_layer: Callable = nn.GELU, dropout: float = 0.0,
+        grad_checkpointing: bool = False
     ):
         super().__init__()
         self.width = width
         self.layers = layers
-        self.grad_checkpointing = False
+        self.grad_checkpointing = grad_checkpointing
 
         self.resblocks = nn.ModuleList([
             ResidualAttentionBlock(width, heads, mlp_ratio, act_layer=act_layer, dropout=dropout)
@@ -62,19 +96,113 @@ class Transformer(nn.Module):
 
     def forward(self, x: torch.Tensor, attn_mask: Optional[torch.Tensor] = None):
         for r in self.resblocks:
-            if self.grad_checkpointing and not torch.jit.is_scripting():
-                x = torch.utils.checkpoint(r, x, attn_mask)
+            if self.grad_checkpointing and torch.is_grad_enabled() and not torch.jit.is_scripting():
+                x = checkpoint(r, x, attn_mask, use_reentrant=False)
             else:
                 x = r(x, attn_mask=attn_mask)
         return x
     
+def sparse_conv_plan(mask: torch.Tensor, kernel: int, stride: int, padding: int, dilation: int):
+    """
+    Neighbor map of a Conv3d over the active sites of mask ([D, H, W] bool). Returns the
+    output mask (the sites whose window touches an active input) and, for each of the
+    kernel**3 offsets, the (input, output) indices of the active sites it connects, counting
+    active sites in flattened order.
+    """
+    out_mask = F.max_pool3d(mask[None, None].float(), kernel, stride, padding, dilation)[0, 0] > 0
+    out_dims = out_mask.shape
+    in_index = torch.full(mask.shape, -1, dtype=torch.long)
+    in_index[mask] = torch.arange(int(mask.sum()))
+    in_index = F.pad(in_index, [padding] * 6, value=-1)
+    out_index = torch.arange(int(out_mask.sum()))
+    pairs = []
+    for offset in itertools.product(range(kernel), repeat=3):
+        window = in_index[tuple(slice(o * dilation, o * dilation + stride * (d - 1) + 1, stride)
+                                for o, d in zip(offset, out_dims))]
+        src = window[out_mask]
+        valid = src >= 0
+        pairs.append((src[valid], out_index[valid]))
+    return out_mask, pairs
+
+def sparse_conv_forward(x, weight, pairs, n_out):
+    """
+    Gather-GEMM-scatter convolution of active site features [bs, n_in, c_in] to
+    [bs, n_out, c_out], weight [kernel**3, c_in, c_out]
+    """
+    out = x.new_zeros(x.shape[0], n_out, weight.shape[-1])
+    for k, (src, dst) in enumerate(pairs):
+        if len(src):
+            out.index_add_(1, dst, x[:, src] @ weight[k])
+    return out
+
+class SparseConv3dFunction(torch.autograd.Function):
+    """
+    sparse_conv_forward with a backward that only saves x and the weight, the gathers are
+    redone there rather than kept for every offset
+    """
+    @staticmethod
+    def forward(ctx, x, weight, pairs, n_out):
+        out = sparse_conv_forward(x, weight, pairs, n_out)
+        ctx.save_for_backward(x, weight)
+        ctx.pairs = pairs
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight = ctx.saved_tensors
+        grad_x = torch.zeros_like(x) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight) if ctx.needs_input_grad[1] else None
+        for k, (src, dst) in enumerate(ctx.pairs):
+            if not len(src):
+                continue
+            g = grad_out[:, dst]
+            if grad_weight is not None:
+                grad_weight[k] = x[:, src].flatten(0, 1).t() @ g.flatten(0, 1)
+            if grad_x is not None:
+                grad_x.index_add_(1, src, g @ weight[k].t())
+        return grad_x, grad_weight, None, None
+
+def sparse_conv3d(x: torch.Tensor, conv: nn.Conv3d, pairs, n_out: int):
+    """Apply conv's weights to active site features [bs, n_in, c_in] along a sparse_conv_plan"""
+    # [c_out, c_in, k, k, k] -> [k**3, c_in, c_out], offsets in the order of sparse_conv_plan
+    weight = conv.weight.permute(2, 3, 4, 1, 0).reshape(-1, conv.in_channels, conv.out_channels)
+    if x.is_cuda and torch.is_autocast_enabled():
+        dtype = torch.get_autocast_gpu_dtype()
+    elif not x.is_cuda and torch.is_autocast_cpu_enabled():
+        dtype = torch.get_autocast_cpu_dtype()
+    else:
+        dtype = x.dtype
+    with torch.autocast(x.device.type, enabled=False):
+        if torch.is_grad_enabled():
+            out = SparseConv3dFunction.apply(x.to(dtype), weight.to(dtype), pairs, n_out)
+        else:
+            # plain ops, which torch.jit.trace and the ONNX export can record
+            out = sparse_conv_forward(x.to(dtype), weight.to(dtype), pairs, n_out)
+        if conv.bias is not None:
+            out = out + conv.bias.to(dtype)
+    return out
+
+def channels_first(module: nn.Module, x: torch.Tensor):
+    """Apply a 3D module (BatchNorm3d, Dropout3d) to active site features [bs, n, c]"""
+    return module(x.transpose(1, 2)[..., None, None])[..., 0, 0].transpose(1, 2)
+
 class NewVoxel3dConvEncoder(nn.Module):
     def __init__(self, dims: List[int], attention_width: int, out_dim: int, 
         c_in: int = 1, average_output: bool = False, act_layer: Callable = nn.GELU,
         channels: Optional[List[int]] = None, strides: Optional[List[int]] = None,
         padding: Optional[List[int]] = None, dilation: Optional[List[int]] = None,
-        kernel: Optional[List[int]] = None
+        kernel: Optional[List[int]] = None, mask: Optional[np.ndarray] = None,
+        grad_checkpointing: bool = False
     ):
+        """
+        With a mask (bool, shaped like dims, e.g. BrainMask.level_mask) the conv blocks run
+        sparsely over the sites inside it, with the same parameters as the dense blocks.
+        The BatchNorms then normalize over those sites only, and sites outside the mask
+        stay zero instead of getting the bias, so the outputs match the dense path with
+        its features zeroed outside the mask after every block (exactly so in eval mode).
+
+        grad_checkpointing recomputes the transformer blocks' activations in backward.
+        """
         super().__init__()
         
         # Average the output of the transformer instead of using a flattened linear layer
@@ -122,6 +250,11 @@ class NewVoxel3dConvEncoder(nn.Module):
             for i in range(len(self.channels))
         ])
 
+        if mask is not None:
+            assert list(mask.shape) == list(dims), f"mask shape {list(mask.shape)} doesn't match dims {list(dims)}"
+            self._init_sparse(torch.as_tensor(np.asarray(mask, dtype=bool)))
+        self.sparse = mask is not None
+
         print(f"Input shape: {dims}")
         for n in range(len(self.channels)):
             stride = self.strides[n]
@@ -134,7 +267,7 @@ class NewVoxel3dConvEncoder(nn.Module):
         print(f"Transformer sequence length: {np.prod(dims)}. Transformer width: {attention_width}")
         
         self.transformer = Transformer(attention_width, layers=2, heads=8, mlp_ratio=4, 
-            act_layer=act_layer, dropout=0.0
+            act_layer=act_layer, dropout=0.0, grad_checkpointing=grad_checkpointing
         )
         
         print(f"Projection input features: {attention_width * dims[0] * dims[1] * dims[2]}")
@@ -159,9 +292,51 @@ class NewVoxel3dConvEncoder(nn.Module):
             # nn.MaxPool3d(kernel_size=2, stride=2)
         )
 
-    def forward(self, x: torch.Tensor):
+    def _init_sparse(self, mask: torch.Tensor):
+        # active sites and neighbor maps of every conv block, kept off the module's buffers
+        # (no state_dict entries, no DDP broadcasts) and moved to the input's device on use
+        self.masks = [mask]
+        self.plans = []
+        for n in range(len(self.channels)):
+            out_mask, pairs = sparse_conv_plan(self.masks[-1], self.kernel[n], self.strides[n],
+                                               self.padding[n], self.dilation[n])
+            self.masks.append(out_mask)
+            self.plans.append(pairs)
+        # flat positions of the input and output sites, gathers that the ONNX export takes (boolean masks it doesn't)
+        self.sites = [self.masks[0].flatten().nonzero()[:, 0], self.masks[-1].flatten().nonzero()[:, 0]]
+        self._plans_device = torch.device('cpu')
+        print("Sparse conv active sites: " + ", ".join(
+            f"{int(m.sum())}/{m.numel()}" for m in self.masks))
+
+    def _sparse_plans(self, device):
+        if self._plans_device != device:
+            self.plans = [[(src.to(device), dst.to(device)) for src, dst in pairs] for pairs in self.plans]
+            self.masks = [m.to(device) for m in self.masks]
+            self.sites = [s.to(device) for s in self.sites]
+            self._plans_device = device
+        return self.masks, self.plans
+
+    def _sparse_grid(self, x: torch.Tensor):
+        # the sparse conv blocks, [*, x, y, z] volumes to [*, x', y', z', attention_width] features
+        masks, plans = self._sparse_plans(x.device)
+        in_sites, out_sites = self.sites
+        x = x.flatten(1)[:, in_sites].unsqueeze(-1) # [*, active sites, 1]
+        x = channels_first(self.input_dropout, x)
+        for block, pairs, out_mask in zip(self.conv_blocks, plans, masks[1:]):
+            conv, norm, act, drop = block
+            x = sparse_conv3d(x, conv, pairs, int(out_mask.sum()))
+            x = channels_first(drop, act(channels_first(norm, x)))
+        grid = x.new_zeros(x.shape[0], out_mask.numel(), x.shape[-1])
+        grid[:, out_sites] = x
+        return grid.view(x.shape[0], *out_mask.shape, x.shape[-1])
+
+    def conv_features(self, x: torch.Tensor):
+        """The conv blocks, [*, x, y, z] volumes to [*, attention_width, x', y', z'] features"""
         assert x.ndim == 4, f"Input must be 4D. Got {x.ndim}D"
 
+        if self.sparse:
+            return self._sparse_grid(x).permute(0, 4, 1, 2, 3)
+
         # add singleton channel dimension
         x = x.unsqueeze(1)
 
@@ -171,11 +346,18 @@ class NewVoxel3dConvEncoder(nn.Module):
         for block in self.conv_blocks:
             x = block(x)
             #import ipdb; ipdb.set_trace()
-        # Currently the output shape is [*, attention_width, x, y, z]
-        x = x.reshape(x.shape[0], x.shape[1], -1) # [*, attention_width, seq_len]
-        x = x.permute(2, 0, 1) # [seq_len, *, attention_width]
+        return x
+
+    def forward(self, x: torch.Tensor):
+        if self.sparse:
+            # the sparse grid is channels last already
+            assert x.ndim == 4, f"Input must be 4D. Got {x.ndim}D"
+            x = self._sparse_grid(x).flatten(1, 3) # [*, seq_len, attention_width]
+        else:
+            x = self.conv_features(x)
+            # Currently the output shape is [*, attention_width, x, y, z]
+            x = x.flatten(2).transpose(1, 2) # [*, seq_len, attention_width]
         x = self.transformer(x)
-        x = x.permute(1, 0, 2) # [*, seq_len, attention_width]
         if self.average_output:
             x = x.mean(dim=1)
             x = x @ self.proj
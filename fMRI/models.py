@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from torchvision import transforms
 import torch
@@ -17,11 +18,23 @@ from dalle2_pytorch.train_configs import DiffusionPriorNetworkConfig
 from diffusers import StableDiffusionImageVariationPipeline
 from typing import Callable, List, Optional, Union
 
+import clip_cache
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class Clipper(torch.nn.Module):
-    def __init__(self, clip_variant, clamp_embs=False, norm_embs=False, train_transforms=None):
+    """
+    With cache_size, embed_image and embed_text keep the embeddings of the last cache_size
+    distinct images / prompts (keyed by their content and get_config(), see
+    clip_cache.EmbeddingLRU), and only the ones not in the cache go through CLIP. cache_dir
+    adds an on-disk tier of up to cache_disk_bytes that outlives the run. Random
+    train_transforms would be frozen by the cache, so with them images are only cached in
+    eval mode. Pass cache=False for images that never repeat (augmentations, generated
+    variations), they would only cost a hash and evict the ones that do.
+    """
+    def __init__(self, clip_variant, clamp_embs=False, norm_embs=False, train_transforms=None,
+                 cache_size=0, cache_dir=None, cache_disk_bytes=int(1e9)):
         super().__init__()
         assert clip_variant in ("RN50", "ViT-L/14", "ViT-B/32"), \
             "clip_variant must be one of RN50, ViT-L/14, ViT-B/32"
@@ -31,6 +44,7 @@ class Clipper(torch.nn.Module):
         clip_model.requires_grad_(False) # dont need to calculate gradients
             
         self.clip = clip_model
+        self.clip_variant = clip_variant
         self.mean = np.array([0.48145466, 0.4578275, 0.40821073])
         self.std = np.array([0.26862954, 0.26130258, 0.27577711])
         self.normalize = transforms.Normalize(self.mean, self.std)
@@ -39,13 +53,58 @@ class Clipper(torch.nn.Module):
         self.clamp_embs = clamp_embs
         self.norm_embs = norm_embs
         self.transforms = train_transforms
+        self.cache = clip_cache.EmbeddingLRU(cache_size, cache_dir, cache_disk_bytes) if cache_size else None
+
+    def get_config(self):
+        """Settings that determine the embeddings (used to key the offline embedding cache)"""
+        return dict(
+            clip_variant=self.clip_variant,
+            clamp_embs=self.clamp_embs,
+            norm_embs=self.norm_embs,
+            clip_size=list(self.clip_size),
+            transforms=None if self.transforms is None else repr(self.transforms),
+        )
 
     def resize_image(self, image):
         # note: antialias should be False if planning to use Pinkney's Image Variation SD model
         return nn.functional.interpolate(image.to(device), self.clip_size, mode="area", antialias=False)
 
-    def embed_image(self, image):
+    def cache_stats(self):
+        """Hits, misses and hit rate of the embedding cache since the last call, None without one"""
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        self.cache.reset_stats()
+        return stats
+
+    def _cached(self, samples, embed):
+        """
+        Embeddings of samples, from the cache where it has them and embed(indices) for the
+        rest. Duplicates within the batch are embedded once.
+        """
+        # autocast changes the embeddings, so it is part of the key too
+        config = dict(self.get_config(), autocast=clip_cache.autocast_state(device.type))
+        suffix = clip_cache.config_hash(config)
+        keys = [f"{clip_cache.content_hash(s)}-{suffix}" for s in samples]
+        first = {}
+        for i, key in enumerate(keys):
+            first.setdefault(key, i)
+        embs = {key: self.cache.get(key, device) for key in first}
+        misses = [key for key, emb in embs.items() if emb is None]
+        if misses:
+            for key, emb in zip(misses, embed([first[key] for key in misses])):
+                self.cache.put(key, emb)
+                embs[key] = emb
+        return torch.stack([embs[key].to(device) for key in keys])
+
+    def embed_image(self, image, cache=True):
         """Expects images in -1 to 1 range"""
+        if not cache or self.cache is None or (self.transforms is not None and self.training):
+            return self._embed_image(image)
+        # one copy to the cpu for hashing instead of one per image
+        return self._cached(image.detach().cpu(), lambda idx: self._embed_image(image[idx]))
+
+    def _embed_image(self, image):
         clip_emb = self.resize_image(image)
         if self.transforms is not None:
             clip_emb = self.transforms(clip_emb)
@@ -58,6 +117,12 @@ class Clipper(torch.nn.Module):
         return clip_emb
     
     def embed_text(self, text_samples):
+        if self.cache is None:
+            return self._embed_text(text_samples)
+        text_samples = [text_samples] if isinstance(text_samples, str) else [str(t) for t in text_samples]
+        return self._cached(text_samples, lambda idx: self._embed_text([text_samples[i] for i in idx]))
+
+    def _embed_text(self, text_samples):
         clip_text = clip.tokenize(text_samples).to(device)
         clip_text = self.clip.encode_text(clip_text)
         if self.clamp_embs:
@@ -79,12 +144,127 @@ class Clipper(torch.nn.Module):
         txt = txt.flatten()
         return self.embed_text(txt)
 
+class LowRankLinear(nn.Module):
+    """
+    nn.Linear(in_features, out_features) factorized through a rank r bottleneck, up(down(x)),
+    with r * (in_features + out_features) weights instead of in_features * out_features.
+    For the voxel input projections, 15724 x 4096 = 64M weights become 5M at rank 256.
+    """
+    def __init__(self, in_features, out_features, rank, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.rank = rank
+        self.down = nn.Linear(in_features, rank, bias=False)
+        self.up = nn.Linear(rank, out_features, bias=bias)
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, rank={self.rank}"
+
+    @classmethod
+    def from_linear(cls, linear, rank):
+        """Initialized from the truncated SVD of a (trained) nn.Linear, its best rank r approximation"""
+        down, up = svd_factors(linear.weight.data, rank)
+        lowrank = cls(linear.in_features, linear.out_features, rank, bias=linear.bias is not None)
+        lowrank.to(linear.weight.device)
+        lowrank.down.weight.data.copy_(down)
+        lowrank.up.weight.data.copy_(up)
+        if linear.bias is not None:
+            lowrank.up.bias.data.copy_(linear.bias.data)
+        return lowrank
+
+def svd_factors(weight, rank):
+    """
+    [out, in] weight to the [rank, in] and [out, rank] factors of its truncated SVD,
+    the singular values split evenly between them so neither dominates the gradients
+    """
+    U, S, Vh = torch.linalg.svd(weight.float(), full_matrices=False)
+    root = S[:rank].sqrt()
+    return (root[:, None] * Vh[:rank]).to(weight.dtype), (U[:, :rank] * root).to(weight.dtype)
+
+class RoiBlockLinear(nn.Module):
+    """
+    Block-diagonal input layer: the voxels of each ROI only feed their own slice of the
+    out_features, one small [n_roi, out / num_rois] matmul per ROI instead of one dense
+    [in, out] one, so the weights and FLOPs shrink by about the number of ROIs.
+
+    roi_index maps each input voxel to its ROI (0..num_rois-1, -1 drops the voxel), or is
+    an int to cut the voxels into that many contiguous blocks. The ROIs are packed into a
+    [num_rois, max_roi_size, out / num_rois] weight, padded with zeros, and applied with a
+    single bmm; the padding costs extra when the ROI sizes are very uneven.
+    """
+    def __init__(self, in_features, out_features, roi_index, bias=True):
+        super().__init__()
+        if isinstance(roi_index, int):
+            roi_index = np.arange(in_features) * roi_index // in_features
+        roi_index = np.asarray(roi_index, dtype=np.int64)
+        assert len(roi_index) == in_features, f"roi_index has {len(roi_index)} voxels, expected {in_features}"
+        rois = [np.flatnonzero(roi_index == r) for r in range(roi_index.max() + 1)]
+        rois = [voxels for voxels in rois if len(voxels)]
+        self.in_features = in_features
+        self.out_features = out_features
+        self.num_rois = len(rois)
+        self.block_features = -(-out_features // self.num_rois)
+        max_size = max(len(voxels) for voxels in rois)
+
+        # voxel positions of each ROI, padded with in_features (a zero column appended in forward)
+        gather_index = torch.full((self.num_rois, max_size), in_features, dtype=torch.long)
+        for r, voxels in enumerate(rois):
+            gather_index[r, :len(voxels)] = torch.from_numpy(voxels)
+        self.register_buffer('gather_index', gather_index)
+        self.register_buffer('roi_sizes', torch.tensor([len(v) for v in rois]), persistent=False)
+
+        self.weight = nn.Parameter(torch.empty(self.num_rois, max_size, self.block_features))
+        self.bias = nn.Parameter(torch.empty(out_features)) if bias else None
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # nn.Linear's init with each ROI's own fan in, zero in the padding
+        bound = 1 / self.roi_sizes.float().sqrt()
+        with torch.no_grad():
+            self.weight.uniform_(-1, 1).mul_(bound[:, None, None])
+            self.weight.mul_((self.gather_index < self.in_features)[..., None])
+            if self.bias is not None:
+                block_bound = bound.repeat_interleave(self.block_features)[:self.out_features]
+                self.bias.uniform_(-1, 1).mul_(block_bound)
+
+    def forward(self, x):
+        x = torch.cat([x, x.new_zeros(x.shape[0], 1)], dim=1)
+        x = x[:, self.gather_index].transpose(0, 1) # num_rois, bs, max_size
+        x = torch.bmm(x, self.weight.to(x.dtype)).transpose(0, 1) # bs, num_rois, block_features
+        x = x.reshape(x.shape[0], -1)[:, :self.out_features]
+        if self.bias is not None:
+            x = x + self.bias.to(x.dtype)
+        return x
+
+    def extra_repr(self):
+        return (f"in_features={self.in_features}, out_features={self.out_features}, "
+                f"num_rois={self.num_rois}, max_roi_size={self.weight.shape[1]}")
+
+def load_roi_index(roi_index):
+    """An ROI map given as a .npy path (one ROI id per nsdgeneral voxel), array or number of blocks"""
+    if isinstance(roi_index, str):
+        return np.load(os.path.expanduser(roi_index))
+    return roi_index
+
+def input_projection(in_dim, h, rank=0, roi_index=None):
+    """The voxel input layer, full (rank=0), factorized or ROI block-diagonal"""
+    assert not (rank and roi_index is not None), "rank and roi_index are alternatives"
+    if roi_index is not None:
+        return RoiBlockLinear(in_dim, h, load_roi_index(roi_index))
+    if rank:
+        return LowRankLinear(in_dim, h, rank)
+    return nn.Linear(in_dim, h)
+
 class BrainNetwork(nn.Module):
-    # 133M
-    def __init__(self, out_dim=768, in_dim=15724, h=4096, n_blocks=4):
+    # 133M (75M with rank=256, 78M with roi_index=8)
+    def __init__(self, out_dim=768, in_dim=15724, h=4096, n_blocks=4, rank=0, roi_index=None):
         super().__init__()
         self.lin0 = nn.Sequential(
-            nn.Linear(in_dim, h),
+            input_projection(in_dim, h, rank, roi_index),
             nn.ReLU(inplace=True),
             nn.BatchNorm1d(h),
             nn.Dropout(0.5),
@@ -114,16 +294,16 @@ class BrainNetwork(nn.Module):
             x = self.mlp[res_block](x)
             x += residual
             residual = x
-        x = x.reshape(len(x), -1)
+        x = x.reshape(x.shape[0], -1)
         x = self.lin1(x)
         return x
     
 class BrainNetworkLarge(nn.Module):
-    # 235M
-    def __init__(self, out_dim, in_dim=15724, h=4096):
+    # 235M (176M with rank=256)
+    def __init__(self, out_dim, in_dim=15724, h=4096, rank=0, roi_index=None):
         super().__init__()
         self.conv = nn.Sequential(
-            nn.Linear(in_dim, h),
+            input_projection(in_dim, h, rank, roi_index),
             nn.GELU(),
             nn.Dropout(0.5),
         )
@@ -0,0 +1,107 @@
+"""
+Pack the train and val voxels out of the webdataset shards into a memory-mapped voxel
+store (see voxel_store.py):
+
+$ python pack_voxels.py --voxels_key=nsdgeneral.npy --dtype=float16
+
+Then train with --voxel_store_dir=... (together with --clip_emb_cache_dir=... since the
+store only holds voxels).
+
+For wholebrain_3d.npy, pass --mask_path=... (from make_brain_mask.py) to store only the
+in-mask voxels of each volume.
+
+With --quantize=float16 or int8 the voxels are stored z-scored (int8: per-voxel scaled)
+using the stats of compute_voxel_stats.py in --stats_dir, halving or quartering the store.
+
+After each split the first batch is read back through VoxelStore and compared against the
+float voxels it was packed from, within the error of the store's dtype.
+"""
+import os
+import json
+import numpy as np
+import torch
+import webdataset as wds
+from tqdm import tqdm
+
+import utils
+import shards
+import voxel_store
+import brain_mask
+import voxel_stats
+
+
+def check_roundtrip(store_dir, split, voxels, stats=None, mask=None):
+    """Max error of the first rows of a store split against the float voxels they were packed from"""
+    got = voxel_store.VoxelStore(store_dir, split)[np.arange(len(voxels))][0].float()
+    expected = torch.as_tensor(np.asarray(voxels, dtype=np.float32))
+    atol = torch.zeros(expected.shape[1:])
+    if stats is not None:
+        expected = stats.normalize(expected)
+        if voxel_store.read_meta(store_dir, split)['dtype'] == 'int8':
+            # half a step of rounding, and z-scores beyond 127 steps saturate
+            scale = torch.from_numpy(stats.scale)
+            expected = torch.maximum(torch.minimum(expected, 127 * scale), -127 * scale)
+            atol = scale / 2
+    if mask is not None:
+        expected, atol = mask(expected), mask(atol[None])[0]
+    # float16 storage (and float16 dequantized output) is good to 2**-11 relative
+    excess = (got - expected).abs() - atol - 2**-10 * expected.abs() - 1e-6
+    assert excess.max() <= 0, f"{split} voxels read back from {store_dir} are off by up to {excess.max():.2e} more than expected"
+    return (got - expected).abs().max().item()
+
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    voxels_key = 'nsdgeneral.npy' # ('nsdgeneral.npy', 'wholebrain_3d.npy')
+    dtype = 'float16' # ('float32', 'float16') for raw voxels, ignored when quantizing
+    batch_size = 300
+    num_workers = 4
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    num_train_shards = 50 # train_subj01_{0..num_train_shards-1}.tar under shard_root
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    store_dir = os.path.expanduser('~/data/neuro/voxel-store/nsdgeneral')
+    mask_path = '' # brain mask from make_brain_mask.py, empty to store the volumes as they are
+    quantize = '' # ('', 'float16', 'int8') store z-scores instead of raw voxels
+    stats_dir = os.path.expanduser('~/data/neuro/voxel-stats') # from compute_voxel_stats.py, used when quantizing
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if remote_data:
+        train_url, val_url = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    mask = brain_mask.load_mask(os.path.expanduser(mask_path)) if mask_path else None
+    if mask is not None:
+        print(mask)
+    if quantize:
+        stats = voxel_stats.VoxelStats.load(voxel_stats.stats_path(stats_dir, voxels_key))
+        dtype = quantize
+    else:
+        stats = None
+
+    for split, url in (('train', train_url), ('val', val_url)):
+        data = wds.WebDataset(url)\
+            .decode(only=[voxels_key, "trial.npy"])\
+            .to_tuple("__key__", voxels_key, "trial.npy")\
+            .batched(batch_size, partial=True)
+        # webdataset fails when a worker has no shard to read, e.g. on the one val shard
+        dl = wds.WebLoader(data, num_workers=min(num_workers, len(shards.expand_urls(url))), batch_size=None, shuffle=False)
+
+        writer = voxel_store.VoxelStoreWriter(store_dir, split, voxels_key, dtype, brain_mask=mask, voxel_stats=stats)
+        first = None
+        for keys, voxels, trials in tqdm(dl, desc=split):
+            writer.write(keys, voxels, trials)
+            first = voxels if first is None else first
+        writer.close()
+        diff = check_roundtrip(store_dir, split, first, stats, mask)
+        print(f"{split} round trip: max abs diff {diff:.2e}" + (" (z-scores)" if stats is not None else ""))
@@ -0,0 +1,81 @@
+"""
+Precompute the Clipper image embeddings of the train and val webdatasets once, so the
+training scripts can read them from disk instead of running CLIP every step.
+
+The embeddings are stored as fp16 in a directory keyed by the Clipper config (see
+clip_cache.py), so each clip_variant / clamp_embs / norm_embs setting needs its own run:
+
+$ python precompute_clip_embs.py --clip_variant=ViT-L/14 --norm_embs=True
+
+Then point the training scripts at the same root with --clip_emb_cache_dir=...
+"""
+import os
+import json
+import numpy as np
+import torch
+import webdataset as wds
+from tqdm import tqdm
+
+import utils
+import shards
+import clip_cache
+from models import Clipper
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    clip_variant = "ViT-L/14" # ("RN50", "ViT-L/14", "ViT-B/32")
+    clamp_embs = False # clamp embeddings to (-1.5, 1.5)
+    norm_embs = False # l2 normalize embeddings
+    batch_size = 256
+    num_workers = 4
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    num_train_shards = 50 # train_subj01_{0..num_train_shards-1}.tar under shard_root
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    cache_root = os.path.expanduser('~/data/neuro/clip-emb-cache')
+    overwrite = False # recompute even if the cache is already complete
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=norm_embs)
+    clip_config = clip_extractor.get_config()
+    cache_dir = clip_cache.get_cache_dir(cache_root, clip_config)
+    print("cache_dir", cache_dir)
+
+    if remote_data:
+        train_url, val_url = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    for split, url in (('train', train_url), ('val', val_url)):
+        if not overwrite and clip_cache.is_complete(cache_dir, split, clip_config):
+            print(f"{split} embeddings already cached, skipping")
+            continue
+
+        # one plain pass over the shards, no shuffling or resampling
+        data = wds.WebDataset(url)\
+            .decode("torch")\
+            .rename(images="jpg;png")\
+            .to_tuple("__key__", "images")\
+            .batched(batch_size, partial=True)
+        # webdataset fails when a worker has no shard to read, e.g. on the one val shard
+        dl = wds.WebLoader(data, num_workers=min(num_workers, len(shards.expand_urls(url))), batch_size=None, shuffle=False)
+
+        keys, embs = [], []
+        with torch.no_grad():
+            for batch_keys, image in tqdm(dl, desc=split):
+                emb = clip_extractor.embed_image(image.to(device).float())
+                keys.extend(batch_keys)
+                embs.append(emb.float().cpu().numpy().astype(np.float16))
+
+        clip_cache.write_split(cache_dir, split, keys, np.concatenate(embs), clip_config)
@@ -0,0 +1,65 @@
+"""
+Rewrite the webdataset shards with the jpgs replaced by pre-decoded uint8 images, so
+loading needs no image decoding at all:
+
+$ python predecode_images.py --image_size=256 --out_root=/scratch/.../webdataset_u8
+
+Each jpg becomes a [3, image_size, image_size] uint8 array under utils.PREDECODED_IMAGE_KEY,
+all other fields are copied as is. Train on the result with
+--shard_root=<out_root> --image_decode=predecoded
+"""
+import os
+import io
+import json
+import shutil
+import numpy as np
+import webdataset as wds
+from PIL import Image
+from tqdm import tqdm
+
+import utils
+import shards
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    image_size = 256 # (224, 256) 256 is the stored size, 224 is what CLIP sees
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    out_root = os.path.expanduser('~/data/neuro/webdataset_u8')
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if remote_data:
+        train_url, val_url = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..49}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    for split, url in (('train', train_url), ('val', val_url)):
+        os.makedirs(os.path.join(out_root, split), exist_ok=True)
+        # one output shard per input shard so shard names and counts stay the same
+        for shard_url in tqdm(shards.expand_urls(url), desc=split):
+            out_path = os.path.join(out_root, split, os.path.basename(shard_url))
+            with wds.TarWriter(out_path + '.tmp') as sink:
+                for sample in wds.WebDataset(shard_url):
+                    image_key = 'jpg' if 'jpg' in sample else 'png'
+                    image = Image.open(io.BytesIO(sample.pop(image_key))).convert('RGB')
+                    if image.size != (image_size, image_size):
+                        image = image.resize((image_size, image_size), Image.BICUBIC)
+                    out = {k: v for k, v in sample.items() if not k.startswith('__')}
+                    out['__key__'] = sample['__key__']
+                    out[utils.PREDECODED_IMAGE_KEY] = np.asarray(image).transpose(2, 0, 1).copy()
+                    sink.write(out)
+            os.replace(out_path + '.tmp', out_path)
+
+    # counts are unchanged, so the metadata carries over
+    if not remote_data and os.path.exists(os.path.join(shard_root, 'metadata.json')):
+        shutil.copy(os.path.join(shard_root, 'metadata.json'), os.path.join(out_root, 'metadata.json'))
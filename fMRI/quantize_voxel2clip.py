@@ -0,0 +1,134 @@
+"""
+Int8 quantization of a trained voxel2clip checkpoint for cpu inference:
+
+$ python quantize_voxel2clip.py --ckpt_path=~/data/neuro/models/voxel2clip/test/ckpt-best.pth --modes=dynamic,static
+
+The BatchNorms are folded into the linears first (inference.fold_batchnorms), then
+
+    dynamic   int8 weights, the activations quantized on the fly per batch
+    static    int8 weights and activations, calibrated on calib_samples val voxels
+
+Each variant (fp32, the folded fp32 model, its frozen TorchScript from
+inference.optimize_for_inference and the quantized ones) prints one JSON record:
+the serialized size, the forward latency at each of latency_batch_sizes, and the cosine
+similarity of its embeddings to the fp32 ones over the val set (mean and min per sample).
+With out_dir the quantized models are also written as TorchScript, which loads with
+torch.jit.load and no models.py.
+"""
+import os
+import json
+import itertools
+import torch
+import torch.nn.functional as F
+
+import utils
+import models
+import inference
+import voxel_stats as voxel_stats_lib
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    ckpt_path = ''
+    arch = 'BrainNetwork' # ('BrainNetwork', 'BrainNetworkLarge')
+    out_dim = 768
+    rank = 0 # the voxel2clip_kwargs the checkpoint was trained with
+    roi_index = '' # .npy ROI map or a number of blocks, empty for none
+    modes = 'dynamic,static' # comma separated ('dynamic', 'static')
+    fold_bn = True
+    freeze = True # also compare inference.optimize_for_inference, the frozen fp32 TorchScript
+    backend = 'fbgemm' # ('fbgemm', 'qnnpack') fbgemm on x86, qnnpack on arm
+    calib_samples = 300 # static: val voxels to calibrate the activation ranges on
+    max_val_samples = 0 # val voxels to compare the embeddings on, 0 for the whole split
+    val_url = '' # empty for the Hugging Face val shards
+    voxel_stats_dir = '' # the stats the checkpoint was trained with, see compute_voxel_stats.py
+    batch_size = 300
+    latency_batch_sizes = (1, 300) # a single one is written --latency_batch_sizes=1, with the trailing comma
+    steps = 20
+    warmup = 5
+    num_threads = 0 # torch cpu threads, 0 for the default
+    out_dir = '' # also write <arch>-int8-<mode>.pt TorchScript models here
+    out_path = '' # also write the records here
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str, tuple))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    roi = None if roi_index == '' else int(roi_index) if roi_index.isdigit() else roi_index
+    model = getattr(models, arch)(out_dim=out_dim, rank=rank, roi_index=roi)
+    checkpoint = torch.load(os.path.expanduser(ckpt_path), map_location='cpu')
+    model.load_state_dict(checkpoint.get('model_state_dict', checkpoint))
+    model.eval()
+    print("loaded", ckpt_path)
+    utils.count_params(model)
+
+    if voxel_stats_dir:
+        voxel_stats = voxel_stats_lib.VoxelStats.load(voxel_stats_lib.stats_path(os.path.expanduser(voxel_stats_dir), 'nsdgeneral.npy'))
+    else:
+        voxel_stats = None
+    # voxels only, the trial stands in for the images
+    _, val_dl = utils.get_dataloaders(
+        batch_size, "trial",
+        num_workers=0,
+        val_url=val_url or None,
+        val_cache_bytes=0,
+        voxel_stats=voxel_stats,
+    )
+    val_voxels = []
+    for voxel, _ in val_dl:
+        val_voxels.append(voxel.float())
+        if max_val_samples and sum(len(v) for v in val_voxels) >= max_val_samples:
+            break
+    val_voxels = torch.cat(val_voxels)[:max_val_samples or None]
+    print(f"{len(val_voxels)} val voxels")
+
+    with torch.no_grad():
+        reference = torch.cat([model(v) for v in val_voxels.split(batch_size)])
+
+    variants = [('fp32', model)]
+    folded = model
+    if fold_bn:
+        folded, num_folded = inference.fold_batchnorms(model)
+        print(f"folded {num_folded} BatchNorms")
+        variants.append(('fp32_folded', folded))
+    if freeze:
+        variants.append(('fp32_frozen', inference.optimize_for_inference(model, val_voxels[:batch_size])))
+    for mode in modes.split(','):
+        if mode == 'dynamic':
+            variants.append((mode, inference.quantize_dynamic(folded, backend)))
+        elif mode == 'static':
+            calibration = val_voxels[:calib_samples].split(batch_size)
+            variants.append((mode, inference.quantize_static(folded, calibration, backend)))
+        else:
+            raise ValueError(f"unknown mode {mode}, expected 'dynamic' or 'static'")
+
+    records = []
+    for name, variant in variants:
+        with torch.no_grad():
+            emb = torch.cat([variant(v) for v in val_voxels.split(batch_size)])
+        cos = F.cosine_similarity(emb.float(), reference, dim=-1)
+        record = dict(variant=name, size_mb=inference.model_size_mb(variant),
+                      cos_mean=cos.mean().item(), cos_min=cos.min().item())
+        for bs in latency_batch_sizes:
+            inputs = val_voxels[list(itertools.islice(itertools.cycle(range(len(val_voxels))), bs))]
+            record[f"latency_ms_bs{bs}"] = inference.measure_latency(variant, inputs, steps, warmup)
+        print(json.dumps(record))
+        records.append(record)
+
+        if out_dir and name in ('dynamic', 'static'):
+            os.makedirs(os.path.expanduser(out_dir), exist_ok=True)
+            path = os.path.join(os.path.expanduser(out_dir), f"{arch}-int8-{name}.pt")
+            torch.jit.save(torch.jit.trace(variant, val_voxels[:2]), path)
+            print(f"saved {path}")
+
+    if out_path:
+        with open(out_path, 'w') as f:
+            json.dump(dict(config=config, results=records), f, indent=2)
+        print(f"wrote {len(records)} results to {out_path}")
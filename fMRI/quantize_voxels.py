@@ -0,0 +1,70 @@
+"""
+Rewrite the webdataset shards with the voxels stored as z-scored float16 or per-voxel
+scaled int8 (see voxel_stats.py), halving or quartering the voxel bytes read per sample:
+
+$ python compute_voxel_stats.py
+$ python quantize_voxels.py --quantize=int8 --out_root=/scratch/.../webdataset_int8
+
+Every key in voxels_keys keeps its name but holds the quantized array, all other fields
+are copied as is. Train on the result with --shard_root=<out_root> --voxel_stats_dir=<stats_dir>
+so the loaders dequantize with the same stats.
+"""
+import os
+import json
+import shutil
+import numpy as np
+import webdataset as wds
+from tqdm import tqdm
+
+import utils
+import shards
+import voxel_stats
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    voxels_keys = 'nsdgeneral.npy,wholebrain_3d.npy' # comma separated
+    quantize = 'int8' # ('float16', 'int8')
+    remote_data = False # pull data from huggingface if True
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
+    num_train_shards = 50 # train_subj01_{0..num_train_shards-1}.tar under shard_root
+    data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
+    stats_dir = os.path.expanduser('~/data/neuro/voxel-stats') # from compute_voxel_stats.py
+    out_root = os.path.expanduser('~/data/neuro/webdataset_int8')
+
+    # -----------------------------------------------------------------------------
+    config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    config = {k: globals()[k] for k in config_keys}
+    # -----------------------------------------------------------------------------
+
+    print('config:')
+    print(json.dumps(config, indent=2))
+
+    if remote_data:
+        train_url, val_url = utils.get_huggingface_urls(data_commit)
+    else:
+        train_url = f"{shard_root}/train/train_subj01_{{0..{num_train_shards - 1}}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
+
+    keys = voxels_keys.split(',')
+    stats = {key: voxel_stats.VoxelStats.load(voxel_stats.stats_path(stats_dir, key)) for key in keys}
+
+    for split, url in (('train', train_url), ('val', val_url)):
+        os.makedirs(os.path.join(out_root, split), exist_ok=True)
+        # one output shard per input shard so shard names and counts stay the same
+        for shard_url in tqdm(shards.expand_urls(url), desc=split):
+            out_path = os.path.join(out_root, split, os.path.basename(shard_url))
+            with wds.TarWriter(out_path + '.tmp') as sink:
+                for sample in wds.WebDataset(shard_url).decode(only=keys):
+                    out = {k: v for k, v in sample.items() if not k.startswith('__')}
+                    out['__key__'] = sample['__key__']
+                    for key in keys:
+                        out[key] = stats[key].quantize(np.asarray(sample[key])[None], quantize)[0]
+                    sink.write(out)
+            os.replace(out_path + '.tmp', out_path)
+
+    # counts are unchanged, so the metadata carries over, and the stats travel with the shards
+    if not remote_data and os.path.exists(os.path.join(shard_root, 'metadata.json')):
+        shutil.copy(os.path.join(shard_root, 'metadata.json'), os.path.join(out_root, 'metadata.json'))
+    for key in keys:
+        shutil.copy(voxel_stats.stats_path(stats_dir, key), voxel_stats.stats_path(out_root, key))
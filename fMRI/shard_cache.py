@@ -0,0 +1,171 @@
+"""
+Bounded on-disk cache for remote webdataset shards (e.g. the Hugging Face NSD urls).
+
+Shards are downloaded into cache_dir, the least recently used ones are evicted once the
+cache grows past max_bytes, and the next few shards of each worker's (shuffled) shard
+order are downloaded by background threads while the current one is being read.
+Shards found in a local mirror (a directory or file:// url) are read from there instead.
+
+The cache directory is the shared state, so DataLoader workers can each hold their own
+ShardCache: recency is the file mtime, and downloads land under a temp name and are
+renamed into place when complete.
+
+check_shard_cache.py runs it against a local HTTP stand-in for the remote shards.
+"""
+import os
+import time
+import hashlib
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import webdataset as wds
+
+
+class ShardCache:
+    def __init__(self, cache_dir, max_bytes, num_prefetch=2, num_threads=2, mirrors=(), opener=None):
+        """
+        opener(url) returns a readable file object for url, urllib's urlopen by default
+        (pass a different one to test against a local server or a fake).
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.num_prefetch = num_prefetch
+        self.num_threads = num_threads
+        self.mirrors = [m[len('file://'):] if m.startswith('file://') else m for m in mirrors]
+        self.opener = opener
+        self.hits, self.misses = 0, 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._pid = None
+
+    def _init_process(self):
+        # threads and locks don't survive fork, so they are created in the process using them
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._executor = ThreadPoolExecutor(self.num_threads)
+            self._lock = threading.Lock()
+            self._pending = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ('_executor', '_lock', '_pending'):
+            state.pop(k, None)
+        state['_pid'] = None
+        return state
+
+    def cache_path(self, url):
+        # basenames repeat across subjects and commits, so prefix a hash of the full url
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest()[:10] + '-' + os.path.basename(url))
+
+    def mirror_path(self, url):
+        if url.startswith('file://'):
+            return url[len('file://'):]
+        if '://' not in url:
+            return url
+        parent, name = url.rsplit('/', 2)[-2:]
+        for mirror in self.mirrors:
+            for path in (os.path.join(mirror, name), os.path.join(mirror, parent, name)):
+                if os.path.exists(path):
+                    return path
+        return None
+
+    def _download(self, url):
+        path = self.cache_path(url)
+        if os.path.exists(path):
+            return path
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        opener = self.opener or (lambda u: urllib.request.urlopen(u, timeout=60))
+        t0 = time.time()
+        with opener(url) as src, open(tmp_path, 'wb') as dst:
+            while True:
+                chunk = src.read(1 << 22)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        os.replace(tmp_path, path)
+        print(f"downloaded {url} ({os.path.getsize(path) / 1e9:.2f} GB in {time.time() - t0:.1f}s)")
+        with self._lock:
+            # prefetched shards that haven't been read yet are about to be, keep them too
+            keep = {path} | {self.cache_path(u) for u in self._pending}
+        self.evict(keep=keep)
+        return path
+
+    def _submit(self, url):
+        with self._lock:
+            future = self._pending.get(url)
+            if future is not None and future.done() and \
+                    (future.exception() is not None or not os.path.exists(self.cache_path(url))):
+                # a failed download is retried, and a finished one whose file was evicted since redone
+                future = None
+            if future is None:
+                future = self._executor.submit(self._download, url)
+                self._pending[url] = future
+        return future
+
+    def prefetch(self, urls):
+        self._init_process()
+        for url in urls[:self.num_prefetch]:
+            if self.mirror_path(url) is None and not os.path.exists(self.cache_path(url)):
+                self._submit(url)
+
+    def get(self, url):
+        """Local path of url, downloading it (or waiting for its prefetch) if needed"""
+        self._init_process()
+        path = self.mirror_path(url)
+        if path is not None:
+            return path
+        path = self.cache_path(url)
+        if os.path.exists(path):
+            self.hits += 1
+        else:
+            self.misses += 1
+        try:
+            while True:
+                if not os.path.exists(path):
+                    self._submit(url).result()
+                try:
+                    os.utime(path) # mark as most recently used
+                    return path
+                except FileNotFoundError: # evicted by another worker in between, download it again
+                    pass
+        finally:
+            with self._lock:
+                self._pending.pop(url, None)
+
+    def evict(self, keep=()):
+        """Remove least recently used shards until the cache fits in max_bytes"""
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.tmp') or path in keep:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError: # evicted by another worker
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files) + sum(os.path.getsize(p) for p in keep if os.path.exists(p))
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                # readers that already opened it keep their handle, unlinking is safe
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+    def open_shards(self, src):
+        """Pipeline stage: turns {url} samples into {url, stream}, prefetching the ones that follow"""
+        urls = [sample['url'] for sample in src]
+        for i, url in enumerate(urls):
+            self.prefetch(urls[i + 1:])
+            with open(self.get(url), 'rb') as stream:
+                yield dict(url=url, stream=stream)
+
+
+def cached_tarfile_samples(src, shard_cache, select_files=None):
+    """Like wds.tarfile_samples, but reading the shards through a ShardCache"""
+    streams = shard_cache.open_shards(src)
+    kwargs = dict(select_files=select_files) if select_files is not None else dict()
+    files = wds.tariterators.tar_file_expander(streams, handler=wds.reraise_exception, **kwargs)
+    return wds.tariterators.group_by_keys(files, handler=wds.reraise_exception)
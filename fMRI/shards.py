@@ -0,0 +1,306 @@
+"""
+Exact, rank-aware epochs over webdataset shards.
+
+Instead of resampling shards with replacement, every epoch the shard list is shuffled
+with a seed shared by all ranks and split round-robin over ranks and then over the
+DataLoader workers of each rank, so each sample is read exactly once per epoch and
+DDP ranks read disjoint data.
+
+The sample shuffle buffer (EpochShuffle) is seeded by epoch, rank and worker as well, so
+an epoch's batches can be replayed, and EpochLoader.state_dict() / load_state_dict()
+resume a run in the middle of an epoch: each worker skips the samples it already
+delivered before they are decoded, and shards whose samples were all delivered are not
+read at all (when metadata.json has per-shard counts).
+"""
+import os
+import json
+import math
+import random
+import urllib.request
+import braceexpand
+import torch
+import torch.distributed as dist
+
+# subj01's counts, used when there is no metadata.json next to its shards
+DEFAULT_NUM_SAMPLES = dict(train=24983, val=492)
+
+
+def expand_urls(url):
+    if isinstance(url, (list, tuple)):
+        return [u for x in url for u in expand_urls(x)]
+    return list(braceexpand.braceexpand(url))
+
+def get_rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+def read_metadata(url):
+    """
+    Read the metadata.json one level above the split directory, e.g.
+    webdataset_split/metadata.json for webdataset_split/train/train_subj01_{0..49}.tar.
+    Returns None if there isn't one.
+    """
+    first_url = expand_urls(url)[0]
+    split_dir = first_url.rsplit('/', 1)[0]
+    metadata_url = split_dir.rsplit('/', 1)[0] + '/metadata.json'
+    try:
+        if '://' in metadata_url:
+            with urllib.request.urlopen(metadata_url, timeout=30) as f:
+                return json.loads(f.read())
+        with open(metadata_url) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"could not read {metadata_url}: {e}")
+        return None
+
+def get_shard_counts(url, split, subject=1):
+    """
+    Number of samples in each shard of a split, keyed by shard url.
+
+    metadata.json holds the split totals as {"totals": {"train": 24983, ...}}, and those of
+    other subjects as {"totals": {"subj02": {"train": ...}}}, and optionally per-shard
+    counts as {"shard_counts": {"train_subj01_0.tar": 500, ...}}.
+    Shards without a count are assumed to hold an equal share of the split total. Only
+    subj01 falls back to DEFAULT_NUM_SAMPLES, the other subjects' totals must be given.
+    """
+    urls = expand_urls(url)
+    metadata = read_metadata(url) or {}
+    known = metadata.get('shard_counts', {})
+    counts = {u: known[os.path.basename(u)] for u in urls if os.path.basename(u) in known}
+    if len(counts) < len(urls):
+        totals = metadata.get('totals', {})
+        total = totals.get(f'subj{subject:02d}', {}).get(split, totals.get(split) if subject == 1 else None)
+        if total is None and subject != 1:
+            # subj01's count would get the epoch length, the lr schedule and resuming wrong
+            raise ValueError(f"no sample count for subj{subject:02d} {split} in the metadata.json of {url}, "
+                             f"add it as {{\"totals\": {{\"subj{subject:02d}\": {{\"{split}\": <count>}}}}}}")
+        if total is None:
+            total = DEFAULT_NUM_SAMPLES[split]
+            print(f"no sample count for subj01 {split} in metadata.json, assuming {total}")
+        remaining = total - sum(counts.values())
+        n_missing = len(urls) - len(counts)
+        for i, u in enumerate(u for u in urls if u not in counts):
+            counts[u] = remaining // n_missing + (1 if i < remaining % n_missing else 0)
+    return counts
+
+def has_exact_counts(url):
+    """Whether metadata.json has the count of every shard of url, rather than just split totals"""
+    known = (read_metadata(url) or {}).get('shard_counts', {})
+    return all(os.path.basename(u) in known for u in expand_urls(url))
+
+def buffer_shuffle(src, bufsize, rng):
+    """Shuffle buffer like wds.shuffle, drawing from the given rng so the order can be replayed"""
+    buf = []
+    for sample in src:
+        if len(buf) < bufsize:
+            buf.append(sample)
+            continue
+        k = rng.randrange(bufsize)
+        yield buf[k]
+        buf[k] = sample
+    rng.shuffle(buf)
+    yield from buf
+
+def worker_batches_consumed(worker_batches, num_batches):
+    """
+    How many of each worker's batches are among the first num_batches of an epoch. The
+    DataLoader takes batches from its workers round-robin, skipping exhausted workers.
+    """
+    consumed = [0] * len(worker_batches)
+    active = [w for w, n in enumerate(worker_batches) if n > 0]
+    while num_batches > 0 and active:
+        for w in list(active):
+            if num_batches == 0:
+                break
+            consumed[w] += 1
+            num_batches -= 1
+            if consumed[w] == worker_batches[w]:
+                active.remove(w)
+    return consumed
+
+
+class EpochShardList(torch.utils.data.IterableDataset):
+    """
+    First stage of a wds.DataPipeline, yields the shards of one rank and worker for one epoch.
+    Each worker counts its own epochs, so this works with persistent workers as long as
+    every epoch iterates the loader once.
+
+    resume, set by EpochLoader.load_state_dict, holds the epoch to start from and how
+    many samples each worker already delivered in it. With shard_counts (exact ones) and
+    the bufsize of the EpochShuffle that follows, the shards holding only delivered
+    samples are left out.
+    """
+    def __init__(self, urls, rank=0, world_size=1, shuffle=True, seed=0, shard_counts=None, bufsize=0):
+        super().__init__()
+        self.urls = expand_urls(urls)
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.shard_counts = shard_counts
+        self.bufsize = bufsize
+        self.epoch = 0
+        self.resume = None
+        self.plan = None
+
+    def shards(self, epoch, rank, worker, num_workers):
+        urls = list(self.urls)
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(urls)
+        return urls[rank::self.world_size][worker::num_workers]
+
+    def sample_rng(self, epoch, worker):
+        # str seeds are hashed deterministically, unlike tuples
+        return random.Random(f"{self.seed}-{epoch}-{self.rank}-{worker}")
+
+    def skipped_shards(self, urls, skip, rng):
+        """Shards all of whose samples are among the first skip the shuffle buffer puts out"""
+        if skip == 0 or self.shard_counts is None:
+            return set()
+        # replay the shuffle on sample positions instead of samples
+        total = sum(self.shard_counts[u] for u in urls)
+        order = buffer_shuffle(iter(range(total)), self.bufsize, rng) if self.bufsize else iter(range(total))
+        delivered = set(next(order) for _ in range(min(skip, total)))
+        skipped, start = set(), 0
+        for u in urls:
+            n = self.shard_counts[u]
+            if all(i in delivered for i in range(start, start + n)):
+                skipped.add(u)
+            start += n
+        return skipped
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        epoch = self.epoch
+        self.epoch += 1
+        urls = self.shards(epoch, self.rank, worker, num_workers)
+        skip = 0
+        if self.resume is not None and self.resume['epoch'] == epoch:
+            skip = self.resume['skip'][worker]
+        skipped = self.skipped_shards(urls, skip, self.sample_rng(epoch, worker))
+        # read by the EpochShuffle stage of the same worker
+        self.plan = dict(urls=urls, skip=skip, skipped=skipped, rng=self.sample_rng(epoch, worker))
+        for url in urls:
+            if url not in skipped:
+                yield dict(url=url)
+
+
+class EpochShuffle:
+    """
+    Pipeline stage after the tar reader (and before decoding): a shuffle buffer seeded per
+    epoch, rank and worker by the EpochShardList, which also drops the samples a resumed
+    run already delivered. Shards the EpochShardList left out are stood in for by
+    placeholders, so the buffer sees the same sequence as in the original run.
+    """
+    def __init__(self, shard_list, bufsize):
+        self.shard_list = shard_list
+        self.bufsize = bufsize
+
+    def __call__(self, src):
+        src = iter(src)
+        # pulling the first sample starts the shard list's iteration, which sets its plan
+        sample = next(src, None)
+        plan = self.shard_list.plan
+
+        def with_placeholders(sample):
+            for url in plan['urls']:
+                if url in plan['skipped']:
+                    yield from [None] * self.shard_list.shard_counts[url]
+                    continue
+                while sample is not None and sample['__url__'] == url:
+                    yield sample
+                    sample = next(src, None)
+            while sample is not None:
+                yield sample
+                sample = next(src, None)
+
+        stream = with_placeholders(sample)
+        if self.bufsize:
+            stream = buffer_shuffle(stream, self.bufsize, plan['rng'])
+        for i, sample in enumerate(stream):
+            if i < plan['skip']:
+                continue
+            assert sample is not None, "a skipped shard has undelivered samples, are the shard counts right?"
+            yield sample
+
+
+class EpochLoader:
+    """
+    Wraps the WebLoader over an EpochShardList. Each epoch yields every batch of this
+    rank, except that under DDP all ranks stop after the smallest rank's batch count for
+    that epoch, so no rank is left waiting on a step the others never take.
+
+    state_dict() is the position after the last batch handed out, load_state_dict()
+    resumes from such a position. It has to be called before the loader is first
+    iterated, since the workers keep the copy of the EpochShardList they started with.
+    A resumed epoch delivers the same remaining samples, though the DataLoader may take
+    the remaining batches from its workers in a different order.
+    """
+    def __init__(self, loader, shard_list, shard_counts, batch_size, num_workers):
+        self.loader = loader
+        self.shard_list = shard_list
+        self.shard_counts = shard_counts
+        self.batch_size = batch_size
+        self.has_workers = num_workers > 0
+        self.num_workers = max(1, num_workers)
+        self.epoch = 0
+        self.batch = 0 # batches handed out in the current epoch
+        self.skip_batches = 0
+        self.started = False
+
+    def worker_samples(self, epoch):
+        return [sum(self.shard_counts[u] for u in self.shard_list.shards(epoch, self.shard_list.rank, w, self.num_workers))
+                for w in range(self.num_workers)]
+
+    def state_dict(self):
+        if self.epoch == 0:
+            return dict(epoch=0, batch=0, seed=self.shard_list.seed)
+        return dict(epoch=self.epoch - 1, batch=self.batch, seed=self.shard_list.seed)
+
+    def load_state_dict(self, state):
+        assert not (self.started and self.has_workers), \
+            "load the loader state before iterating the loader, the workers already started from the old state"
+        assert state['seed'] == self.shard_list.seed, \
+            f"the state is from a run with seed {state['seed']}, not {self.shard_list.seed}"
+        epoch, batch = state['epoch'], state['batch']
+        if batch >= self.num_batches(epoch):
+            epoch, batch = epoch + 1, 0
+        self.epoch = epoch
+        self.shard_list.epoch = epoch
+        self.skip_batches = batch
+        if batch > 0:
+            samples = self.worker_samples(epoch)
+            consumed = worker_batches_consumed([math.ceil(n / self.batch_size) for n in samples], batch)
+            skip = [min(c * self.batch_size, n) for c, n in zip(consumed, samples)]
+            self.shard_list.resume = dict(epoch=epoch, skip=skip)
+        print(f"resuming at epoch {epoch}, batch {batch}")
+
+    def num_batches(self, epoch):
+        per_rank = []
+        for rank in range(self.shard_list.world_size):
+            n = 0
+            for worker in range(self.num_workers):
+                shards = self.shard_list.shards(epoch, rank, worker, self.num_workers)
+                # each worker batches its own samples, so each can end on a partial batch
+                n += math.ceil(sum(self.shard_counts[u] for u in shards) / self.batch_size)
+            per_rank.append(n)
+        return min(per_rank)
+
+    def __len__(self):
+        # upper bound on num_batches(epoch) over all epochs, e.g. for OneCycleLR's total_steps
+        num_samples = sum(self.shard_counts.values()) // self.shard_list.world_size
+        return math.ceil(num_samples / self.batch_size) + self.num_workers - 1
+
+    def __iter__(self):
+        self.started = True
+        skip, self.skip_batches = self.skip_batches, 0
+        n = self.num_batches(self.epoch) - skip
+        self.epoch += 1
+        self.batch = skip
+        for i, batch in enumerate(self.loader):
+            if i == n:
+                break
+            self.batch += 1
+            yield batch
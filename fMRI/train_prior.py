@@ -17,6 +17,9 @@ from dalle2_pytorch import DiffusionPriorNetwork #, DiffusionPrior
 
 import ddp_config
 import utils
+import clip_cache
+import voxel_stats as voxel_stats_lib
+import loaders
 from models import Clipper, BrainNetwork, BrainDiffusionPrior, BrainSD
 
 if __name__ == '__main__':
@@ -46,8 +49,19 @@ if __name__ == '__main__':
     # how many pairs of (orig, augmented) images to save
     n_aug_save = 16
     remote_data = False
+    shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
     data_commit = '9947586218b6b7c8cab804009ddca5045249a38d'
     pretrained = False
+    clip_emb_cache_dir = '' # root written by precompute_clip_embs.py, empty to run CLIP every step
+    clip_lru_size = 0 # Clipper LRU of the last N image embeddings (the val images repeat every epoch), 0 for none
+    clip_lru_dir = '' # on-disk tier of that cache, kept between runs
+    clip_lru_disk_gb = 1.0 # disk budget of that tier, least recently used embeddings are removed past it
+    voxel_store_dir = '' # written by pack_voxels.py, empty to read voxels from the tar shards
+    image_decode = 'pil' # ('pil', 'batched', 'predecoded') see utils.decode_stages
+    voxel_stats_dir = '' # from compute_voxel_stats.py, z-scores the voxels (and dequantizes quantize_voxels.py shards)
+    compile = False # torch.compile brain_net, the prior's p_losses and the metrics, eager where that fails
+    compile_cache_dir = '~/.cache/medical/torch_compile' # compile caches kept between runs
+    precision = 'fp32' # ('fp32', 'bf16', 'fp16') autocast mode, bf16 also works on the cpu
     # -----------------------------------------------------------------------------
     # params for all models
     seed = 0
@@ -118,7 +132,23 @@ if __name__ == '__main__':
 
     # load clipper - don't L2 norm the extracted CLIP embeddings since we want the prior 
     # to learn un-normed embeddings for usage with the SD image variation pipeline
-    clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=False)
+    clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=False,
+                             cache_size=clip_lru_size, cache_dir=clip_lru_dir or None,
+                             cache_disk_bytes=int(clip_lru_disk_gb * 1e9))
+
+    if clip_emb_cache_dir:
+        # the loaders yield precomputed CLIP embeddings in place of the images
+        assert clip_aug_mode == 'n', "image variations need the real images, use clip_aug_mode='n' with cached embeddings"
+        assert n_samples_save == 0, "sampling needs the real images, use n_samples_save=0 with cached embeddings"
+        clip_emb_dir = clip_cache.get_cache_dir(clip_emb_cache_dir, clip_extractor.get_config())
+    else:
+        clip_emb_dir = None
+
+    if voxel_stats_dir:
+        # the models train on z-scored voxels, inference has to normalize with the same stats
+        voxel_stats = voxel_stats_lib.VoxelStats.load(voxel_stats_lib.stats_path(os.path.expanduser(voxel_stats_dir), 'nsdgeneral.npy'))
+    else:
+        voxel_stats = None
 
     # # load COCO annotations curated in the same way as the mind_reader (Lin Sprague Singh) preprint
     # f = h5py.File('/scratch/gpfs/KNORMAN/nsdgeneral_hdf5/COCO_73k_subj_indices.hdf5', 'r')
@@ -132,14 +162,20 @@ if __name__ == '__main__':
         train_url, val_url = utils.get_huggingface_urls(data_commit)
     else:
         # local paths
-        train_url = "/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split/train/train_subj01_{0..49}.tar"
-        val_url = "/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split/val/val_subj01_0.tar"
+        train_url = f"{shard_root}/train/train_subj01_{{0..49}}.tar"
+        val_url = f"{shard_root}/val/val_subj01_0.tar"
 
     train_dl, val_dl = utils.get_dataloaders(
         batch_size, image_var, 
         num_workers=num_workers,
         train_url=train_url,
         val_url=val_url,
+        clip_emb_dir=clip_emb_dir,
+        clip_config=clip_extractor.get_config(),
+        voxel_store_dir=voxel_store_dir or None,
+        seed=seed,
+        image_decode=image_decode,
+        voxel_stats=voxel_stats,
     )
 
     # get first batches
@@ -201,15 +237,34 @@ if __name__ == '__main__':
 
     utils.count_params(diffusion_prior)
 
+    def sim_metrics(image_clip, pred, clip_embed):
+        """Cosine similarity of the target to the prior's prediction and to the voxel embedding, in fp32"""
+        image_clip = image_clip.float()
+        return F.cosine_similarity(image_clip, pred.float()).mean(), F.cosine_similarity(image_clip, clip_embed.float()).mean()
+
+    compiled = []
+    if compile:
+        utils.setup_compile_cache(compile_cache_dir)
+        # in place, inside DDP
+        utils.compile_with_fallback(brain_net.module if using_ddp else brain_net, 'brain_net')
+        diffusion_prior.p_losses = utils.compile_with_fallback(diffusion_prior.p_losses, 'p_losses')
+        sim_metrics = utils.compile_with_fallback(sim_metrics, 'sim_metrics')
+        compiled = [(brain_net.module if using_ddp else brain_net).forward, diffusion_prior.p_losses, sim_metrics]
+    step_times = []
+
+    if precision != 'fp32':
+        utils.keep_norms_fp32(diffusion_prior)
+        utils.keep_norms_fp32(brain_net)
+    scaler = utils.get_grad_scaler(precision)
+
     optimizer = torch.optim.AdamW(diffusion_prior.parameters(), lr=initial_lr)
     if lr_scheduler == 'fixed':
         lr_scheduler = None
     elif lr_scheduler == 'cycle':
-        # <TODO> hard-coded values
         lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
             optimizer, 
             max_lr=max_lr, 
-            total_steps=num_epochs*((24983//batch_size)//num_devices), 
+            total_steps=num_epochs*len(train_dl), 
             final_div_factor=1000,
             last_epoch=-1, pct_start=2/num_epochs
         )
@@ -270,6 +325,10 @@ if __name__ == '__main__':
         train_dl = [(voxel0[:bs], image0[:bs])]
         val_dl = [(val_voxel0[:bs], val_image0[:bs])]
 
+    # copy the next batch to the gpu (and convert it there) while the current step runs
+    train_dl = loaders.DevicePrefetcher(train_dl, device)
+    val_dl = loaders.DevicePrefetcher(val_dl, device)
+
     # feed text and images into diffusion prior network
     progress_bar = tqdm(range(epoch, num_epochs), desc='train loop')
 
@@ -280,78 +339,90 @@ if __name__ == '__main__':
         image_aug = None
 
         for train_i, (voxel, image) in enumerate(train_dl):
+            t_step = time.time()
             optimizer.zero_grad()
-            image = image.to(device)
-            clip_embed = brain_net(voxel.to(device).float())
-            image_clip = clip_extractor.embed_image(image).float()
-
-            if clip_aug_mode == 'x':
-                # the target y is fixed, and we will change the input x
-                if random.random() < clip_aug_prob:
-                    # get an image variation
-                    image_aug = sd_pipe(
-                        image=image,
-                        width=256,
-                        height=256,
-                    )
-                    # get the CLIP embedding for the variation and use it for x
-                    clip_aug = clip_extractor.embed_image(image_aug).float()
-
-                    loss, pred = diffusion_prior(text_embed=clip_aug, image_embed=image_clip)
-                    loss_on_aug.append(loss.item())
+            with utils.get_autocast(precision, device):
+                clip_embed = brain_net(voxel)
+                if clip_emb_dir is None:
+                    image_clip = clip_extractor.embed_image(image).float()
                 else:
-                    loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
-                    loss_off_aug.append(loss.item())
-
-            elif clip_aug_mode == 'y':
-                # the input x is fixed, and we will change the target y
-                if random.random() < clip_aug_prob:
-                    _, clip_pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
-
-                    # get an image variation
-                    image_aug = sd_pipe(
-                        # duplicate the embedding to serve classifier free guidance
-                        image_embeddings=torch.cat([torch.zeros_like(clip_pred), clip_pred]).unsqueeze(1),
-                        width=256,
-                        height=256,
-                    )
-                    # get the CLIP embedding for the variation and use it for y
-                    clip_aug = clip_extractor.embed_image(image_aug).float()
-
-                    loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=clip_aug)
-                    loss_on_aug.append(loss.item())
+                    image_clip = image.float() # already a CLIP embedding
+
+                if clip_aug_mode == 'x':
+                    # the target y is fixed, and we will change the input x
+                    if random.random() < clip_aug_prob:
+                        # get an image variation
+                        image_aug = sd_pipe(
+                            image=image,
+                            width=256,
+                            height=256,
+                        )
+                        # get the CLIP embedding for the variation and use it for x
+                        clip_aug = clip_extractor.embed_image(image_aug, cache=False).float()
+
+                        loss, pred = diffusion_prior(text_embed=clip_aug, image_embed=image_clip)
+                        loss_on_aug.append(loss.item())
+                    else:
+                        loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
+                        loss_off_aug.append(loss.item())
+
+                elif clip_aug_mode == 'y':
+                    # the input x is fixed, and we will change the target y
+                    if random.random() < clip_aug_prob:
+                        _, clip_pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
+
+                        # get an image variation
+                        image_aug = sd_pipe(
+                            # duplicate the embedding to serve classifier free guidance
+                            image_embeddings=torch.cat([torch.zeros_like(clip_pred), clip_pred]).unsqueeze(1),
+                            width=256,
+                            height=256,
+                        )
+                        # get the CLIP embedding for the variation and use it for y
+                        clip_aug = clip_extractor.embed_image(image_aug, cache=False).float()
+
+                        loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=clip_aug)
+                        loss_on_aug.append(loss.item())
+                    else:
+                        loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
+                        loss_off_aug.append(loss.item())
                 else:
                     loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
-                    loss_off_aug.append(loss.item())
-            else:
-                loss, pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
 
-            loss.backward()
-            optimizer.step()
+            # the prior's mse loss in fp32
+            loss = loss.float()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             if lr_scheduler is not None:
                 lr_scheduler.step() 
 
+            with torch.no_grad():
+                sim, sim_base = sim_metrics(image_clip, pred, clip_embed)
             losses.append(loss.item())
             lrs.append(optimizer.param_groups[0]['lr'])
-            sims.append(F.cosine_similarity(image_clip, pred).mean().item())
-            sims_base.append(F.cosine_similarity(image_clip, clip_embed).mean().item())
+            sims.append(sim.item())
+            sims_base.append(sim_base.item())
+            step_times.append(time.time() - t_step)
             
         diffusion_prior.eval()
         for val_i, (val_voxel, val_image) in enumerate(val_dl):    
-            with torch.no_grad(): 
-                val_image = val_image.to(device)
-
-                clip_embed = brain_net(val_voxel.to(device).float())
+            with torch.no_grad(), utils.get_autocast(precision, device):
+                clip_embed = brain_net(val_voxel)
                 #clip_embed = nn.functional.normalize(clip_embed,dim=-1)
                 # clip_embed = clip_extractor.embed_curated_annotations(subj01_annots[voxel])
 
-                image_clip = clip_extractor.embed_image(val_image).float()
+                if clip_emb_dir is None:
+                    image_clip = clip_extractor.embed_image(val_image).float()
+                else:
+                    image_clip = val_image.float() # already a CLIP embedding
 
                 val_loss, val_pred = diffusion_prior(text_embed=clip_embed, image_embed=image_clip)
 
-                val_losses.append(val_loss.item())
-                val_sims.append(F.cosine_similarity(image_clip, val_pred).mean().item())
-                val_sims_base.append(F.cosine_similarity(image_clip, clip_embed).mean().item())
+            val_sim, val_sim_base = sim_metrics(image_clip, val_pred, clip_embed)
+            val_losses.append(val_loss.item())
+            val_sims.append(val_sim.item())
+            val_sims_base.append(val_sim_base.item())
                 
         if ckpt_saving:
             # save best model
@@ -386,7 +457,17 @@ if __name__ == '__main__':
             "train/num_steps": len(losses),
             "train/loss_on_aug": np.mean(loss_on_aug),
             "train/loss_off_aug": np.mean(loss_off_aug),
+            "train/data_wait_frac": train_dl.wait_fraction(),
         }
+        print(f"epoch {epoch}: waited {train_dl.wait_time:.1f}s for training data ({100 * train_dl.wait_fraction():.0f}%)")
+        clip_stats = clip_extractor.cache_stats()
+        if clip_stats is not None:
+            print(f"epoch {epoch}: CLIP embedding cache hit rate {100 * clip_stats['hit_rate']:.0f}% ({clip_stats['misses']} misses)")
+            logs["train/clip_cache_hit_rate"] = clip_stats['hit_rate']
+        if compile:
+            # the epoch's first step (compiling, or recompiling) against its steady state step time
+            logs.update(utils.compile_report(step_times, compiled))
+            step_times = []
 
         # sample some images
         if (not save_samples_at_end and n_samples_save > 0) or (save_samples_at_end and epoch == num_epochs - 1):
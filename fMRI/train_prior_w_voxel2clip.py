@@ -4,6 +4,7 @@ Train one single network that includes the voxel2clip mapper and the diffusion p
 import os
 import sys
 import json
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -16,6 +17,11 @@ from dalle2_pytorch import DiffusionPriorNetwork
 
 import ddp_config
 import utils
+import clip_cache
+import voxel_stats as voxel_stats_lib
+import brain_mask as brain_mask_lib
+import checkpointing
+import loaders
 from models import Clipper, BrainNetwork, BrainDiffusionPrior, BrainSD
 from model3d import NewVoxel3dConvEncoder
 
@@ -30,6 +36,8 @@ alpha_schedule = "constant" # ("constant", "linear") - for weighting the loss
 # -- for voxel2clip model
 voxel2clip_kwargs = dict(
     out_dim=768,
+    # rank=256, # voxel_dims=1 only: factorized input projection (models.LowRankLinear)
+    # roi_index=8, # voxel_dims=1 only: ROI block-diagonal input layer (models.RoiBlockLinear), or a .npy ROI map
 )
 # -- for diffusion prior - these are ignored when pretrained=True
 pretrained = True # use pretrained prior
@@ -44,9 +52,29 @@ voxel_dims = 1 # (1, 3)
 n_samples_save = 8 # how many SD samples from train and val to save
 # -- params for data
 remote_data = False # pull data from huggingface if True
+shard_root = '/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split' # local shards, used when remote_data=False
 data_commit = '9947586218b6b7c8cab804009ddca5045249a38d' # only applies when remote_data=True
 cache_dir = "/tmp/wds-cache"
-n_cache_recs = 0
+shard_cache_gb = 50.0 # disk budget for cached remote shards
+prefetch_shards = 2 # remote shards to download ahead of the one being read
+shard_mirror = '' # local directory with copies of (some of) the remote shards
+val_cache_gb = 2.0 # keep the decoded validation batches in RAM after the first epoch
+train_cache_gb = 0.0 # same for the first training epoch, replayed in a new order every epoch
+clip_emb_cache_dir = '' # root written by precompute_clip_embs.py, empty to run CLIP every step
+clip_lru_size = 0 # Clipper LRU of the last N image embeddings (the val images repeat every epoch), 0 for none
+clip_lru_dir = '' # on-disk tier of that cache, kept between runs
+clip_lru_disk_gb = 1.0 # disk budget of that tier, least recently used embeddings are removed past it
+voxel_store_dir = '' # written by pack_voxels.py, empty to read voxels from the tar shards
+image_decode = 'pil' # ('pil', 'batched', 'predecoded') see utils.decode_stages
+voxel_stats_dir = '' # from compute_voxel_stats.py, z-scores the voxels (and dequantizes quantize_voxels.py shards)
+brain_mask_path = '' # from make_brain_mask.py, crops the 3D volumes (voxel_dims=3) to the brain
+mask_level = 0 # pyramid level of the cropped volumes, each level halves the resolution
+sparse_conv = False # with brain_mask_path, run the 3D conv blocks only over the voxels in the mask
+checkpoint_voxel2clip = 'none' # ('none', 'all', 'everyK') activation checkpointing of the voxel2clip blocks, see checkpointing.py
+checkpoint_prior = 'none' # same for the prior's transformer layers
+compile = False # torch.compile voxel2clip, the prior's p_losses and the loss/metrics, eager where that fails
+compile_cache_dir = '~/.cache/medical/torch_compile' # compile caches kept between runs
+precision = 'fp16' if torch.cuda.is_available() else 'fp32' # ('fp32', 'bf16', 'fp16') autocast mode, bf16 also works on the cpu
 # -----------------------------------------------------------------------------
 # params for all models
 seed = 0
@@ -104,10 +132,29 @@ with open(os.path.join(outdir, 'config.json'), 'w') as f:
 print('Creating Clipper...')
 # Don't L2 norm the extracted CLIP embeddings since we want the prior 
 # to learn un-normed embeddings for usage with the SD image variation pipeline.
-clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=False)
+clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=False,
+                         cache_size=clip_lru_size, cache_dir=clip_lru_dir or None,
+                         cache_disk_bytes=int(clip_lru_disk_gb * 1e9))
+
+if clip_emb_cache_dir:
+    # the loaders yield precomputed CLIP embeddings in place of the images
+    clip_emb_dir = clip_cache.get_cache_dir(clip_emb_cache_dir, clip_extractor.get_config())
+else:
+    clip_emb_dir = None
 
 print('Creating voxel2clip...')
 
+assert not sparse_conv or (voxel_dims == 3 and brain_mask_path), "sparse_conv needs voxel_dims=3 and a brain_mask_path"
+if voxel_dims == 3 and brain_mask_path:
+    brain_mask = brain_mask_lib.load_mask(os.path.expanduser(brain_mask_path))
+    # the encoder sees the cropped volumes, not the full ones
+    voxel2clip_kwargs['dims'] = brain_mask.dims(mask_level)
+    print(brain_mask, "level", mask_level, "dims", voxel2clip_kwargs['dims'])
+    if sparse_conv:
+        voxel2clip_kwargs['mask'] = brain_mask.level_mask(mask_level)
+else:
+    brain_mask = None
+
 if voxel_dims == 1:
     voxel2clip = BrainNetwork(**voxel2clip_kwargs)
     # 134M params
@@ -166,6 +213,12 @@ try:
 except:
     print('Cannot count params for diffusion_prior (probably because it has Lazy layers)')
 
+# recompute the activations of these blocks in backward instead of keeping them, for bigger batches
+print("checkpointed voxel2clip blocks", checkpointing.apply_checkpointing(diffusion_prior.voxel2clip, checkpoint_voxel2clip))
+print("checkpointed prior layers", checkpointing.apply_checkpointing(diffusion_prior, checkpoint_prior))
+if precision != 'fp32':
+    utils.keep_norms_fp32(diffusion_prior)
+
 if 1:
     print('Creating SD image variation pipeline...')
     sd_pipe = BrainSD.from_pretrained(
@@ -203,8 +256,8 @@ if remote_data:
     train_url, val_url = utils.get_huggingface_urls(data_commit)
 else:
     # local paths
-    train_url = "/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split/train/train_subj01_{0..49}.tar"
-    val_url = "/scratch/gpfs/KNORMAN/webdataset_nsd/webdataset_split/val/val_subj01_0.tar"
+    train_url = f"{shard_root}/train/train_subj01_{{0..49}}.tar"
+    val_url = f"{shard_root}/val/val_subj01_0.tar"
 
 # which to use for the voxels
 if voxel_dims == 1:
@@ -214,25 +267,42 @@ elif voxel_dims == 3:
 else:
     raise Exception(f"voxel_dims must be 1 or 3, not {voxel_dims}")
 
+if voxel_stats_dir:
+    # the models train on z-scored voxels, inference has to normalize with the same stats
+    voxel_stats = voxel_stats_lib.VoxelStats.load(voxel_stats_lib.stats_path(os.path.expanduser(voxel_stats_dir), voxels_key))
+else:
+    voxel_stats = None
+
 train_dl, val_dl = utils.get_dataloaders(
     batch_size, image_var, 
     num_workers=num_workers,
     train_url=train_url,
     val_url=val_url,
     cache_dir=cache_dir,
-    n_cache_recs=n_cache_recs,
+    val_cache_bytes=int(val_cache_gb * 1e9),
+    train_cache_bytes=int(train_cache_gb * 1e9),
+    shard_cache_bytes=int(shard_cache_gb * 1e9),
+    prefetch_shards=prefetch_shards,
+    shard_mirrors=[shard_mirror] if shard_mirror else None,
     voxels_key=voxels_key,
+    clip_emb_dir=clip_emb_dir,
+    clip_config=clip_extractor.get_config(),
+    voxel_store_dir=voxel_store_dir or None,
+    seed=seed,
+    image_decode=image_decode,
+    voxel_stats=voxel_stats,
+    brain_mask=brain_mask,
+    mask_level=mask_level,
 )
 
 optimizer = torch.optim.AdamW(diffusion_prior.parameters(), lr=initial_lr)
 if lr_scheduler == 'fixed':
     lr_scheduler = None
 elif lr_scheduler == 'cycle':
-    # <TODO> hard-coded values
     lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
         optimizer, 
         max_lr=max_lr, 
-        total_steps=num_epochs*((24983//batch_size)//num_devices), 
+        total_steps=num_epochs*len(train_dl), 
         final_div_factor=1000,
         last_epoch=-1, pct_start=2/num_epochs
     )
@@ -267,6 +337,33 @@ epoch = 0
 losses, val_losses, lrs = [], [], []
 best_val_loss = 1e9
 nce = InfoNCE()
+scaler = utils.get_grad_scaler(precision)
+
+def nce_and_metrics(clip_voxels, clip_image, pred):
+    """Contrastive loss, cosine similarities after / before the prior and top 1 accuracies, in fp32"""
+    clip_voxels, clip_image, pred = clip_voxels.float(), clip_image.float(), pred.float()
+    loss_nce = nce(
+        nn.functional.normalize(clip_voxels, dim=-1), 
+        nn.functional.normalize(clip_image, dim=-1),
+    )
+    # similarity after prior diffusion
+    sim = F.cosine_similarity(clip_image, pred).mean()
+    # baseline similarity before prior diffusion
+    sim_base = F.cosine_similarity(clip_image, clip_voxels).mean()
+    # forward and backward top 1 accuracy
+    labels = torch.arange(len(clip_voxels), device=clip_voxels.device)
+    fwd = utils.topk(utils.batchwise_cosine_similarity(clip_image, clip_voxels), labels, k=1)
+    bwd = utils.topk(utils.batchwise_cosine_similarity(clip_voxels, clip_image), labels, k=1)
+    return loss_nce, sim, sim_base, fwd, bwd
+
+compiled = []
+if compile:
+    utils.setup_compile_cache(compile_cache_dir)
+    diffusion_prior.voxel2clip = utils.compile_with_fallback(diffusion_prior.voxel2clip, 'voxel2clip')
+    diffusion_prior.p_losses = utils.compile_with_fallback(diffusion_prior.p_losses, 'p_losses')
+    nce_and_metrics = utils.compile_with_fallback(nce_and_metrics, 'nce_and_metrics')
+    compiled = [diffusion_prior.voxel2clip.forward, diffusion_prior.p_losses, nce_and_metrics]
+step_times = []
 
 # weight for prior's MSE loss term
 if alpha_schedule == 'constant':
@@ -298,6 +395,10 @@ if first_batch:
     train_dl = [(voxel0[:bs], image0[:bs])]
     val_dl = [(val_voxel0[:bs], val_image0[:bs])]
 
+# copy the next batch to the gpu (and convert it there) while the current step runs
+train_dl = loaders.DevicePrefetcher(train_dl, device)
+val_dl = loaders.DevicePrefetcher(val_dl, device)
+
 def check_loss(loss):
     if loss.isnan().any():
         raise ValueError('NaN loss')
@@ -324,49 +425,45 @@ for epoch in progress_bar:
     alpha = alphas[epoch]
 
     for train_i, (voxel, image) in enumerate(train_dl):
+        t_step = time.time()
         optimizer.zero_grad()
-        
-        image = image.to(device).float()
-        voxel = voxel.to(device).float()
 
-        with torch.cuda.amp.autocast():
-            clip_image = clip_extractor.embed_image(image).float()
+        with utils.get_autocast(precision, device):
+            if clip_emb_dir is None:
+                clip_image = clip_extractor.embed_image(image).float()
+            else:
+                clip_image = image # already a CLIP embedding
             loss, pred, clip_voxels = diffusion_prior(image_embed=clip_image, voxel=voxel)
-            check_loss(loss)
 
-            loss_nce = nce(
-                nn.functional.normalize(clip_voxels, dim=-1), 
-                nn.functional.normalize(clip_image, dim=-1),
-            )
-            check_loss(loss_nce)
-
-            loss_nce_sum += loss_nce.item()
-            loss_prior_sum += loss.item()
-
-            # MSE and NCE are weighted equally at the beginning,
-            # with alpha=0.01 we'll have something like .01*300 + .99*3 = 3 + 3
-            loss = alpha * loss + (1-alpha) * loss_nce
-
-            losses.append(loss.item())
-            lrs.append(optimizer.param_groups[0]['lr'])
-            # similarity after prior diffusion
-            sims += F.cosine_similarity(clip_image, pred).mean().item()
-            # baseline similarity before prior diffusion
-            sims_base += F.cosine_similarity(clip_image, clip_voxels).mean().item()
-            # forward and backward top 1 accuracy
-            labels = torch.arange(len(clip_voxels)).to(device)
-            fwd_percent_correct += utils.topk(
-                utils.batchwise_cosine_similarity(clip_image, clip_voxels), labels, k=1
-            )
-            bwd_percent_correct += utils.topk(
-                utils.batchwise_cosine_similarity(clip_voxels, clip_image), labels, k=1
-            )
+        # the loss and metrics in fp32
+        loss = loss.float()
+        check_loss(loss)
+
+        loss_nce, sim, sim_base, fwd, bwd = nce_and_metrics(clip_voxels, clip_image, pred)
+        check_loss(loss_nce)
+
+        loss_nce_sum += loss_nce.item()
+        loss_prior_sum += loss.item()
+
+        # MSE and NCE are weighted equally at the beginning,
+        # with alpha=0.01 we'll have something like .01*300 + .99*3 = 3 + 3
+        loss = alpha * loss + (1-alpha) * loss_nce
+
+        losses.append(loss.item())
+        lrs.append(optimizer.param_groups[0]['lr'])
+        sims += sim.item()
+        sims_base += sim_base.item()
+        fwd_percent_correct += fwd
+        bwd_percent_correct += bwd
 
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
         
         if lr_scheduler is not None:
             lr_scheduler.step()
+        # .item() above synced with the gpu, so this is close to the step time
+        step_times.append(time.time() - t_step)
 
         logs = OrderedDict(
             train_loss=np.mean(losses[-(train_i+1):]),
@@ -383,32 +480,25 @@ for epoch in progress_bar:
     diffusion_prior.eval()
     for val_i, (voxel, image) in enumerate(val_dl):    
         with torch.no_grad():
-            image = image.to(device).float()
-            voxel = voxel.to(device).float()
-
-            with torch.cuda.amp.autocast():
-                clip_image = clip_extractor.embed_image(image).float()
+            with utils.get_autocast(precision, device):
+                if clip_emb_dir is None:
+                    clip_image = clip_extractor.embed_image(image).float()
+                else:
+                    clip_image = image # already a CLIP embedding
                 loss, pred, clip_voxels = diffusion_prior(image_embed=clip_image, voxel=voxel)
 
-                loss_nce = nce(
-                    nn.functional.normalize(clip_voxels, dim=-1), 
-                    nn.functional.normalize(clip_image, dim=-1),
-                )
-                val_loss_nce_sum += loss_nce.item()
-                val_loss_prior_sum += loss.item()
-
-                val_loss = alpha * loss + (1-alpha) * loss_nce
-
-                val_losses.append(val_loss.item())
-                val_sims += F.cosine_similarity(clip_image, pred).mean().item()
-                val_sims_base += F.cosine_similarity(clip_image, clip_voxels).mean().item()
-                labels = torch.arange(len(clip_voxels)).to(device)
-                val_fwd_percent_correct += utils.topk(
-                    utils.batchwise_cosine_similarity(clip_image, clip_voxels), labels, k=1
-                )
-                val_bwd_percent_correct += utils.topk(
-                    utils.batchwise_cosine_similarity(clip_voxels, clip_image), labels, k=1
-                )
+            loss = loss.float()
+            loss_nce, sim, sim_base, fwd, bwd = nce_and_metrics(clip_voxels, clip_image, pred)
+            val_loss_nce_sum += loss_nce.item()
+            val_loss_prior_sum += loss.item()
+
+            val_loss = alpha * loss + (1-alpha) * loss_nce
+
+            val_losses.append(val_loss.item())
+            val_sims += sim.item()
+            val_sims_base += sim_base.item()
+            val_fwd_percent_correct += fwd
+            val_bwd_percent_correct += bwd
     
         logs = OrderedDict(
             train_loss=np.mean(losses[-(train_i+1):]),
@@ -453,10 +543,20 @@ for epoch in progress_bar:
         "val/loss_nce": val_loss_nce_sum / (val_i + 1),
         "val/loss_prior": val_loss_prior_sum / (val_i + 1),
         "train/alpha": alpha,
+        "train/data_wait_frac": train_dl.wait_fraction(),
     }
-
-    # sample some images
-    if sd_pipe is not None:
+    print(f"epoch {epoch}: waited {train_dl.wait_time:.1f}s for training data ({100 * train_dl.wait_fraction():.0f}%)")
+    clip_stats = clip_extractor.cache_stats()
+    if clip_stats is not None:
+        print(f"epoch {epoch}: CLIP embedding cache hit rate {100 * clip_stats['hit_rate']:.0f}% ({clip_stats['misses']} misses)")
+        logs["train/clip_cache_hit_rate"] = clip_stats['hit_rate']
+    if compile:
+        # the epoch's first step (compiling, or recompiling) against its steady state step time
+        logs.update(utils.compile_report(step_times, compiled))
+        step_times = []
+
+    # sample some images (needs the real images, so not possible with cached embeddings)
+    if sd_pipe is not None and clip_emb_dir is None:
         if (not save_at_end and n_samples_save > 0) or (save_at_end and epoch == num_epochs - 1):
             # training
             grids = utils.sample_images(
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import time
 import numpy as np
 import torch
 import torch.nn as nn
@@ -15,6 +16,10 @@ from info_nce import InfoNCE
 
 import ddp_config
 import utils
+import clip_cache
+import voxel_stats as voxel_stats_lib
+import loaders
+import checkpointing
 from models import Clipper, BrainNetwork, NewVoxel3dConvEncoder
 
 if __name__ == '__main__':
@@ -25,6 +30,23 @@ if __name__ == '__main__':
     clamp_embs = False # clamp embeddings to (-1.5, 1.5)
     img_augmenting = True # augment images with random crops
     soft_clip = False
+    clip_emb_cache_dir = '' # root written by precompute_clip_embs.py, empty to run CLIP every step
+    clip_lru_size = 0 # Clipper LRU of the last N image embeddings (the val images repeat every epoch), 0 for none
+    clip_lru_dir = '' # on-disk tier of that cache, kept between runs
+    clip_lru_disk_gb = 1.0 # disk budget of that tier, least recently used embeddings are removed past it
+    voxel_store_dir = '' # written by pack_voxels.py, empty to read voxels from the tar shards
+    image_decode = 'pil' # ('pil', 'batched', 'predecoded') see utils.decode_stages
+    voxel_stats_dir = '' # from compute_voxel_stats.py, z-scores the voxels (and dequantizes quantize_voxels.py shards)
+    voxel2clip_kwargs = dict(
+        out_dim=768,
+        # rank=256, # factorized input projection (models.LowRankLinear), see convert_lowrank.py
+        # roi_index='~/data/neuro/nsdgeneral_rois.npy', # or a number of blocks, ROI block-diagonal input layer (models.RoiBlockLinear)
+    )
+    init_ckpt = '' # model weights to start from (not the optimizer etc. like resume), e.g. from convert_lowrank.py
+    checkpoint_voxel2clip = 'none' # ('none', 'all', 'everyK') activation checkpointing of the residual blocks, see checkpointing.py
+    compile = False # torch.compile brain_net and the contrastive loss, eager where that fails
+    precision = 'fp16' if torch.cuda.is_available() else 'fp32' # ('fp32', 'bf16', 'fp16') autocast mode, bf16 also works on the cpu
+    compile_cache_dir = '~/.cache/medical/torch_compile' # compile caches kept between runs
 
     seed = 0
     batch_size = 300
@@ -42,6 +64,8 @@ if __name__ == '__main__':
     first_batch = False
     ckpt_saving = True
     ckpt_interval = None
+    ckpt_steps = 0 # also save ckpt-last.pth every this many steps, so a preempted run can resume mid-epoch
+    resume = '' # checkpoint to resume from, e.g. <outdir>/ckpt-last.pth
     outdir = os.path.expanduser(f'~/data/neuro/models/{model_name}/test')
 
     # -----------------------------------------------------------------------------
@@ -74,7 +98,22 @@ if __name__ == '__main__':
     os.makedirs(outdir, exist_ok=True)
 
     # load clipper
-    clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=norm_embs)
+    clip_extractor = Clipper(clip_variant, clamp_embs=clamp_embs, norm_embs=norm_embs,
+                             cache_size=clip_lru_size, cache_dir=clip_lru_dir or None,
+                             cache_disk_bytes=int(clip_lru_disk_gb * 1e9))
+
+    if clip_emb_cache_dir:
+        # the loaders yield precomputed CLIP embeddings in place of the images
+        assert not img_augmenting, "cached embeddings are of the unaugmented images, use img_augmenting=False"
+        clip_emb_dir = clip_cache.get_cache_dir(clip_emb_cache_dir, clip_extractor.get_config())
+    else:
+        clip_emb_dir = None
+
+    if voxel_stats_dir:
+        # the models train on z-scored voxels, inference has to normalize with the same stats
+        voxel_stats = voxel_stats_lib.VoxelStats.load(voxel_stats_lib.stats_path(os.path.expanduser(voxel_stats_dir), 'nsdgeneral.npy'))
+    else:
+        voxel_stats = None
 
     # # load COCO annotations curated in the same way as the mind_reader (Lin Sprague Singh) preprint
     # f = h5py.File('/scratch/gpfs/KNORMAN/nsdgeneral_hdf5/COCO_73k_subj_indices.hdf5', 'r')
@@ -83,16 +122,35 @@ if __name__ == '__main__':
     # annots = np.load('/scratch/gpfs/KNORMAN/nsdgeneral_hdf5/COCO_73k_annots_curated.npy',allow_pickle=True)
     # subj01_annots = annots[subj01_order]
 
-    train_dl, val_dl = utils.get_dataloaders(batch_size, image_var, num_workers=num_workers)
-
-    # get first batches
-    for train_i, (voxel0, image0) in enumerate(train_dl):
-        break
+    train_dl, val_dl = utils.get_dataloaders(
+        batch_size, image_var, 
+        num_workers=num_workers,
+        clip_emb_dir=clip_emb_dir,
+        clip_config=clip_extractor.get_config(),
+        voxel_store_dir=voxel_store_dir or None,
+        seed=seed,
+        image_decode=image_decode,
+        voxel_stats=voxel_stats,
+    )
+
+    # get first batch (the training one only for first_batch, a resumed loader must not
+    # have started its workers before its state is loaded)
     for val_i, (val_voxel0, val_image0) in enumerate(val_dl):
         break
 
     # voxel2clip mapper model
-    brain_net = BrainNetwork(768) 
+    brain_net = BrainNetwork(**voxel2clip_kwargs)
+    if init_ckpt:
+        print("initializing from", init_ckpt)
+        brain_net.load_state_dict(torch.load(init_ckpt, map_location='cpu')['model_state_dict'])
+    # recompute the activations of these blocks in backward instead of keeping them, for bigger batches
+    print("checkpointed blocks", checkpointing.apply_checkpointing(brain_net, checkpoint_voxel2clip))
+    if precision != 'fp32':
+        utils.keep_norms_fp32(brain_net)
+    if compile:
+        # in place, before DDP wraps it and the checkpoints see its state_dict
+        utils.setup_compile_cache(compile_cache_dir)
+        brain_net = utils.compile_with_fallback(brain_net, 'brain_net')
     if using_ddp:
         brain_net0 = brain_net.to(local_rank)
         brain_net = DDP(brain_net0, device_ids=[local_rank])
@@ -109,9 +167,11 @@ if __name__ == '__main__':
     # brain_net.eval()
     # brain_net.requires_grad_(False)
 
-    def save_ckpt(tag):
+    def save_ckpt(tag, epoch_complete=True):
         ckpt_path = os.path.join(outdir, f'ckpt-{tag}.pth')
         print(f'saving {ckpt_path}')
+        # every rank is at the same position, so rank 0's loader state is everyone's
+        loader_state = loaders.get_loader_state(train_dl)
         if (using_ddp==False) or (using_ddp==True and local_rank==0):
             state_dict = brain_net.state_dict()
             if using_ddp: # if using DDP, convert DDP state_dict to non-DDP before saving
@@ -121,8 +181,14 @@ if __name__ == '__main__':
                         del state_dict[key]   
             torch.save({
                 'epoch': epoch,
-                'model_state_dict': diffusion_prior.state_dict(),
+                'epoch_complete': epoch_complete,
+                'model_state_dict': state_dict,
                 'optimizer_state_dict': optimizer.state_dict(),
+                'scaler_state_dict': scaler.state_dict(),
+                'lr_scheduler_state_dict': lr_scheduler.state_dict() if lr_scheduler is not None else None,
+                'loader_state': loader_state,
+                'rng_state': utils.get_rng_state(),
+                'best_val_loss': best_val_loss,
                 'train_losses': losses,
                 'val_losses': val_losses,
                 'lrs': lrs,
@@ -130,9 +196,9 @@ if __name__ == '__main__':
                 'val_sims': val_sims,
                 }, ckpt_path)
             
-            if using_ddp:
-                # this tells the other gpus wait for the first gpu to finish saving the model
-                dist.barrier()
+        if using_ddp:
+            # this tells the other gpus wait for the first gpu to finish saving the model
+            dist.barrier()
 
     utils.count_params(brain_net)
 
@@ -140,11 +206,10 @@ if __name__ == '__main__':
     if lr_scheduler == 'fixed':
         lr_scheduler = None
     elif lr_scheduler == 'cycle':
-        # <TODO> hard-coded values
         lr_scheduler = torch.optim.lr_scheduler.OneCycleLR(
             optimizer, 
             max_lr=max_lr, 
-            total_steps=num_epochs*((24983//batch_size)//num_devices), 
+            total_steps=num_epochs*len(train_dl), 
             final_div_factor=1000,
             last_epoch=-1, pct_start=2/num_epochs
         )
@@ -154,15 +219,34 @@ if __name__ == '__main__':
     sims, val_sims = [], []
     best_val_loss = 1e9
     nce = InfoNCE(temperature=0.01)
-
-    # resume from checkpoint:
-    # prior_checkpoint = torch.load(ckpt_path, map_location=device)
-    # brain_net.load_state_dict(prior_checkpoint['model_state_dict'])
-    # optimizer.load_state_dict(prior_checkpoint['optimizer_state_dict'])
-    # lr = prior_checkpoint['lr']
-    # epoch = prior_checkpoint['epoch']+1
-    # losses = prior_checkpoint['train_losses']
-    # optimizer.param_groups[0]['lr'] = lr
+    scaler = utils.get_grad_scaler(precision)
+    compiled = []
+    if compile:
+        nce = utils.compile_with_fallback(nce, 'nce')
+        compiled = [(brain_net.module if using_ddp else brain_net).forward, nce.forward]
+    step_times = []
+
+    if resume:
+        print("resuming from", resume)
+        checkpoint = torch.load(resume, map_location='cpu')
+        (brain_net.module if using_ddp else brain_net).load_state_dict(checkpoint['model_state_dict'])
+        optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if checkpoint.get('scaler_state_dict'):
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+        if lr_scheduler is not None and checkpoint.get('lr_scheduler_state_dict') is not None:
+            lr_scheduler.load_state_dict(checkpoint['lr_scheduler_state_dict'])
+        # a mid-epoch checkpoint continues its epoch where it left off
+        epoch = checkpoint['epoch'] + (1 if checkpoint.get('epoch_complete', True) else 0)
+        losses, val_losses, lrs = checkpoint['train_losses'], checkpoint['val_losses'], checkpoint['lrs']
+        sims, val_sims = checkpoint['sims'], checkpoint['val_sims']
+        best_val_loss = checkpoint.get('best_val_loss', best_val_loss)
+        if checkpoint.get('loader_state') is not None:
+            loaders.set_loader_state(train_dl, checkpoint['loader_state'])
+        else:
+            print("no loader state in the checkpoint, the epoch restarts from its first batch")
+        if checkpoint.get('rng_state') is not None:
+            utils.set_rng_state(checkpoint['rng_state'])
+        del checkpoint
 
     if wandb_log:
         import wandb
@@ -175,11 +259,16 @@ if __name__ == '__main__':
         )
 
     if first_batch:
+        for train_i, (voxel0, image0) in enumerate(train_dl):
+            break
         # fake DataLoaders with just the first batches
         bs = 5
         train_dl = [(voxel0[:bs], image0[:bs])]
         val_dl = [(val_voxel0[:bs], val_image0[:bs])]
 
+    # copy the next batch to the gpu (and convert it there) while the current step runs
+    train_dl = loaders.DevicePrefetcher(train_dl, device)
+
     def check_loss(loss):
         if loss.isnan().any():
             raise ValueError('NaN loss')
@@ -193,46 +282,57 @@ if __name__ == '__main__':
         loss_on_aug, loss_off_aug, aug_pairs = [], [], []
 
         for train_i, (voxel, image) in enumerate(train_dl):
+            t_step = time.time()
             optimizer.zero_grad()
-            image = image.to(device)
-            
-            with torch.cuda.amp.autocast():
-                if image_var=='images': # using images
+            with utils.get_autocast(precision, device):
+                if clip_emb_dir is not None:
+                    emb = image.float() # already a CLIP embedding
+                elif image_var=='images': # using images
                     if img_augmenting:
-                        img_input = utils.img_augment(img_input)
-                    emb = clip_extractor.embed_image(img_input)
+                        image = utils.img_augment(image)
+                    # augmented images never repeat, caching them would only cost a hash
+                    emb = clip_extractor.embed_image(image, cache=not img_augmenting)
                 else: 
                     # using text captions of the images 
                     # emb = clip_extractor.embed_curated_annotations(subj01_annots[img_input])
                     raise NotImplementedError()
 
                 emb_ = brain_net(voxel)
+
+            # the loss and metrics in fp32
+            emb, emb_ = emb.float(), emb_.float()
                 
-                # l2 norm before doing cosine similarity
-                emb_ = nn.functional.normalize(emb_, dim=-1)
-                labels = torch.arange(len(emb)).to(device)
-
-                if soft_clip:
-                    if epoch<10:
-                        loss = nce(emb_.reshape(len(emb),-1),emb.reshape(len(emb),-1))
-                    else:
-                        loss = utils.soft_clip_loss(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
-                    # loss = nce(emb_.reshape(len(emb),-1),emb.reshape(len(emb),-1)) + \
-                    #        soft_clip_loss(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
-                else:
-                    loss = nce(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
-                check_loss(loss)
-                fwd_percent_correct = utils.topk(utils.batchwise_cosine_similarity(emb, emb_), labels, k=1)
-                bwd_percent_correct = utils.topk(utils.batchwise_cosine_similarity(emb_, emb), labels, k=1)
+            # l2 norm before doing cosine similarity
+            emb_ = nn.functional.normalize(emb_, dim=-1)
+            labels = torch.arange(len(emb)).to(device)
 
-            loss.backward()
-            optimizer.step()
+            if soft_clip:
+                if epoch<10:
+                    loss = nce(emb_.reshape(len(emb),-1),emb.reshape(len(emb),-1))
+                else:
+                    loss = utils.soft_clip_loss(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
+                # loss = nce(emb_.reshape(len(emb),-1),emb.reshape(len(emb),-1)) + \
+                #        soft_clip_loss(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
+            else:
+                loss = nce(emb_.reshape(len(emb),-1), emb.reshape(len(emb),-1))
+            check_loss(loss)
+            fwd_percent_correct = utils.topk(utils.batchwise_cosine_similarity(emb, emb_), labels, k=1)
+            bwd_percent_correct = utils.topk(utils.batchwise_cosine_similarity(emb_, emb), labels, k=1)
+
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             if lr_scheduler is not None:
                 lr_scheduler.step() 
 
             losses.append(loss.item())
             lrs.append(optimizer.param_groups[0]['lr'])
             sims.append(F.cosine_similarity(emb, emb_).mean().item())
+            # .item() synced with the gpu, so this is close to the step time
+            step_times.append(time.time() - t_step)
+
+            if ckpt_saving and ckpt_steps and len(losses) % ckpt_steps == 0:
+                save_ckpt('last', epoch_complete=False)
             
         # brain_net.eval()
         # for val_i, (val_voxel, val_image) in enumerate(val_dl):    
@@ -283,7 +383,17 @@ if __name__ == '__main__':
             "train/num_steps": len(losses),
             "train/loss_on_aug": np.mean(loss_on_aug),
             "train/loss_off_aug": np.mean(loss_off_aug),
+            "train/data_wait_frac": train_dl.wait_fraction(),
         }
+        print(f"epoch {epoch}: waited {train_dl.wait_time:.1f}s for training data ({100 * train_dl.wait_fraction():.0f}%)")
+        clip_stats = clip_extractor.cache_stats()
+        if clip_stats is not None:
+            print(f"epoch {epoch}: CLIP embedding cache hit rate {100 * clip_stats['hit_rate']:.0f}% ({clip_stats['misses']} misses)")
+            logs["train/clip_cache_hit_rate"] = clip_stats['hit_rate']
+        if compile:
+            # the epoch's first step (compiling, or recompiling) against its steady state step time
+            logs.update(utils.compile_report(step_times, compiled))
+            step_times = []
 
         if wandb_log:
             wandb.log(logs)
@@ -1,6 +1,7 @@
 import numpy as np
 from torchvision import transforms
 import torch
+import torchvision
 import torch.nn as nn
 import torch.nn.functional as F
 import PIL
@@ -9,18 +10,31 @@ import os
 import matplotlib.pyplot as plt
 import pandas as pd
 import math
+import time
+import resource
+import contextlib
+import inspect
+import functools
 import webdataset as wds
 import tempfile
 from torchvision.utils import make_grid
 
+import augment
+import clip_cache
+import voxel_store
+import shards
+import shard_cache
+import loaders
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-img_augment = transforms.Compose([
-                transforms.RandomCrop(size=(140,140)),
-                transforms.RandomHorizontalFlip(p=.5),
-                transforms.ColorJitter(.4,.4,.2,.1),
-                transforms.RandomGrayscale(p=.2),
-            ])
+# per-sample version of RandomCrop(140) + RandomHorizontalFlip(.5) + ColorJitter(.4,.4,.2,.1) + RandomGrayscale(.2)
+img_augment = augment.BatchAugment(
+                crop_size=(140,140),
+                flip_p=.5,
+                brightness=.4, contrast=.4, saturation=.2, hue=.1,
+                grayscale_p=.2,
+            )
 
 def seed_everything(seed=0, cudnn_deterministic=True):
     random.seed(seed)
@@ -29,12 +43,31 @@ def seed_everything(seed=0, cudnn_deterministic=True):
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
+    img_augment.generator.manual_seed(seed)
     if cudnn_deterministic:
         torch.backends.cudnn.deterministic = True
     else:
         ## needs to be False to use conv3D
         print('Note: not using cudnn.deterministic')
 
+def get_rng_state():
+    """All the random states a training run draws from, to resume it exactly"""
+    return dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        img_augment=img_augment.generator.get_state(),
+    )
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    img_augment.generator.set_state(state['img_augment'])
+
 def np_to_Image(x):
     if x.ndim==4:
         x=x[0]
@@ -115,6 +148,146 @@ def count_params(model):
     trainable = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print('param counts:\n{:,} total\n{:,} trainable'.format(total, trainable))
 
+def setup_compile_cache(cache_dir):
+    """
+    Keep torch.compile's inductor and triton caches in cache_dir rather than /tmp, with the
+    FX graph cache on, so later runs of the same models skip most of the compile warmup.
+    Call before the first compile.
+    """
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+    os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+    os.environ.setdefault('TRITON_CACHE_DIR', os.path.join(cache_dir, 'triton'))
+    print("compile cache", cache_dir)
+
+class CompiledFunction:
+    """
+    Calls the torch.compile'd version of fn, and the eager fn if torch has no compile or
+    compiling / running the compiled one fails (then for good). compile_time is the wall time
+    of the first call, which includes compiling.
+    """
+    def __init__(self, fn, name, **compile_kwargs):
+        self.eager = fn
+        self.name = name
+        self.compile_time = None
+        if hasattr(torch, 'compile'):
+            self.compiled = torch.compile(fn, **compile_kwargs)
+        else:
+            print(f"torch {torch.__version__} has no torch.compile, running {name} eagerly")
+            self.compiled = None
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is None:
+            return self.eager(*args, **kwargs)
+        t0 = time.time()
+        try:
+            out = self.compiled(*args, **kwargs)
+        except Exception as e:
+            print(f"compiling {self.name} failed, running it eagerly from now on: {type(e).__name__}: {e}")
+            self.compiled = None
+            return self.eager(*args, **kwargs)
+        if self.compile_time is None:
+            self.compile_time = time.time() - t0
+            print(f"compiled {self.name} in {self.compile_time:.1f}s")
+        return out
+
+def compile_with_fallback(fn, name, **compile_kwargs):
+    """
+    torch.compile a function, or a module's forward in place (its state_dict keys stay the
+    same, unlike with torch.compile(module)), falling back to eager, see CompiledFunction
+    """
+    if isinstance(fn, nn.Module):
+        fn.forward = CompiledFunction(fn.forward, name, **compile_kwargs)
+        return fn
+    return CompiledFunction(fn, name, **compile_kwargs)
+
+def compile_report(step_times, compiled):
+    """Compile times against the first and the steady state (median) step times, for logging"""
+    report = {f"compile/{c.name}_s": c.compile_time for c in compiled if c.compile_time is not None}
+    if step_times:
+        report["compile/first_step_s"] = step_times[0]
+    if len(step_times) > 1:
+        report["compile/steady_step_ms"] = float(np.median(step_times[1:])) * 1000
+    print("compile report:", ", ".join(f"{k} {v:.2f}" for k, v in report.items()))
+    return report
+
+PRECISIONS = ('fp32', 'bf16', 'fp16')
+
+def get_autocast(precision, device):
+    """
+    Autocast context of a precision mode on the device type of device (cpu autocast only
+    does bf16), a no-op for fp32. Call it for every new with block.
+    """
+    assert precision in PRECISIONS, f"precision must be one of {PRECISIONS}, not {precision}"
+    device_type = torch.device(device).type
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    assert not (precision == 'fp16' and device_type == 'cpu'), "fp16 autocast needs cuda, use bf16 on the cpu"
+    return torch.autocast(device_type, dtype=torch.bfloat16 if precision == 'bf16' else torch.float16)
+
+def get_grad_scaler(precision):
+    """
+    Loss scaling for fp16, whose small exponent range underflows small gradients. bf16 has
+    fp32's range and needs none: for bf16 and fp32 the scaler passes everything through.
+    """
+    return torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+def _norm_inputs_fp32(module, inputs):
+    return tuple(x.float() if torch.is_tensor(x) and x.is_floating_point() else x for x in inputs)
+
+def keep_norms_fp32(model):
+    """
+    Run the BatchNorm / LayerNorm / GroupNorm layers of model on fp32 inputs under autocast,
+    their statistics (and the residual streams they feed) lose too much in bf16 / fp16
+    """
+    norms = (nn.modules.batchnorm._BatchNorm, nn.LayerNorm, nn.GroupNorm)
+    for module in model.modules():
+        if isinstance(module, norms):
+            module.register_forward_pre_hook(_norm_inputs_fp32)
+    return model
+
+def measure_step(model, inputs, loss_fn, optimizer=None, steps=20, warmup=5, precision='fp16'):
+    """
+    Time a training step (forward, backward and optimizer step) of model on fixed inputs at
+    a precision mode (fp16 falls back to fp32 on the cpu), returning the mean step time in
+    ms, the peak gpu memory in MB (0 on the cpu) and the peak resident memory of the process.
+    loss_fn maps the model output to a scalar, which is taken in fp32.
+    """
+    if not isinstance(inputs, (tuple, list)):
+        inputs = (inputs,)
+    device = next(model.parameters()).device
+    if precision == 'fp16' and device.type == 'cpu':
+        precision = 'fp32'
+    if optimizer is None:
+        optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    scaler = get_grad_scaler(precision)
+    model.train()
+
+    def step():
+        optimizer.zero_grad(set_to_none=True)
+        with get_autocast(precision, device):
+            out = model(*inputs)
+        loss = loss_fn(out)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+    for _ in range(warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    t0 = time.time()
+    for _ in range(steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    step_ms = (time.time() - t0) / steps * 1000
+    peak_mb = torch.cuda.max_memory_allocated(device) / 2**20 if device.type == 'cuda' else 0.
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return dict(step_ms=step_ms, peak_mem_mb=peak_mb, peak_rss_mb=peak_rss_mb)
+
 def plot_brainnet(train_losses, train_fwd_topk, train_bwd_topk, val_losses, val_fwd_topk, val_bwd_topk, lrs):
     fig, (ax1, ax2, ax3, ax4, ax5, ax6, ax7) = plt.subplots(1, 7, figsize=(23,3))
     ax1.set_title(f"Training Loss\n(final={train_losses[-1]:.3f})")
@@ -182,29 +355,178 @@ def image_grid(imgs, rows, cols):
         grid.paste(img, box=(i%cols*w, i//cols*h))
     return grid
 
-def get_huggingface_urls(commit='9947586218b6b7c8cab804009ddca5045249a38d'):
+def get_huggingface_urls(commit='9947586218b6b7c8cab804009ddca5045249a38d', subj=1, num_train_shards=50):
     """
     You can use commit='main' is the most up to date data.
     Before the new data was added is commit "9947586218b6b7c8cab804009ddca5045249a38d".
     """
     base_url = "https://huggingface.co/datasets/pscotti/naturalscenesdataset/resolve/"
-    train_url = base_url + commit + "/webdataset/train/train_subj01_{0..49}.tar"
-    val_url = base_url + commit + "/webdataset/val/val_subj01_0.tar"
+    train_url = base_url + commit + f"/webdataset/train/train_subj{subj:02d}_{{0..{num_train_shards - 1}}}.tar"
+    val_url = base_url + commit + f"/webdataset/val/val_subj{subj:02d}_0.tar"
     return train_url, val_url
 
+# voxels in the nsdgeneral ROI of each NSD subject
+NSDGENERAL_VOXELS = {1: 15724, 2: 14278, 3: 15226, 4: 13153, 5: 13039, 6: 17907, 7: 12682, 8: 14386}
+
+# key of the uint8 [3, size, size] images written by predecode_images.py
+PREDECODED_IMAGE_KEY = "image_u8.npy"
+
+def decode_image_batch(images, device='cpu'):
+    """Decode a list of encoded jpg/png bytes into one uint8 [batch, 3, height, width] tensor"""
+    data = [torch.frombuffer(bytearray(image), dtype=torch.uint8) for image in images]
+    try:
+        # one call for the whole batch (torchvision>=0.19)
+        decoded = torchvision.io.decode_jpeg(data, mode=torchvision.io.ImageReadMode.RGB, device=device)
+    except (TypeError, RuntimeError):
+        # older torchvision, or pngs in the batch
+        decoded = [torchvision.io.decode_image(d, mode=torchvision.io.ImageReadMode.RGB).to(device) for d in data]
+    return torch.stack(decoded)
+
+def image_to_float(image):
+    """uint8 images from image_decode="batched"/"predecoded" to floats in [0, 1], best done on the device"""
+    if image.dtype == torch.uint8:
+        return image.float() / 255
+    return image.float()
+
+def get_fields(image_var, voxels_key, emb_cache=None, image_decode="pil"):
+    """Tar members a pipeline needs, everything else is dropped before decoding"""
+    fields = [voxels_key]
+    if emb_cache is not None:
+        return fields
+    if image_var == "images":
+        fields += [PREDECODED_IMAGE_KEY] if image_decode == "predecoded" else ["jpg", "png"]
+    else:
+        fields.append(f"{image_var}.npy")
+    return fields
+
+def is_selected_file(fname, fields):
+    # webdataset splits member names at the first dot into __key__ and field
+    return os.path.basename(fname).split('.', 1)[-1] in fields
+
+def project_fields(sample, fields):
+    return {k: v for k, v in sample.items() if k.startswith('__') or k in fields}
+
+def decode_stages(image_var, voxels_key, batch_size, emb_cache=None, image_decode="pil"):
+    """
+    Pipeline stages that decode webdataset samples into batches of (voxels, image_var)
+    tuples, or (voxels, clip_emb) if emb_cache is given.
+
+    image_decode picks how images are decoded:
+        "pil"        one at a time through PIL into float tensors
+        "batched"    a whole batch at a time by torchvision, kept as uint8
+        "predecoded" uint8 arrays from shards written by predecode_images.py
+    With "batched" and "predecoded" the images cross the worker boundary as uint8, use
+    image_to_float once they are on the device.
+    """
+    assert image_decode in ("pil", "batched", "predecoded"), f"unknown image_decode: {image_decode}"
+    if emb_cache is not None:
+        # images are swapped for their precomputed CLIP embeddings, so they are never decoded
+        return [
+            wds.decode("torch"),
+            wds.rename(voxels=voxels_key),
+            wds.to_tuple("voxels", "__key__"),
+            wds.batched(batch_size, partial=True),
+            # one sorted read of the memmap per batch of keys
+            wds.map_tuple(None, emb_cache.lookup),
+        ]
+    # only rename the fields that get_fields kept
+    renames = dict(voxels=voxels_key)
+    if image_var == "images":
+        renames["images"] = PREDECODED_IMAGE_KEY if image_decode == "predecoded" else "jpg;png"
+    else:
+        renames[image_var] = f"{image_var}.npy"
+    if image_decode in ("pil", "predecoded"):
+        return [
+            wds.decode("torch"),
+            wds.rename(**renames),
+            wds.to_tuple("voxels", image_var),
+            wds.batched(batch_size, partial=True),
+        ]
+    # batched: leave the jpgs as bytes until the batch is assembled
+    stages = [
+        wds.decode("torch", only=[voxels_key, "trial.npy"]),
+        wds.rename(**renames),
+        wds.to_tuple("voxels", image_var),
+        wds.batched(batch_size, partial=True),
+    ]
+    if image_var == "images":
+        stages.append(wds.map_tuple(None, decode_image_batch))
+    return stages
+
 def get_dataloaders(
     batch_size,
     image_var,
-    num_devices=None,
     num_workers=None,
     train_url=None,
     val_url=None,
     cache_dir="/tmp/wds-cache",
-    n_cache_recs=0,
+    val_cache_bytes=int(2e9),
+    train_cache_bytes=0,
+    cache_spill_dir=None,
     voxels_key="nsdgeneral.npy",
+    clip_emb_dir=None,
+    clip_config=None,
+    voxel_store_dir=None,
+    rank=None,
+    world_size=None,
+    seed=0,
+    image_decode="pil",
+    fields=None,
+    shard_cache_bytes=int(50e9),
+    prefetch_shards=2,
+    shard_mirrors=None,
+    brain_mask=None,
+    mask_level=0,
+    voxel_stats=None,
+    subject=1,
+    subjects=None,
+    subject_weights=None,
 ):
+    """
+    Every epoch reads each sample exactly once (see shards.py). Under DDP the training
+    shards are split across ranks, with rank and world_size taken from torch.distributed
+    unless given. len() of the returned loaders is an upper bound on batches per epoch.
+
+    If clip_emb_dir is given (see clip_cache.get_cache_dir), the loaders yield
+    (voxels, clip_emb) using the embeddings written by precompute_clip_embs.py
+    instead of (voxels, images). Pass clip_config=Clipper.get_config() to check
+    that the cached embeddings were made with the same Clipper settings.
+
+    If voxel_store_dir is given (see pack_voxels.py), the voxels are read from the
+    memory-mapped store instead of the tar shards. The store has no images, so the
+    second item is the cached CLIP embedding or, for image_var="trial", the trial.
+
+    image_decode is "pil", "batched" or "predecoded", see decode_stages.
+
+    Only the tar members in fields (e.g. ["nsdgeneral.npy", "jpg", "png"]) are read and
+    decoded. It defaults to what image_var, voxels_key and the embedding cache need, see get_fields.
+
+    Remote shards go through a shard_cache.ShardCache in cache_dir, which keeps at most
+    shard_cache_bytes on disk, downloads the next prefetch_shards shards in the background
+    and reads shards from the local shard_mirrors directories when they are there.
+
+    The decoded batches of the first full validation pass are kept in RAM (up to
+    val_cache_bytes, then spilled to cache_spill_dir if given) and reused every epoch,
+    see loaders.CachedLoader. train_cache_bytes > 0 does the same for the first training
+    epoch, replaying its batches in a new order each epoch.
+
+    With a brain_mask (brain_mask.BrainMask) the 3D volumes are cropped to the mask and
+    pooled to pyramid level mask_level in the workers, so they have shape brain_mask.dims(mask_level).
+
+    With voxel_stats (voxel_stats.VoxelStats) the voxels come out as float16 z-scores:
+    shards written by quantize_voxels.py are dequantized and raw float voxels normalized.
+    Voxel stores packed with --quantize use the stats stored with them.
+
+    subject picks the default (Hugging Face) urls and the sample counts. To train on
+    several subjects pass subjects (e.g. [1, 2, 5, 7]) with train_url and val_url as dicts
+    from subject to url (or None for the Hugging Face urls), see get_multisubject_dataloaders.
+    """
+    if subjects is not None:
+        kwargs = {k: v for k, v in locals().items() if k not in ('subject', 'subjects', 'subject_weights', 'train_url', 'val_url')}
+        return get_multisubject_dataloaders(subjects, subject_weights, train_url, val_url, **kwargs)
+
     print("Getting dataloaders...")
-    train_url_hf, val_url_hf = get_huggingface_urls()
+    train_url_hf, val_url_hf = get_huggingface_urls(subj=subject)
     # default to huggingface urls if not specified
     if train_url is None:
         train_url = train_url_hf
@@ -213,30 +535,13 @@ def get_dataloaders(
     print("train_url", train_url)
     print("val_url", val_url)
 
-    if num_devices is None:
-        num_devices = torch.cuda.device_count()
-    print("num_devices", num_devices)
     if num_workers is None:
-        num_workers = num_devices
+        num_workers = torch.cuda.device_count()
     print("num_workers", num_workers)
-    
-    num_samples = 24983 # see metadata.json in webdataset_split folder
-    global_batch_size = batch_size * num_devices
-    num_batches = math.floor(num_samples / global_batch_size)
-    num_worker_batches = math.floor(num_batches / num_workers)
+    if rank is None or world_size is None:
+        rank, world_size = shards.get_rank_and_world_size()
+    print(f"rank {rank} of world_size {world_size}")
     print("batch_size", batch_size)
-    print("global_batch_size", global_batch_size)
-    print("num_worker_batches", num_worker_batches)
-    
-    # train_data = wds.DataPipeline([wds.ResampledShards(train_url),
-    #                     wds.tarfile_to_samples(),
-    #                     wds.shuffle(500,initial=500),
-    #                     wds.decode("torch"),
-    #                     wds.rename(images="jpg;png", voxels="nsdgeneral.npy", 
-    #                                 trial="trial.npy"),
-    #                     wds.to_tuple("voxels", image_var),
-    #                     wds.batched(batch_size, partial=True),
-    #                 ]).with_epoch(num_worker_batches)
 
     if 'http' not in train_url:
         # don't use cache if train_url is for local path
@@ -245,48 +550,126 @@ def get_dataloaders(
     if cache_dir is not None and not os.path.exists(cache_dir):
         os.makedirs(cache_dir)
 
-    train_data = wds.WebDataset(train_url, resampled=True, cache_dir=cache_dir)\
-        .shuffle(500, initial=500)\
-        .decode("torch")\
-        .rename(images="jpg;png", voxels=voxels_key, trial="trial.npy")\
-        .to_tuple("voxels", image_var)\
-        .batched(batch_size, partial=True)\
-        .with_epoch(num_worker_batches)
+    if clip_emb_dir is not None:
+        print("clip_emb_dir", clip_emb_dir)
+        train_emb_cache = clip_cache.ClipEmbeddingCache(clip_emb_dir, 'train', clip_config)
+        val_emb_cache = clip_cache.ClipEmbeddingCache(clip_emb_dir, 'val', clip_config)
+    else:
+        train_emb_cache, val_emb_cache = None, None
+
+    if voxel_store_dir is not None:
+        assert clip_emb_dir is not None or image_var == "trial", \
+            "the voxel store has no images, pass clip_emb_dir as well"
+        return voxel_store.get_dataloaders(voxel_store_dir, batch_size, num_workers, voxels_key,
+                                           train_emb_cache, val_emb_cache,
+                                           rank=rank, world_size=world_size, seed=seed,
+                                           brain_mask=brain_mask, mask_level=mask_level,
+                                           voxel_stats=voxel_stats)
+
+    if fields is None:
+        fields = get_fields(image_var, voxels_key, train_emb_cache, image_decode)
+    print("fields", fields)
+    if 'select_files' in inspect.signature(wds.tariterators.tar_file_expander).parameters:
+        # unused members are skipped by the tar reader and never copied into memory
+        select_files = functools.partial(is_selected_file, fields=fields)
+    else:
+        select_files = None
+    if cache_dir is not None:
+        cache = shard_cache.ShardCache(cache_dir, shard_cache_bytes, num_prefetch=prefetch_shards,
+                                       mirrors=shard_mirrors or ())
+        read_tars = functools.partial(shard_cache.cached_tarfile_samples, shard_cache=cache, select_files=select_files)
+    elif select_files is not None:
+        read_tars = wds.tarfile_to_samples(select_files=select_files)
+    else:
+        read_tars = wds.tarfile_to_samples()
+    # drop unused fields before the shuffle buffer and the decoder ever see them
+    project = wds.map(functools.partial(project_fields, fields=fields))
+    voxel_stages = []
+    if voxel_stats is not None:
+        # dequantize before cropping, the stats are laid out like the full volumes
+        voxel_stages.append(wds.map_tuple(voxel_stats.dequantize, None))
+    if brain_mask is not None:
+        print(brain_mask, "level", mask_level)
+        voxel_stages.append(wds.map_tuple(functools.partial(brain_mask, level=mask_level), None))
+
+    # training shards are partitioned across ranks, every rank sees all of validation
+    train_counts = shards.get_shard_counts(train_url, 'train', subject)
+    # exact per-shard counts let a resumed run skip whole shards
+    train_shards = shards.EpochShardList(train_url, rank, world_size, shuffle=True, seed=seed,
+                                         shard_counts=train_counts if shards.has_exact_counts(train_url) else None,
+                                         bufsize=500)
+    train_data = wds.DataPipeline(
+        train_shards,
+        read_tars,
+        project,
+        shards.EpochShuffle(train_shards, 500),
+        *decode_stages(image_var, voxels_key, batch_size, train_emb_cache, image_decode),
+        *voxel_stages,
+    )
 
-    if n_cache_recs > 0:
-        train_data = train_data.compose(wds.DBCache, os.path.join(cache_dir, "cache-train.db"),  n_cache_recs)
-    
     train_dl = wds.WebLoader(train_data, num_workers=num_workers,
-                            batch_size=None, shuffle=False, persistent_workers=True)
-
-    # Validation
-    num_samples = 492
-    num_batches = math.ceil(num_samples / global_batch_size)
-    num_worker_batches = math.ceil(num_batches / num_workers)
-    print("validation: num_worker_batches",num_worker_batches)
-
-    # val_data = wds.DataPipeline([wds.SimpleShardList(val_url),
-    #                     wds.tarfile_to_samples(),
-    #                     wds.decode("torch"),
-    #                     wds.rename(images="jpg;png", voxels="nsdgeneral.npy", 
-    #                                 trial="trial.npy"),
-    #                     wds.to_tuple("voxels", image_var),
-    #                     wds.batched(batch_size, partial=True),
-    #                 ]).with_epoch(num_worker_batches)
-
-    val_data = wds.WebDataset(val_url, cache_dir=cache_dir)\
-        .decode("torch")\
-        .rename(images="jpg;png", voxels=voxels_key, trial="trial.npy")\
-        .to_tuple("voxels", image_var)\
-        .batched(batch_size, partial=True)\
-        .with_epoch(num_worker_batches)
-    
+                            batch_size=None, shuffle=False, persistent_workers=num_workers > 0)
+    train_dl = shards.EpochLoader(train_dl, train_shards, train_counts,
+                                  batch_size, num_workers)
+    print("train: num_batches", train_dl.num_batches(0))
+
+    val_shards = shards.EpochShardList(val_url, shuffle=False)
+    val_data = wds.DataPipeline(
+        val_shards,
+        read_tars,
+        project,
+        *decode_stages(image_var, voxels_key, batch_size, val_emb_cache, image_decode),
+        *voxel_stages,
+    )
+
     val_dl = wds.WebLoader(val_data, num_workers=num_workers,
-                        batch_size=None, shuffle=False, persistent_workers=True)
+                        batch_size=None, shuffle=False, persistent_workers=num_workers > 0)
+    val_dl = shards.EpochLoader(val_dl, val_shards, shards.get_shard_counts(val_url, 'val', subject),
+                                batch_size, num_workers)
+    print("validation: num_batches", val_dl.num_batches(0))
+
+    if train_cache_bytes > 0:
+        train_dl = loaders.CachedLoader(train_dl, train_cache_bytes, cache_spill_dir and os.path.join(cache_spill_dir, 'train'),
+                                        shuffle=True, seed=seed, name='train')
+    if val_cache_bytes > 0:
+        val_dl = loaders.CachedLoader(val_dl, val_cache_bytes, cache_spill_dir and os.path.join(cache_spill_dir, 'val'),
+                                      name='val')
 
-    if n_cache_recs > 0:
-        val_data = val_data.compose(wds.DBCache, os.path.join(cache_dir, "cache-val.db"),  n_cache_recs)
+    return train_dl, val_dl
+
+def get_multisubject_dataloaders(subjects, subject_weights=None, train_urls=None, val_urls=None,
+                                 batch_size=None, image_var=None, num_workers=None, seed=0, **kwargs):
+    """
+    Loaders over several subjects: each subject gets its own get_dataloaders loaders, with
+    num_workers split between them, so all subjects' shards are read in parallel. The
+    training batches are interleaved by loaders.SubjectMixLoader, in proportion to
+    subject_weights (defaults to the subjects' sizes), validation reads each subject in turn.
 
+    Every batch holds a single subject, so no padding is needed for the subjects' different
+    voxel counts (NSDGENERAL_VOXELS), and has a third item, the subject id of each sample.
+    """
+    assert kwargs.get('voxel_store_dir') is None and kwargs.get('clip_emb_dir') is None, \
+        "the voxel store and embedding cache are per subject, not supported with several subjects yet"
+    if num_workers is None:
+        num_workers = torch.cuda.device_count()
+    subject_workers = max(1, num_workers // len(subjects)) if num_workers > 0 else 0
+    train_dls, val_dls = [], []
+    for subj in subjects:
+        print(f"subj{subj:02d}:")
+        train_url_hf, val_url_hf = get_huggingface_urls(subj=subj)
+        train_dl, val_dl = get_dataloaders(
+            batch_size, image_var,
+            num_workers=subject_workers,
+            train_url=(train_urls or {}).get(subj) or train_url_hf,
+            val_url=(val_urls or {}).get(subj) or val_url_hf,
+            seed=seed,
+            subject=subj,
+            **kwargs,
+        )
+        train_dls.append(train_dl)
+        val_dls.append(val_dl)
+    train_dl = loaders.SubjectMixLoader(train_dls, subjects, subject_weights, seed=seed)
+    val_dl = loaders.SubjectMixLoader(val_dls, subjects, sequential=True)
     return train_dl, val_dl
 
 @torch.no_grad()
@@ -305,6 +688,7 @@ def sample_images(
     
     assert voxel.shape[0] == img_input.shape[0], 'batch dim must be the same for voxels and images'
     n_examples = voxel.shape[0]
+    img_input = image_to_float(img_input)
 
     clip_extractor.eval()
     brain_net.eval()
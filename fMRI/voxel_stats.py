@@ -0,0 +1,177 @@
+"""
+Per-voxel normalization statistics of the voxel arrays (nsdgeneral.npy, wholebrain_3d.npy),
+and z-scored fp16 / per-voxel scaled int8 quantization built on them.
+
+compute_voxel_stats.py makes one streaming pass over the train shards, merging the mean
+and variance of each batch into running totals (Chan et al.'s parallel update, in float64),
+overall and per scanning session. The stats are saved as an .npz and used to
+
+- normalize incoming voxels the same way at inference (VoxelStats.normalize)
+- quantize the stored voxels (pack_voxels.py / quantize_voxels.py --quantize=...)
+- dequantize them again in the loaders (VoxelStats.dequantize)
+
+Quantized voxels are z-scores: float16 stores them as is, int8 as round(z / scale) with a
+per-voxel scale that maps the voxel's largest |z| seen in the stats pass (clipped at
+`clip` standard deviations) to 127. Dequantizing gives float16 z-scores, which the
+DevicePrefetcher turns into float32 on the gpu.
+"""
+import os
+import numpy as np
+import torch
+
+# NSD runs 750 trials per scanning session
+TRIALS_PER_SESSION = 750
+QUANTIZE_DTYPES = ('float16', 'int8')
+
+
+def stats_path(stats_dir, voxels_key):
+    return os.path.join(stats_dir, voxels_key.replace('.npy', '') + '_stats.npz')
+
+
+def trial_to_session(trials, trials_per_session=TRIALS_PER_SESSION):
+    return np.asarray(trials).reshape(-1) // trials_per_session
+
+
+class RunningStats:
+    """Streaming mean / variance / min / max over the first axis of the batches"""
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        if n == 0:
+            return
+        mean = x.mean(axis=0)
+        m2 = ((x - mean)**2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n, mean, m2
+            self.min, self.max = x.min(axis=0), x.max(axis=0)
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta**2 * (self.count * n / total)
+        self.count = total
+        np.minimum(self.min, x.min(axis=0), out=self.min)
+        np.maximum(self.max, x.max(axis=0), out=self.max)
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / max(self.count - 1, 1))
+
+
+class VoxelStatsAccumulator:
+    """Overall and per-session RunningStats, fed batches of (voxels, trials)"""
+    def __init__(self, trials_per_session=TRIALS_PER_SESSION):
+        self.trials_per_session = trials_per_session
+        self.total = RunningStats()
+        self.sessions = {}
+
+    def update(self, voxels, trials):
+        voxels = np.asarray(voxels)
+        self.total.update(voxels)
+        sessions = trial_to_session(trials, self.trials_per_session)
+        for s in np.unique(sessions):
+            self.sessions.setdefault(int(s), RunningStats()).update(voxels[sessions == s])
+
+    def finalize(self, eps=1e-6):
+        ids = sorted(self.sessions)
+        std = self.total.std
+        absmax_z = np.maximum(self.total.max - self.total.mean, self.total.mean - self.total.min) / (std + eps)
+        return VoxelStats(
+            mean=self.total.mean.astype(np.float32),
+            std=std.astype(np.float32),
+            absmax_z=absmax_z.astype(np.float32),
+            count=self.total.count,
+            session_ids=np.array(ids, dtype=np.int64),
+            session_mean=np.stack([self.sessions[s].mean for s in ids]).astype(np.float32),
+            session_std=np.stack([self.sessions[s].std for s in ids]).astype(np.float32),
+            trials_per_session=self.trials_per_session,
+        )
+
+
+class VoxelStats:
+    def __init__(self, mean, std, absmax_z, count, session_ids, session_mean, session_std,
+                 trials_per_session=TRIALS_PER_SESSION, clip=4., eps=1e-6):
+        self.mean = mean
+        self.std = std
+        self.absmax_z = absmax_z
+        self.count = int(count)
+        self.session_ids = session_ids
+        self.session_mean = session_mean
+        self.session_std = session_std
+        self.trials_per_session = int(trials_per_session)
+        self.clip = float(clip)
+        self.eps = eps
+        # int8 step of each voxel, in z units
+        self.scale = (np.minimum(absmax_z, clip) / 127).clip(min=eps).astype(np.float32)
+        self._scale_t = None
+
+    def save(self, path):
+        np.savez(path, mean=self.mean, std=self.std, absmax_z=self.absmax_z, count=self.count,
+                 session_ids=self.session_ids, session_mean=self.session_mean,
+                 session_std=self.session_std, trials_per_session=self.trials_per_session,
+                 clip=self.clip)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(**{k: data[k] for k in data.files})
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_scale_t'] = None
+        return state
+
+    def normalize(self, voxels, trials=None, per_session=False):
+        """
+        z-score voxels (numpy or torch, [n, *voxel_shape]) with the overall stats, or with
+        the stats of each sample's session if per_session (needs the trials, and falls
+        back to the overall stats for sessions not seen in the stats pass).
+        """
+        is_torch = isinstance(voxels, torch.Tensor)
+        x = voxels.float().cpu().numpy() if is_torch else np.asarray(voxels, dtype=np.float32)
+        if per_session:
+            assert trials is not None, "per_session normalization needs the trials"
+            rows = np.searchsorted(self.session_ids, trial_to_session(trials, self.trials_per_session))
+            rows = rows.clip(max=len(self.session_ids) - 1)
+            found = self.session_ids[rows] == trial_to_session(trials, self.trials_per_session)
+            mean = np.where(found.reshape((-1,) + (1,) * (x.ndim - 1)), self.session_mean[rows], self.mean)
+            std = np.where(found.reshape((-1,) + (1,) * (x.ndim - 1)), self.session_std[rows], self.std)
+        else:
+            mean, std = self.mean, self.std
+        z = (x - mean) / (std + self.eps)
+        return torch.from_numpy(z).to(voxels.device) if is_torch else z
+
+    def quantize(self, voxels, dtype):
+        """Raw voxels (numpy or torch) to z-scores stored as float16, or int8 steps of self.scale (numpy)"""
+        assert dtype in QUANTIZE_DTYPES, f"dtype must be one of {QUANTIZE_DTYPES}, not {dtype}"
+        z = self.normalize(np.asarray(voxels))
+        if dtype == 'float16':
+            return z.astype(np.float16)
+        return np.rint(z / self.scale).clip(-127, 127).astype(np.int8)
+
+    def dequantize(self, voxels, scale=None):
+        """
+        Loader stage: a batch of quantized voxels (torch, or numpy as batched by the tar
+        path) to float16 z-scores. int8 values
+        are multiplied by their voxel's scale (pass scale if the stored layout differs
+        from the voxel shape, e.g. after brain mask packing), float16 passes through, and
+        float32/float64 voxels are taken to be raw, unquantized ones and normalized.
+        """
+        voxels = torch.as_tensor(voxels)
+        if voxels.dtype == torch.float16:
+            return voxels
+        if voxels.dtype in (torch.float32, torch.float64):
+            return self.normalize(voxels).half()
+        assert voxels.dtype == torch.int8, f"expected float or int8 voxels, got {voxels.dtype}"
+        if scale is None:
+            if self._scale_t is None:
+                self._scale_t = torch.from_numpy(self.scale)
+            scale = self._scale_t
+        return (voxels.float() * scale).half()
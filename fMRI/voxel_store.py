@@ -0,0 +1,269 @@
+"""
+Memory-mapped voxel store, written once by pack_voxels.py so training doesn't have to
+parse a tar member and decode an .npy file for every sample.
+
+A store directory holds, for each split:
+
+    {split}_voxels.bin    raw (num_samples, *voxel_shape) array, float32 or float16
+    {split}_index.npz     keys (webdataset __key__) and trial of every row
+    {split}_meta.json     shape, dtype and voxels_key of the array
+
+Stores packed with a brain mask (pack_voxels.py --mask_path=...) hold only the in-mask
+voxels of each volume, rows of shape (num_voxels,), and a copy of the mask in
+brain_mask.npz. VoxelStore rebuilds the cropped volumes, see brain_mask.py.
+
+Stores packed with --quantize=float16/int8 hold z-scored (and for int8, per-voxel scaled)
+voxels and a copy of the stats in voxel_stats.npz, VoxelStore dequantizes them to
+float16 z-scores, see voxel_stats.py.
+"""
+import os
+import json
+import math
+import numpy as np
+import torch
+
+import brain_mask as brain_mask_lib
+from voxel_stats import VoxelStats
+
+
+def read_meta(store_dir, split):
+    with open(os.path.join(store_dir, f'{split}_meta.json')) as f:
+        return json.load(f)
+
+
+class VoxelStoreWriter:
+    """Appends batches of voxels to a store split, the final shape is only known at close()"""
+    def __init__(self, store_dir, split, voxels_key, dtype='float32', brain_mask=None, voxel_stats=None):
+        """with voxel_stats, dtype float16 or int8 quantizes the voxels (VoxelStats.quantize)"""
+        assert dtype in ('float32', 'float16', 'int8'), f"dtype must be float32, float16 or int8, not {dtype}"
+        assert dtype != 'int8' or voxel_stats is not None, "int8 needs voxel_stats to quantize with"
+        os.makedirs(store_dir, exist_ok=True)
+        self.store_dir = store_dir
+        self.split = split
+        self.voxels_key = voxels_key
+        self.dtype = np.dtype(dtype)
+        self.bin_path = os.path.join(store_dir, f'{split}_voxels.bin')
+        self.f = open(self.bin_path + '.tmp', 'wb')
+        self.keys, self.trials = [], []
+        self.voxel_shape = None
+        self.brain_mask = brain_mask
+        if brain_mask is not None:
+            brain_mask_lib.save_mask(os.path.join(store_dir, 'brain_mask.npz'), brain_mask.mask, brain_mask.bbox)
+        self.voxel_stats = voxel_stats
+        if voxel_stats is not None:
+            voxel_stats.save(os.path.join(store_dir, 'voxel_stats.npz'))
+
+    def write(self, keys, voxels, trials):
+        voxels = np.asarray(voxels) # the WebLoader hands over tensors
+        if self.voxel_stats is not None:
+            voxels = self.voxel_stats.quantize(voxels, self.dtype.name)
+        if self.brain_mask is not None:
+            voxels = self.brain_mask.pack(voxels)
+        voxels = np.ascontiguousarray(voxels, dtype=self.dtype)
+        if self.voxel_shape is None:
+            self.voxel_shape = list(voxels.shape[1:])
+        assert list(voxels.shape[1:]) == self.voxel_shape, \
+            f"voxel shape changed from {self.voxel_shape} to {list(voxels.shape[1:])}"
+        self.f.write(voxels.tobytes())
+        self.keys.extend(keys)
+        self.trials.extend(np.asarray(trials).reshape(len(keys)).tolist())
+
+    def close(self):
+        self.f.close()
+        os.replace(self.bin_path + '.tmp', self.bin_path)
+        np.savez(os.path.join(self.store_dir, f'{self.split}_index.npz'),
+                 keys=np.array(self.keys), trial=np.array(self.trials, dtype=np.int64))
+        meta = dict(
+            shape=[len(self.keys)] + self.voxel_shape,
+            dtype=self.dtype.name,
+            voxels_key=self.voxels_key,
+            masked=self.brain_mask is not None,
+            quantized=self.voxel_stats is not None,
+        )
+        with open(os.path.join(self.store_dir, f'{self.split}_meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        print(f"wrote {len(self.keys)} {self.split} samples to {self.store_dir}")
+
+
+class VoxelStore(torch.utils.data.Dataset):
+    """
+    Random-access dataset over a store split. Indexing takes a whole batch of indices
+    and gathers it with one fancy-index read, so use it with a BatchSampler and
+    batch_size=None in the DataLoader (see get_dataloaders).
+
+    Items are (voxels, clip_emb) if an emb_cache (clip_cache.ClipEmbeddingCache) is
+    given, and (voxels, trial) otherwise. The memmap is opened lazily in each worker,
+    so the workers share the OS page cache instead of copies of the array.
+
+    Volumes of a masked store, or of a dense store when a brain_mask is given, come out
+    cropped to the mask at pyramid level mask_level.
+
+    Voxels of a quantized store, or of any store when voxel_stats is given, come out as
+    float16 z-scores.
+    """
+    def __init__(self, store_dir, split, emb_cache=None, brain_mask=None, mask_level=0, voxel_stats=None):
+        self.meta = read_meta(store_dir, split)
+        if self.meta.get('masked', False):
+            stored_mask = brain_mask_lib.load_mask(os.path.join(store_dir, 'brain_mask.npz'))
+            assert brain_mask is None or brain_mask == stored_mask, \
+                f"the voxel store was packed with a different brain mask: {stored_mask}"
+            brain_mask = stored_mask
+        self.brain_mask = brain_mask
+        self.mask_level = mask_level
+        self.dequant_scale = None
+        if self.meta.get('quantized', False):
+            # the stats the store was quantized with, whatever was passed in
+            voxel_stats = VoxelStats.load(os.path.join(store_dir, 'voxel_stats.npz'))
+            scale = voxel_stats.scale
+            if self.meta.get('masked', False):
+                scale = brain_mask.pack(scale[None])[0]
+            self.dequant_scale = torch.from_numpy(np.ascontiguousarray(scale))
+        else:
+            assert voxel_stats is None or not self.meta.get('masked', False), \
+                "normalizing a masked store on the fly isn't supported, pack it with --quantize instead"
+        self.voxel_stats = voxel_stats
+        self.bin_path = os.path.join(store_dir, f'{split}_voxels.bin')
+        index = np.load(os.path.join(store_dir, f'{split}_index.npz'))
+        self.keys = index['keys']
+        self.trials = index['trial']
+        self.emb_cache = emb_cache
+        if emb_cache is not None:
+            # row of each sample in the embedding cache
+            self.emb_rows = np.array([emb_cache.index[key] for key in self.keys])
+        self._voxels = None
+
+    @property
+    def voxels(self):
+        if self._voxels is None:
+            self._voxels = np.memmap(self.bin_path, dtype=self.meta['dtype'], mode='r',
+                                     shape=tuple(self.meta['shape']))
+        return self._voxels
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_voxels'] = None
+        return state
+
+    def __len__(self):
+        return self.meta['shape'][0]
+
+    def __getitem__(self, indices):
+        # sorted indices turn the gather into a mostly sequential read, the batch is
+        # already a random subset so its order doesn't matter
+        indices = np.sort(np.asarray(indices))
+        voxels = torch.from_numpy(self.voxels[indices])
+        if self.dequant_scale is not None:
+            voxels = self.voxel_stats.dequantize(voxels, self.dequant_scale)
+        elif self.voxel_stats is not None:
+            voxels = self.voxel_stats.dequantize(voxels.float())
+        if self.brain_mask is not None:
+            voxels = self.brain_mask(voxels, self.mask_level)
+        if self.emb_cache is not None:
+            return voxels, torch.from_numpy(self.emb_cache.embs[self.emb_rows[indices]])
+        return voxels, torch.from_numpy(self.trials[indices])
+
+
+class EpochBatchSampler(torch.utils.data.Sampler):
+    """
+    Batches of indices for VoxelStore, a fresh permutation each epoch that is split
+    across ranks. Under DDP the tail is dropped so all ranks take the same number of steps.
+
+    load_state_dict() resumes from a StoreLoader.state_dict() position, with only indices
+    to skip. The DataLoader draws batches from the sampler ahead of the training step, so
+    the position itself is counted by StoreLoader.
+    """
+    def __init__(self, num_samples, batch_size, rank=0, world_size=1, shuffle=True, seed=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def load_state_dict(self, state):
+        assert state['seed'] == self.seed, f"the state is from a run with seed {state['seed']}, not {self.seed}"
+        epoch, batch = state['epoch'], state['batch']
+        if batch >= len(self):
+            epoch, batch = epoch + 1, 0
+        self.epoch, self.skip_batches = epoch, batch
+        print(f"resuming at epoch {epoch}, batch {batch}")
+
+    def rank_indices(self, epoch):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + epoch)
+            indices = torch.randperm(self.num_samples, generator=g).numpy()
+        else:
+            indices = np.arange(self.num_samples)
+        if self.world_size == 1:
+            return indices
+        return indices[self.rank::self.world_size][:self.num_samples // self.world_size]
+
+    def __len__(self):
+        return math.ceil(len(self.rank_indices(0)) / self.batch_size)
+
+    def __iter__(self):
+        indices = self.rank_indices(self.epoch)
+        self.epoch += 1
+        skip, self.skip_batches = self.skip_batches, 0
+        for i in range(skip * self.batch_size, len(indices), self.batch_size):
+            yield indices[i:i + self.batch_size]
+
+
+class StoreLoader:
+    """
+    The DataLoader over a VoxelStore, counting the batches it hands out. state_dict() is
+    the position after the last of them, like shards.EpochLoader. The workers prefetch
+    prefetch_factor * num_workers batches, so the sampler's own count would run ahead of
+    training and a resumed run would skip the prefetched samples.
+    """
+    def __init__(self, loader):
+        self.loader = loader
+        self.sampler = loader.sampler
+        self.epoch = 0
+        self.batch = 0 # batches handed out in the current epoch
+        self.started = False
+
+    def __len__(self):
+        return len(self.loader)
+
+    def state_dict(self):
+        if not self.started:
+            # nothing handed out yet, so the position is the one the sampler resumes from
+            return dict(epoch=self.sampler.epoch, batch=self.sampler.skip_batches, seed=self.sampler.seed)
+        return dict(epoch=self.epoch - 1, batch=self.batch, seed=self.sampler.seed)
+
+    def load_state_dict(self, state):
+        self.sampler.load_state_dict(state)
+        self.started = False
+
+    def __iter__(self):
+        self.started = True
+        # read before the DataLoader starts the sampler's epoch
+        self.epoch = self.sampler.epoch + 1
+        self.batch = self.sampler.skip_batches
+        for batch in self.loader:
+            self.batch += 1
+            yield batch
+
+
+def get_dataloaders(store_dir, batch_size, num_workers, voxels_key, train_emb_cache=None, val_emb_cache=None,
+                    rank=0, world_size=1, seed=0, brain_mask=None, mask_level=0, voxel_stats=None):
+    loaders = []
+    for split, emb_cache in (('train', train_emb_cache), ('val', val_emb_cache)):
+        dataset = VoxelStore(store_dir, split, emb_cache, brain_mask, mask_level, voxel_stats)
+        assert dataset.meta['voxels_key'] == voxels_key, \
+            f"voxel store has {dataset.meta['voxels_key']}, not {voxels_key}"
+        if split == 'train':
+            batch_sampler = EpochBatchSampler(len(dataset), batch_size, rank, world_size, shuffle=True, seed=seed)
+        else:
+            # every rank sees all of validation
+            batch_sampler = EpochBatchSampler(len(dataset), batch_size, shuffle=False)
+        loaders.append(StoreLoader(torch.utils.data.DataLoader(
+            dataset, sampler=batch_sampler, batch_size=None, num_workers=num_workers,
+            pin_memory=torch.cuda.is_available(), persistent_workers=num_workers > 0,
+        )))
+        print(f"{split}: {len(dataset)} samples from voxel store {store_dir}")
+    return tuple(loaders)